@@ -44,6 +44,10 @@ def create_app(config_name=None):
     migrate.init_app(app, db)
     login_manager.init_app(app)
     
+    # Stripe：API key、重试和熔断参数（HTTP 连接池在每个 worker 首次调用时创建）
+    from app.stripe_client import init_stripe
+    init_stripe(app)
+    
     # 注册路由蓝图（后续可添加）
     from app import routes
     app.register_blueprint(routes.bp)
@@ -56,8 +60,10 @@ def create_app(config_name=None):
     if config_name != 'testing':
         try:
             from apscheduler.schedulers.background import BackgroundScheduler
-            from app.tasks import send_installment_reminders
+            from app.tasks import send_installment_reminders, update_revenue_rollup_job, sweep_expired_checkouts_job, process_stripe_events_job
             
+            # 每个 gunicorn worker 都有一个调度器；任务每次运行先取数据库锁（app.tasks.single_instance），
+            # 同一时刻只有一个进程执行，其余进程本次跳过
             scheduler = BackgroundScheduler()
             # 每天上午 9 点运行
             scheduler.add_job(
@@ -65,8 +71,44 @@ def create_app(config_name=None):
                 'cron',
                 hour=9,
                 minute=0,
+                args=[app],
                 id='send_installment_reminders',
-                replace_existing=True
+                replace_existing=True,
+                max_instances=1,
+                coalesce=True
+            )
+            # 每日收入汇总增量更新
+            scheduler.add_job(
+                update_revenue_rollup_job,
+                'interval',
+                minutes=app.config.get('REVENUE_ROLLUP_INTERVAL_MINUTES', 10),
+                args=[app],
+                id='update_revenue_rollup',
+                replace_existing=True,
+                max_instances=1,
+                coalesce=True
+            )
+            # 清理过期的结账（PendingBooking 过期 / 删除、释放名额锁定）
+            scheduler.add_job(
+                sweep_expired_checkouts_job,
+                'interval',
+                minutes=app.config.get('INVENTORY_HOLD_SWEEP_MINUTES', 5),
+                args=[app],
+                id='sweep_expired_checkouts',
+                replace_existing=True,
+                max_instances=1,
+                coalesce=True
+            )
+            # Stripe Webhook 收件箱：后台按 PaymentIntent 顺序处理（webhook 收到新事件时会提前唤醒）
+            scheduler.add_job(
+                process_stripe_events_job,
+                'interval',
+                seconds=app.config.get('STRIPE_EVENT_POLL_SECONDS', 5),
+                args=[app],
+                id='process_stripe_events',
+                replace_existing=True,
+                max_instances=1,
+                coalesce=True
             )
             
             try:
@@ -1,135 +1,72 @@
-from datetime import date, datetime
+from datetime import date, datetime, timedelta
+import hashlib
 import json
+import time
 from flask import render_template, redirect, url_for, flash, request, jsonify, current_app, send_file
 from flask_login import login_user, logout_user, current_user, login_required
 from sqlalchemy.orm import joinedload
 from sqlalchemy import or_, and_
+from sqlalchemy.exc import IntegrityError
 from app import db
 from app.admin import bp
 from app.admin.forms import LoginForm, TripForm, CityForm, ClientForm, TripBasicsForm, TripDescriptionForm, TripPackagesForm, TripAddonsForm, TripParticipantForm, TripCouponForm, EditBookingForm
-from app.models import User, Trip, City, Client, Lead, TripPackage, TripAddOn, CustomQuestion, DiscountCode, Booking, BookingParticipant, BookingAddOn, BookingPackage, Payment, Message, InstallmentPayment
+from app.models import User, Trip, City, Client, Lead, TripPackage, TripAddOn, CustomQuestion, BuyerInfoField, DiscountCode, Booking, BookingParticipant, BookingAddOn, BookingPackage, Payment, Message, InstallmentPayment
 from app.payments import create_checkout_session
+from app.stats import (
+    calculate_trips_stats,
+    get_trip_financial_summaries,
+    refresh_trip_financial_summary,
+    get_report_trip_lists,
+    get_cached_trip_summaries,
+    reports_cache_stats,
+    clear_report_trip_lists,
+    get_trip_counts,
+    invalidate_trip_counts,
+)
+from app.pricing import price_bookings, price_booking
+from app.inventory import recount_trip_inventory
+from app.trip_pages import invalidate_trip_page
+from app.customers import get_customers_page, DEFAULT_PAGE_SIZE
+from app.leads import get_lead_stats, get_leads_page
+from app.clients import upsert_client
+from app.discounts import invalidate_discount_codes
 from app.utils import save_image, send_email_via_ses, generate_installment_token
 
 
-def get_trip_counts():
-    """计算各类型行程的数量，用于侧边栏导航"""
-    today = date.today()
-    return {
-        'upcoming': Trip.query.filter(Trip.status == 'published', Trip.end_date >= today).count(),
-        'past': Trip.query.filter(Trip.status == 'published', Trip.end_date < today).count(),
-        'draft': Trip.query.filter(Trip.status == 'draft').count(),
-        'deactivated': Trip.query.filter(Trip.status == 'deactivated').count()
-    }
-
 def calculate_trip_stats(trip):
     """
-    计算行程的统计信息（参与者数量、已付金额、应付金额）
+    计算单个行程的统计信息（参与者数量、已付金额、应付金额）
     返回: dict with 'participants_count', 'amount_paid', 'amount_gross', 'amount_discount', 'amount_expected', 'amount_available'
-    
-    重要说明：
-    - amount_paid: 来自 Booking.amount_paid，是客户实际支付的基础金额（不含 Stripe 手续费）
-    - amount_gross: 原价总额（套餐 + 附加项）
-    - amount_discount: 折扣总额
-    - amount_expected: 净应收金额（gross - discount）
-    - amount_available: expected - paid（待收金额）
+
+    计算口径见 app.stats.calculate_trips_stats；列表页请直接批量调用它，避免逐个行程查询
     """
-    bookings = trip.bookings.all() if trip.bookings else []
-    
-    # 计算参与者总数
-    participants_count = 0
-    for booking in bookings:
-        participants_count += booking.participants.count()
-    
-    # 计算已付金额（Booking.amount_paid 只记录基础金额，不含手续费）
-    amount_paid = sum(b.amount_paid or 0.0 for b in bookings)
-    
-    # 计算应付金额（套餐 + 附加项 - 折扣）
-    amount_gross = 0.0
-    amount_discount = 0.0
-    amount_expected = 0.0
-    
-    for b in bookings:
-        booking_gross = 0.0
-        has_packages = False
-        
-        # Calculate expected amount from BookingPackages
-        for bp in b.booking_packages:
-            if bp.package:
-                package_price = float(bp.package.price) if bp.package.price is not None else 0.0
-                quantity = int(bp.quantity) if bp.quantity is not None else 1
-                booking_gross += package_price * quantity
-                has_packages = True
-        
-        # Add add-ons prices (收集所有 add-ons，避免重复计算)
-        seen_addon_ids = set()
-        
-        # 方法1：通过 participant.addons 获取
-        for participant in b.participants:
-            for booking_addon in participant.addons:
-                if booking_addon.addon and booking_addon.id not in seen_addon_ids:
-                    addon_price = float(booking_addon.addon.price) if booking_addon.addon.price is not None else 0.0
-                    quantity = int(booking_addon.quantity) if booking_addon.quantity is not None else 1
-                    booking_gross += addon_price * quantity
-                    seen_addon_ids.add(booking_addon.id)
-        
-        # 方法2：通过 booking.addons 获取（直接关联的 add-ons）
-        for booking_addon in b.addons:
-            if booking_addon.addon and booking_addon.id not in seen_addon_ids:
-                addon_price = float(booking_addon.addon.price) if booking_addon.addon.price is not None else 0.0
-                quantity = int(booking_addon.quantity) if booking_addon.quantity is not None else 1
-                booking_gross += addon_price * quantity
-                seen_addon_ids.add(booking_addon.id)
-        
-        # 折扣金额
-        discount = float(b.discount_amount) if b.discount_amount else 0.0
-        booking_expected = max(0.0, booking_gross - discount)
-        
-        # Fallback for legacy bookings without BookingPackages
-        if not has_packages:
-            booking_gross = float(b.amount_paid) if b.amount_paid is not None else 0.0
-            booking_expected = booking_gross
-            discount = 0.0
-        
-        amount_gross += booking_gross
-        amount_discount += discount
-        amount_expected += booking_expected
-    
-    # Amount available = Expected - Paid (待收金额)
-    amount_available = amount_expected - amount_paid
-    
-    return {
-        'participants_count': participants_count,
-        'amount_paid': amount_paid,
-        'amount_gross': amount_gross,
-        'amount_discount': amount_discount,
-        'amount_expected': amount_expected,
-        'amount_available': amount_available
-    }
+    return calculate_trips_stats([trip.id])[trip.id]
 
-def check_trip_completion(trip):
+def update_trip_completion(trip):
     """
-    检查行程是否完成了所有必需步骤的设置
-    如果完成，根据日期自动更新status为published
+    重新计算行程是否完成了所有必需步骤的设置，结果保存在 trip.setup_complete
+    如果完成，草稿自动更新status为published
+
+    只在会改变这些输入的地方调用（builder 的 basics / description / packages 步骤），
+    不提交事务，由调用方 commit；列表页直接读取 setup_complete / status，不再逐个检查。
     """
-    # Step 1 (Basics): 检查必需字段
-    if not trip.title or not trip.start_date or not trip.end_date or not trip.destination_text:
-        return False
-    
-    # Step 2 (Description): 检查描述
-    if not trip.description:
-        return False
-    
-    # Step 3 (Packages): 至少需要一个套餐
-    if trip.packages.count() == 0:
-        return False
+    complete = bool(
+        # Step 1 (Basics): 检查必需字段
+        trip.title and trip.start_date and trip.end_date and trip.destination_text
+        # Step 2 (Description): 检查描述
+        and trip.description
+        # Step 3 (Packages): 至少需要一个套餐
+        and trip.packages.count() > 0
+    )
+    trip.setup_complete = complete
     
     # 所有必需步骤都完成了，更新status
-    if trip.status == 'draft':
+    if complete and trip.status == 'draft':
         trip.status = 'published'
-        db.session.commit()
+    # 状态或日期（upcoming / past 分组）可能变化，提交后刷新侧边栏计数
+    invalidate_trip_counts()
     
-    return True
+    return complete
 
 # Force reload
 
@@ -186,11 +123,6 @@ def trips():
     query = Trip.query
     today = date.today()
     
-    # Check and update trip status for all draft trips (ensure data consistency)
-    draft_trips = Trip.query.filter(Trip.status == 'draft').all()
-    for trip in draft_trips:
-        check_trip_completion(trip)
-    
     # Base Query
     # status filtering
     if filter_type == 'upcoming':
@@ -242,10 +174,8 @@ def trips():
     # Calculate counts for sidebar navigation
     trip_counts = get_trip_counts()
     
-    # Calculate stats for each trip (participants count, amounts)
-    trip_stats = {}
-    for trip in trips:
-        trip_stats[trip.id] = calculate_trip_stats(trip)
+    # Read precomputed stats for all listed trips (trip_financial_summary)
+    trip_stats = get_trip_financial_summaries([trip.id for trip in trips])
     
     view_type = request.args.get('view', 'list')
     if view_type == 'calendar':
@@ -257,8 +187,57 @@ def trips():
 @bp.route('/trips/json')
 @login_required
 def trips_json():
-    """返回行程数据供日历使用"""
-    trips = Trip.query.filter(Trip.status != 'archived').all()
+    """
+    返回行程数据供日历使用
+
+    接收 FullCalendar 的 start / end 窗口参数，只查询与窗口重叠的行程（走 ix_trips_start_end）；
+    响应带 ETag / Last-Modified（窗口内行程数 + 最大 updated_at），未变化时直接返回 304。
+    """
+    def _parse_day(value):
+        # FullCalendar 传 ISO 时间（可能带时区），只取日期部分
+        try:
+            return date.fromisoformat(value[:10]) if value else None
+        except ValueError:
+            return None
+
+    window_start = _parse_day(request.args.get('start'))
+    window_end = _parse_day(request.args.get('end'))
+
+    query = Trip.query.filter(Trip.status != 'archived')
+    if window_start and window_end:
+        # FullCalendar 的 end 不包含在窗口内
+        query = query.filter(Trip.start_date < window_end, Trip.end_date >= window_start)
+
+    # 版本戳：行程数（覆盖删除/归档）+ 最大 updated_at（覆盖修改）
+    trip_count, last_updated = query.with_entities(
+        db.func.count(Trip.id),
+        db.func.max(Trip.updated_at)
+    ).one()
+    etag = hashlib.sha1(
+        f'{window_start}|{window_end}|{trip_count}|{last_updated.isoformat() if last_updated else ""}'.encode('utf-8')
+    ).hexdigest()
+
+    def _with_validators(response):
+        response.set_etag(etag)
+        if last_updated:
+            response.last_modified = last_updated
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+        return response
+
+    if request.if_none_match.contains(etag) or (
+        not request.if_none_match and last_updated and request.if_modified_since
+        and last_updated.replace(microsecond=0) <= request.if_modified_since.replace(tzinfo=None)
+    ):
+        return _with_validators(current_app.response_class(status=304))
+
+    trips = query.with_entities(
+        Trip.id, Trip.title, Trip.start_date, Trip.end_date,
+        Trip.status, Trip.color, Trip.spots_sold, Trip.capacity
+    ).all()
+
+    # 编辑链接只生成一次
+    edit_url = url_for('admin.edit_trip', id=0).replace('/0/', '/{id}/')
     events = []
     
     for trip in trips:
@@ -271,7 +250,7 @@ def trips_json():
             'title': trip.title,
             'start': trip.start_date.isoformat() if trip.start_date else None,
             'end': trip.end_date.isoformat() if trip.end_date else None,
-            'url': url_for('admin.edit_trip', id=trip.id),
+            'url': edit_url.format(id=trip.id),
             'backgroundColor': color,
             'borderColor': color,
             'extendedProps': {
@@ -280,135 +259,70 @@ def trips_json():
             }
         })
     
-    from flask import jsonify
-    return jsonify(events)
+    return _with_validators(jsonify(events))
 
 
 @bp.route('/trips/<int:id>/manage')
 @login_required
 def manage_trip(id):
     trip = Trip.query.get_or_404(id)
-    bookings = trip.bookings.all() if trip.bookings else []
+    bookings = Booking.query.options(joinedload(Booking.client)).filter_by(trip_id=trip.id).all()
     
-    # Financial Calculations
+    # Financial Calculations（读取 trip_financial_summary，口径与行程列表、报表一致）
     # amount_paid 是客户实际支付的基础金额（不含 Stripe 手续费）
-    total_paid = sum(b.amount_paid or 0.0 for b in bookings)
-    total_gross = 0.0  # 原价总额（未扣除折扣）
-    total_discount = 0.0  # 折扣总额
-    total_expected = 0.0  # 净应收金额（扣除折扣后）
-    
-    for b in bookings:
-        booking_gross = 0.0  # 该订单原价
-        has_packages = False
-        seen_addon_ids = set()
-        
-        # Calculate expected amount from BookingPackages
-        for bp in b.booking_packages:
-            if bp.package:  # Check if package exists
-                package_price = float(bp.package.price) if bp.package.price is not None else 0.0
-                quantity = int(bp.quantity) if bp.quantity is not None else 1
-                booking_gross += package_price * quantity
-                has_packages = True
-        
-        # Add add-ons prices (通过 participant.addons)
-        for participant in b.participants:
-            for booking_addon in participant.addons:
-                if booking_addon.addon and booking_addon.id not in seen_addon_ids:
-                    addon_price = float(booking_addon.addon.price) if booking_addon.addon.price is not None else 0.0
-                    quantity = int(booking_addon.quantity) if booking_addon.quantity is not None else 0
-                    booking_gross += addon_price * quantity
-                    seen_addon_ids.add(booking_addon.id)
-        
-        # Add add-ons prices (直接通过 booking.addons)
-        for booking_addon in b.addons:
-            if booking_addon.addon and booking_addon.id not in seen_addon_ids:
-                addon_price = float(booking_addon.addon.price) if booking_addon.addon.price is not None else 0.0
-                quantity = int(booking_addon.quantity) if booking_addon.quantity is not None else 0
-                booking_gross += addon_price * quantity
-                seen_addon_ids.add(booking_addon.id)
-        
-        # 折扣金额
-        discount = float(b.discount_amount) if b.discount_amount else 0.0
-        booking_expected = max(0.0, booking_gross - discount)
-        
-        # Fallback for legacy bookings without BookingPackages
-        if not has_packages:
-            booking_gross = float(b.amount_paid) if b.amount_paid is not None else 0.0
-            booking_expected = booking_gross  # Legacy bookings don't have discount tracking
-            discount = 0.0
-        
-        total_gross += booking_gross
-        total_discount += discount
-        total_expected += booking_expected 
+    trip_stats = get_trip_financial_summaries([trip.id])[trip.id]
+    total_paid = trip_stats['amount_paid']
+    total_gross = trip_stats['amount_gross']  # 原价总额（未扣除折扣）
+    total_discount = trip_stats['amount_discount']  # 折扣总额
+    total_expected = trip_stats['amount_expected']  # 净应收金额（扣除折扣后）
 
     total_pending = total_expected - total_paid
 
+    # 批量获取所有预订的套餐/附加项明细（定价模块，附加项已去重）
+    booking_pricing = price_bookings([b.id for b in bookings])
+    participants_by_booking = {}
+    if bookings:
+        for participant in BookingParticipant.query.filter(
+            BookingParticipant.booking_id.in_([b.id for b in bookings])
+        ).order_by(BookingParticipant.id).all():
+            participants_by_booking.setdefault(participant.booking_id, []).append(participant)
+
     # Calculate add-ons summary for each booking
     booking_addons_summary = {}
     for booking in bookings:
         addons_map = {}
-        # 方法1：通过 participant.addons 获取（关联到特定参与者的 addon）
-        for participant in booking.participants:
-            for booking_addon in participant.addons:
-                if booking_addon.addon:  # 确保 addon 存在
-                    addon_name = booking_addon.addon.name
-                    if addon_name in addons_map:
-                        addons_map[addon_name] += booking_addon.quantity
-                    else:
-                        addons_map[addon_name] = booking_addon.quantity
-        
-        # 方法2：通过 booking.addons 获取（没有关联到特定参与者的 addon，或 participant_id 为 null）
-        for booking_addon in booking.addons:
-            if booking_addon.addon and (booking_addon.participant_id is None or booking_addon.participant_id not in [p.id for p in booking.participants]):
-                addon_name = booking_addon.addon.name
-                if addon_name in addons_map:
-                    addons_map[addon_name] += booking_addon.quantity
-                else:
-                    addons_map[addon_name] = booking_addon.quantity
-        
+        for addon_item in booking_pricing[booking.id]['addons']:
+            addon_name = addon_item['name']
+            addons_map[addon_name] = addons_map.get(addon_name, 0) + addon_item['quantity']
         booking_addons_summary[booking.id] = addons_map
     
     # Collect all participants with their booking and package info
     all_participants = []
     total_participants_count = 0
     for booking in bookings:
+        pricing = booking_pricing[booking.id]
+        
         # Get package names for this booking (包含付款计划类型)
         package_names = []
-        for bp in booking.booking_packages:
-            if bp.package:
-                pkg_display = bp.package.name
-                if bp.payment_plan_type == 'deposit_installment':
-                    pkg_display += ' (Installment)'
-                else:
-                    pkg_display += ' (Full)'
-                package_names.append(pkg_display)
-        
-        for participant in booking.participants:
-            # Get add-ons for this participant (从两个来源获取，避免重复)
-            participant_addons = []
-            seen_addon_ids = set()
-            
-            # 方法1：通过 participant.addons 获取
-            for booking_addon in participant.addons:
-                if booking_addon.addon and booking_addon.id not in seen_addon_ids:
-                    participant_addons.append({
-                        'name': booking_addon.addon.name,
-                        'quantity': booking_addon.quantity,
-                        'price': float(booking_addon.addon.price) if booking_addon.addon.price else 0.0
-                    })
-                    seen_addon_ids.add(booking_addon.id)
-            
-            # 方法2：通过 booking.addons 获取（如果 participant_id 为空或匹配当前参与者）
-            for booking_addon in booking.addons:
-                if booking_addon.addon and booking_addon.id not in seen_addon_ids:
-                    # 只添加没有关联到参与者的 addon，或者关联到当前参与者的 addon
-                    if booking_addon.participant_id is None or booking_addon.participant_id == participant.id:
-                        participant_addons.append({
-                            'name': booking_addon.addon.name,
-                            'quantity': booking_addon.quantity,
-                            'price': float(booking_addon.addon.price) if booking_addon.addon.price else 0.0
-                        })
-                        seen_addon_ids.add(booking_addon.id)
+        for package_item in pricing['packages']:
+            pkg_display = package_item['name']
+            if package_item['booking_package'].payment_plan_type == 'deposit_installment':
+                pkg_display += ' (Installment)'
+            else:
+                pkg_display += ' (Full)'
+            package_names.append(pkg_display)
+        
+        for participant in participants_by_booking.get(booking.id, []):
+            # 该参与者的 add-ons：关联到当前参与者的，以及没有关联参与者的（整单 add-on）
+            participant_addons = [
+                {
+                    'name': addon_item['name'],
+                    'quantity': addon_item['quantity'],
+                    'price': addon_item['price']
+                }
+                for addon_item in pricing['addons']
+                if addon_item['participant_id'] is None or addon_item['participant_id'] == participant.id
+            ]
             
             # Parse name into first_name and last_name
             name_parts = (participant.name or '').strip().split(None, 1)  # Split on whitespace, max 1 split
@@ -489,6 +403,8 @@ def new_trip():
     # Create a draft trip immediately
     trip = Trip(status='draft', title='Untitled Trip')
     db.session.add(trip)
+    BuyerInfoField.build_defaults(trip)
+    invalidate_trip_counts()
     db.session.commit()
     # Redirect to builder step 1
     return redirect(url_for('admin.trip_builder', id=trip.id, step='basics'))
@@ -506,6 +422,10 @@ def trip_builder(id, step):
     # Get trip counts for sidebar navigation
     trip_counts = get_trip_counts()
     
+    # 任何步骤保存都刷新版本戳，公开报名页快照随本次提交失效（未提交则不生效）
+    if request.method == 'POST':
+        invalidate_trip_page(trip)
+    
     if step == 'basics':
         form = TripBasicsForm(obj=trip)
         if form.validate_on_submit():
@@ -526,9 +446,9 @@ def trip_builder(id, step):
             trip.min_capacity = form.min_capacity.data
             trip.color = form.color.data
             
+            # Inputs for completion changed: recompute and publish if complete
+            update_trip_completion(trip)
             db.session.commit()
-            # Check if trip is complete and update status
-            check_trip_completion(trip)
             return redirect(url_for('admin.trip_builder', id=trip.id, step='description'))
         return render_template('admin/trips/builder/step_basics.html', title='Trip Basics', trip=trip, form=form, current_step='basics', min_date=date.today().isoformat(), trip_counts=trip_counts)
     
@@ -550,9 +470,9 @@ def trip_builder(id, step):
                 flash("Invalid JSON data for includes/excludes", "error")
                 return render_template('admin/trips/builder/step_description.html', title='Trip Description', trip=trip, form=form, current_step='description', trip_counts=trip_counts)
             
+            # Inputs for completion changed: recompute and publish if complete
+            update_trip_completion(trip)
             db.session.commit()
-            # Check if trip is complete and update status
-            check_trip_completion(trip)
             return redirect(url_for('admin.trip_builder', id=trip.id, step='packages'))
         
         return render_template('admin/trips/builder/step_description.html', title='Trip Description', trip=trip, form=form, current_step='description', trip_counts=trip_counts)
@@ -632,9 +552,13 @@ def trip_builder(id, step):
                     if pid not in processed_ids:
                         db.session.delete(pkg)
                 
+                # Inputs for completion changed: recompute and publish if complete
+                update_trip_completion(trip)
+                # 套餐容量可能变化，同步库存计数
+                recount_trip_inventory(trip.id)
+                # 套餐价格变化 / 删除会影响预期收入和余额
+                refresh_trip_financial_summary(trip.id)
                 db.session.commit()
-                # Check if trip is complete and update status
-                check_trip_completion(trip)
                 return redirect(url_for('admin.trip_builder', id=trip.id, step='addons'))
 
             except ValueError as e:
@@ -692,9 +616,9 @@ def trip_builder(id, step):
                     if aid not in processed_ids:
                         db.session.delete(addon)
                 
+                # 附加项价格变化 / 删除会影响预期收入和余额
+                refresh_trip_financial_summary(trip.id)
                 db.session.commit()
-                # Check if trip is complete and update status
-                check_trip_completion(trip)
                 return redirect(url_for('admin.trip_builder', id=trip.id, step='buyer_info'))
 
             except ValueError as e:
@@ -705,31 +629,11 @@ def trip_builder(id, step):
 
     elif step == 'buyer_info':
         from app.admin.forms import TripBuyerInfoForm
-        from app.models import BuyerInfoField
         form = TripBuyerInfoForm()
         if request.method == 'GET':
+            # 默认必填字段在创建/复制行程时写入；全部删掉表示该行程不收集购买者信息
             fields = trip.buyer_info_fields.order_by('display_order').all()
             
-            # 如果没有配置任何字段，自动创建默认必填字段
-            if not fields:
-                default_fields = [
-                    {'field_name': 'First Name', 'field_type': 'text', 'is_required': True, 'display_order': 0},
-                    {'field_name': 'Last Name', 'field_type': 'text', 'is_required': True, 'display_order': 1},
-                    {'field_name': 'Email', 'field_type': 'email', 'is_required': True, 'display_order': 2},
-                    {'field_name': 'Phone', 'field_type': 'phone', 'is_required': True, 'display_order': 3}
-                ]
-                for df in default_fields:
-                    new_field = BuyerInfoField(
-                        trip_id=trip.id,
-                        field_name=df['field_name'],
-                        field_type=df['field_type'],
-                        is_required=df['is_required'],
-                        display_order=df['display_order']
-                    )
-                    db.session.add(new_field)
-                db.session.commit()
-                fields = trip.buyer_info_fields.order_by('display_order').all()
-            
             f_list = []
             for f in fields:
                 f_list.append({
@@ -785,8 +689,6 @@ def trip_builder(id, step):
                         db.session.delete(f)
                 
                 db.session.commit()
-                # Check if trip is complete and update status
-                check_trip_completion(trip)
                 return redirect(url_for('admin.trip_builder', id=trip.id, step='participants'))
 
             except ValueError as e:
@@ -858,8 +760,6 @@ def trip_builder(id, step):
                         db.session.delete(q)
                 
                 db.session.commit()
-                # Check if trip is complete and update status
-                check_trip_completion(trip)
                 return redirect(url_for('admin.trip_builder', id=trip.id, step='coupons'))
 
             except ValueError as e:
@@ -878,7 +778,10 @@ def trip_builder(id, step):
                     'id': c.id,
                     'code': c.code,
                     'type': c.type,
-                    'amount': c.amount
+                    'amount': c.amount,
+                    'max_uses': c.max_uses,
+                    'used_count': c.used_count or 0,
+                    'expires_at': c.expires_at.strftime('%Y-%m-%dT%H:%M') if c.expires_at else None
                 })
             form.coupons_json.data = json.dumps(c_list)
         
@@ -890,21 +793,28 @@ def trip_builder(id, step):
 
                 for c_item in c_data_list:
                     c_id = c_item.get('id')
+                    # 使用上限 / 过期时间可选；为空表示不限
+                    max_uses = int(c_item['max_uses']) if c_item.get('max_uses') not in (None, '') else None
+                    expires_at = datetime.fromisoformat(c_item['expires_at']) if c_item.get('expires_at') else None
                     
                     if c_id and c_id in current_codes:
-                        # Update
+                        # Update（code 由模型统一规范化为去空格大写）
                         code = current_codes[c_id]
-                        code.code = c_item.get('code').upper()
+                        code.code = c_item.get('code')
                         code.type = c_item.get('type')
                         code.amount = float(c_item.get('amount'))
+                        code.max_uses = max_uses
+                        code.expires_at = expires_at
                         processed_ids.append(c_id)
                     else:
                         # Create
                         new_code = DiscountCode(
                             trip_id=trip.id,
-                            code=c_item.get('code').upper(),
+                            code=c_item.get('code'),
                             type=c_item.get('type'),
-                            amount=float(c_item.get('amount'))
+                            amount=float(c_item.get('amount')),
+                            max_uses=max_uses,
+                            expires_at=expires_at
                         )
                         db.session.add(new_code)
                 
@@ -914,11 +824,8 @@ def trip_builder(id, step):
                         db.session.delete(code)
                 
                 db.session.commit()
-                # Check if trip is complete and update status
-                check_trip_completion(trip)
-                
-                # Refresh trip from database to get updated status
-                db.session.refresh(trip)
+                # 本进程的折扣码缓存立即失效（其他 worker 按 DISCOUNT_CODE_CACHE_TTL 过期）
+                invalidate_discount_codes()
                 
                 flash('Trip configuration saved successfully!', 'success')
                 
@@ -958,7 +865,9 @@ def trip_builder(id, step):
 def delete_trip(id):
     trip = Trip.query.get_or_404(id)
     db.session.delete(trip)
+    invalidate_trip_counts()
     db.session.commit()
+    clear_report_trip_lists()
     flash('行程已删除')
     return redirect(url_for('admin.trips'))
 
@@ -986,6 +895,8 @@ def copy_trip(id):
         color=trip.color
     )
     db.session.add(new_trip)
+    BuyerInfoField.build_defaults(new_trip)
+    invalidate_trip_counts()
     db.session.commit()
     flash('Travel copied successfully')
     return redirect(url_for('admin.trips'))
@@ -996,7 +907,9 @@ def copy_trip(id):
 def deactivate_trip(id):
     trip = Trip.query.get_or_404(id)
     trip.status = 'deactivated'
+    invalidate_trip_counts()
     db.session.commit()
+    clear_report_trip_lists()
     flash('Trip deactivated')
     return redirect(url_for('admin.trips', filter='deactivated'))
 
@@ -1006,7 +919,9 @@ def deactivate_trip(id):
 def reactivate_trip(id):
     trip = Trip.query.get_or_404(id)
     trip.status = 'published'
+    invalidate_trip_counts()
     db.session.commit()
+    clear_report_trip_lists()
     
     today = date.today()
     target_filter = 'past' if trip.end_date and trip.end_date < today else 'upcoming'
@@ -1020,7 +935,9 @@ def reactivate_trip(id):
 def archive_trip(id):
     trip = Trip.query.get_or_404(id)
     trip.status = 'archived'
+    invalidate_trip_counts()
     db.session.commit()
+    clear_report_trip_lists()
     flash('Trip archived')
     return redirect(url_for('admin.trips', filter='archived'))
 
@@ -1082,70 +999,99 @@ def delete_city(id):
 @bp.route('/customers')
 @login_required
 def customers():
-    clients = Client.query.order_by(Client.created_at.desc()).all()
-    
-    # Calculate client stats (trips and collected amount)
-    client_stats = {}
-    for client in clients:
-        bookings = client.bookings.all() if client.bookings else []
-        
-        # Calculate total collected amount
-        total_collected = sum(b.amount_paid or 0.0 for b in bookings)
-        
-        # Get unique trip names
-        trip_names = []
-        seen_trip_ids = set()
-        for booking in bookings:
-            if booking.trip and booking.trip.id not in seen_trip_ids:
-                trip_names.append(booking.trip.title)
-                seen_trip_ids.add(booking.trip.id)
-        
-        client_stats[client.id] = {
-            'trips': trip_names,
-            'collected_amount': total_collected
-        }
-    
-    # Using the new template
+    sort = request.args.get('sort', 'created')
+    direction = request.args.get('direction', 'desc')
+    limit = request.args.get('limit', DEFAULT_PAGE_SIZE, type=int)
+
+    page = get_customers_page(sort=sort, direction=direction, limit=limit)
+
     return render_template('admin/customers/customers.html', 
                          title='Customers', 
-                         clients=clients,
-                         client_stats=client_stats)
+                         customers=page['customers'],
+                         next_cursor=page['next_cursor'],
+                         sort=page['sort'],
+                         direction=page['direction'],
+                         limit=limit)
+
+
+@bp.route('/customers/api')
+@login_required
+def customers_api():
+    """客户列表分页 JSON（表格滚动加载）"""
+    page = get_customers_page(
+        sort=request.args.get('sort', 'created'),
+        direction=request.args.get('direction', 'desc'),
+        cursor=request.args.get('cursor'),
+        limit=request.args.get('limit', DEFAULT_PAGE_SIZE, type=int)
+    )
+
+    customers_data = []
+    for item in page['customers']:
+        client = item['client']
+        customers_data.append({
+            'id': client.id,
+            'name': client.name,
+            'email': client.email,
+            'trips': item['trips'],
+            'collected_amount': item['collected_amount'],
+            'last_booking_at': item['last_booking_at'].isoformat() if item['last_booking_at'] else None,
+            'created_at': client.created_at.strftime('%Y/%m/%d') if client.created_at else None
+        })
+
+    return jsonify({
+        'success': True,
+        'customers': customers_data,
+        'next_cursor': page['next_cursor'],
+        'sort': page['sort'],
+        'direction': page['direction']
+    })
 
 
 @bp.route('/customers/leads')
 @login_required
 def leads():
-    leads = Lead.query.order_by(Lead.created_at.desc()).all()
-    
-    # 解析 interest 字段为列表格式
-    for lead in leads:
-        if lead.interest:
-            try:
-                # 尝试解析为 JSON
-                interest_data = json.loads(lead.interest)
-                if isinstance(interest_data, list):
-                    lead.interest_list = interest_data
-                else:
-                    lead.interest_list = [interest_data]
-            except (json.JSONDecodeError, TypeError):
-                # 如果不是 JSON，尝试按逗号分割
-                if ',' in lead.interest:
-                    lead.interest_list = [item.strip() for item in lead.interest.split(',')]
-                else:
-                    lead.interest_list = [lead.interest.strip()]
-        else:
-            lead.interest_list = []
-    
-    # 计算统计数据
-    stats = {
-        'total': len(leads),
-        'new': len([l for l in leads if l.status == 'new' or not l.status]),
-        'replied': len([l for l in leads if l.status == 'replied']),
-        'converted': len([l for l in leads if l.status == 'converted']),
-        'archived': len([l for l in leads if l.status == 'archived'])
+    status = request.args.get('status', 'all')
+    if status != 'all' and status not in Lead.STATUSES:
+        status = 'all'
+    search = request.args.get('q', '').strip()
+    cursor = request.args.get('cursor')
+    limit = request.args.get('limit', DEFAULT_PAGE_SIZE, type=int)
+
+    def _parse_date(value):
+        try:
+            return datetime.strptime(value, '%Y-%m-%d').date() if value else None
+        except ValueError:
+            return None
+
+    date_from = _parse_date(request.args.get('date_from'))
+    date_to = _parse_date(request.args.get('date_to'))
+
+    page = get_leads_page(
+        status=status,
+        date_from=date_from,
+        date_to=date_to,
+        search=search or None,
+        cursor=cursor,
+        limit=limit
+    )
+
+    # 统计数据（一次 GROUP BY status）
+    stats = get_lead_stats()
+
+    filters = {
+        'status': status,
+        'q': search,
+        'date_from': date_from.isoformat() if date_from else '',
+        'date_to': date_to.isoformat() if date_to else '',
+        'limit': limit
     }
-    
-    return render_template('admin/customers/leads.html', title='Leads', leads=leads, stats=stats)
+
+    return render_template('admin/customers/leads.html', title='Leads',
+                         leads=page['leads'],
+                         next_cursor=page['next_cursor'],
+                         is_first_page=not cursor,
+                         filters=filters,
+                         stats=stats)
 
 
 @bp.route('/customers/leads/<int:id>/update-status', methods=['POST'])
@@ -1196,13 +1142,13 @@ def clients():
 def new_client():
     form = ClientForm()
     if form.validate_on_submit():
-        client = Client(
+        # 邮箱已存在时更新该客户，不再新建重复客户
+        upsert_client(
+            form.email.data,
             name=form.name.data,
-            email=form.email.data,
             phone=form.phone.data,
             notes=form.notes.data
         )
-        db.session.add(client)
         db.session.commit()
         flash('客户已创建')
         return redirect(url_for('admin.clients'))
@@ -1219,7 +1165,13 @@ def edit_client(id):
         client.email = form.email.data
         client.phone = form.phone.data
         client.notes = form.notes.data
-        db.session.commit()
+        try:
+            db.session.commit()
+        except IntegrityError:
+            # 规范化邮箱唯一：不能改成其他客户的邮箱
+            db.session.rollback()
+            flash('该邮箱已属于其他客户', 'error')
+            return render_template('admin/clients/form.html', title='编辑客户', form=form)
         flash('客户已更新')
         return redirect(url_for('admin.clients'))
     return render_template('admin/clients/form.html', title='编辑客户', form=form)
@@ -1229,6 +1181,7 @@ def edit_client(id):
 @login_required
 def delete_client(id):
     client = Client.query.get_or_404(id)
+    affected_trip_ids = {booking.trip_id for booking in client.bookings}
     
     # Check if client has bookings
     bookings_count = client.bookings.count()
@@ -1250,6 +1203,10 @@ def delete_client(id):
     
     # Delete client
     db.session.delete(client)
+    db.session.flush()
+    for trip_id in affected_trip_ids:
+        refresh_trip_financial_summary(trip_id)
+        recount_trip_inventory(trip_id)
     db.session.commit()
     flash('客户已删除')
     return redirect(url_for('admin.customers'))
@@ -1260,6 +1217,7 @@ def delete_client(id):
 def delete_customer(id):
     """删除客户（Customers 页面使用）"""
     client = Client.query.get_or_404(id)
+    affected_trip_ids = {booking.trip_id for booking in client.bookings}
     
     try:
         # Check if client has bookings
@@ -1282,6 +1240,10 @@ def delete_customer(id):
         
         # Delete client
         db.session.delete(client)
+        db.session.flush()
+        for trip_id in affected_trip_ids:
+            refresh_trip_financial_summary(trip_id)
+            recount_trip_inventory(trip_id)
         db.session.commit()
         
         return jsonify({'success': True, 'message': 'Customer deleted successfully'})
@@ -1731,22 +1693,21 @@ def reports():
     today = date.today()
     search = request.args.get('search', '').strip()
 
-    trips_query = Trip.query.filter(Trip.status != 'draft')
-    if search:
-        trips_query = trips_query.filter(Trip.title.ilike(f'%{search}%'))
-
-    all_trips = trips_query.all()
+    # 分类列表与行程汇总均走 Reports 缓存（支付/退款/预订事件按行程失效）
+    trip_lists, lists_built_at = get_report_trip_lists(search, today)
+    upcoming_trips = trip_lists['upcoming']
+    past_trips = trip_lists['past']
+    deactivated_trips = trip_lists['deactivated']
 
-    upcoming_trips = [t for t in all_trips if t.status == 'published' and t.end_date and t.end_date >= today]
-    past_trips = [t for t in all_trips if t.status == 'published' and t.end_date and t.end_date < today]
-    deactivated_trips = [t for t in all_trips if t.status == 'deactivated']
+    trips_stats, stats_cached_at = get_cached_trip_summaries(
+        [t['id'] for t in upcoming_trips + past_trips + deactivated_trips]
+    )
 
     def get_trip_summary(trip):
-        stats = calculate_trip_stats(trip)
-        bookings = trip.bookings.all() if trip.bookings else []
+        stats = trips_stats[trip['id']]
         return {
             'trip': trip,
-            'booking_count': len(bookings),
+            'booking_count': stats['booking_count'],
             'participants_count': stats['participants_count'],
             'amount_gross': stats['amount_gross'],
             'amount_discount': stats['amount_discount'],
@@ -1756,11 +1717,11 @@ def reports():
         }
 
     upcoming_summaries = sorted([get_trip_summary(t) for t in upcoming_trips],
-                                key=lambda x: x['trip'].start_date or date.min, reverse=True)
+                                key=lambda x: x['trip']['start_date'] or date.min, reverse=True)
     past_summaries = sorted([get_trip_summary(t) for t in past_trips],
-                            key=lambda x: x['trip'].end_date or date.min, reverse=True)
+                            key=lambda x: x['trip']['end_date'] or date.min, reverse=True)
     deactivated_summaries = sorted([get_trip_summary(t) for t in deactivated_trips],
-                                   key=lambda x: x['trip'].updated_at or datetime.min, reverse=True)
+                                   key=lambda x: x['trip']['updated_at'] or datetime.min, reverse=True)
 
     def calculate_category_total(summaries):
         return {
@@ -1774,12 +1735,19 @@ def reports():
             'total_pending': sum(s['amount_pending'] for s in summaries)
         }
 
+    # 缓存状态（页面展示：数据新鲜度与命中统计）
+    cached_times = [t for t in (lists_built_at, stats_cached_at) if t is not None]
+    cache_info = {
+        'age_seconds': int(time.time() - min(cached_times)) if cached_times else 0,
+        'stats': reports_cache_stats()
+    }
+
     upcoming_total = calculate_category_total(upcoming_summaries)
     past_total = calculate_category_total(past_summaries)
     deactivated_total = calculate_category_total(deactivated_summaries)
 
     grand_total = {
-        'total_trips': len(all_trips),
+        'total_trips': len(trip_lists['all']),
         'total_bookings': upcoming_total['total_bookings'] + past_total['total_bookings'] + deactivated_total['total_bookings'],
         'total_participants': upcoming_total['total_participants'] + past_total['total_participants'] + deactivated_total['total_participants'],
         'total_gross': upcoming_total['total_gross'] + past_total['total_gross'] + deactivated_total['total_gross'],
@@ -1799,10 +1767,124 @@ def reports():
         past_summaries=past_summaries,
         past_total=past_total,
         deactivated_summaries=deactivated_summaries,
-        deactivated_total=deactivated_total
+        deactivated_total=deactivated_total,
+        cache_info=cache_info
     )
 
 
+@bp.route('/reports/revenue')
+@login_required
+def revenue_report_api():
+    """
+    时间范围收入报表 API（读取 revenue_daily 汇总表）
+    
+    参数:
+    - start / end: YYYY-MM-DD（含首尾），默认最近 90 天
+    - granularity: day | week | month | quarter，默认 month
+    - trip_id: 可选，只统计单个行程
+    """
+    from app.revenue import GRANULARITIES, get_revenue_series, get_revenue_watermark
+    
+    granularity = request.args.get('granularity', 'month')
+    if granularity not in GRANULARITIES:
+        return jsonify({'success': False, 'message': f'Invalid granularity: {granularity}'}), 400
+    
+    try:
+        end_day = date.fromisoformat(request.args['end']) if request.args.get('end') else date.today()
+        start_day = date.fromisoformat(request.args['start']) if request.args.get('start') else end_day - timedelta(days=89)
+    except ValueError:
+        return jsonify({'success': False, 'message': 'Invalid date format, expected YYYY-MM-DD'}), 400
+    
+    if start_day > end_day:
+        return jsonify({'success': False, 'message': 'start must be before end'}), 400
+    
+    trip_id = request.args.get('trip_id', type=int)
+    series = get_revenue_series(start_day, end_day, granularity, trip_id=trip_id)
+    watermark = get_revenue_watermark()
+    
+    return jsonify({
+        'success': True,
+        'start': start_day.isoformat(),
+        'end': end_day.isoformat(),
+        'granularity': granularity,
+        'trip_id': trip_id,
+        'currency_unit': 'cents',
+        'buckets': series['buckets'],
+        'totals': series['totals'],
+        'data_as_of': watermark.isoformat() if watermark else None
+    })
+
+
+@bp.route('/payments/metrics')
+@login_required
+def payment_metrics_api():
+    """
+    支付相关的进程内指标（当前 worker）：卡片信息缓存命中率、合并的并发请求数、Stripe 调用耗时、熔断器状态
+    """
+    from app.payments import payment_method_cache_stats
+    from app.stripe_client import stripe_client_stats
+    
+    return jsonify({
+        'success': True,
+        'payment_method_lookup': payment_method_cache_stats(),
+        'stripe_client': stripe_client_stats()
+    })
+
+
+@bp.route('/payments/webhooks')
+@login_required
+def stripe_event_backlog():
+    """
+    Stripe Webhook 收件箱积压情况：各状态数量、最早待处理事件的延迟、重试中和死信事件
+    ?format=json 返回 JSON（用于监控）
+    """
+    from app.stripe_events import get_stripe_event_backlog
+    
+    backlog = get_stripe_event_backlog()
+    if request.args.get('format') == 'json':
+        def _event_dict(event):
+            return {
+                'id': event.id,
+                'event_id': event.event_id,
+                'event_type': event.event_type,
+                'object_id': event.object_id,
+                'attempts': event.attempts,
+                'next_attempt_at': event.next_attempt_at.isoformat() if event.next_attempt_at else None,
+                'received_at': event.received_at.isoformat() if event.received_at else None,
+                'last_error': event.last_error
+            }
+        return jsonify({
+            'success': True,
+            'counts': backlog['counts'],
+            'oldest_pending_at': backlog['oldest_pending_at'].isoformat() if backlog['oldest_pending_at'] else None,
+            'lag_seconds': backlog['lag_seconds'],
+            'failing': [_event_dict(e) for e in backlog['failing']],
+            'dead': [_event_dict(e) for e in backlog['dead']]
+        })
+    
+    return render_template('admin/payments/webhooks.html', title='Stripe Webhooks', backlog=backlog)
+
+
+@bp.route('/payments/webhooks/<int:event_pk>/retry', methods=['POST'])
+@login_required
+def retry_stripe_event(event_pk):
+    """把死信事件重新放回收件箱队列"""
+    from app.stripe_events import retry_dead_event, wake_stripe_event_worker
+    
+    try:
+        event = retry_dead_event(event_pk)
+        if event is None:
+            flash('Event not found or not dead-lettered.', 'error')
+            return redirect(url_for('admin.stripe_event_backlog'))
+        db.session.commit()
+        wake_stripe_event_worker(current_app._get_current_object())
+        flash(f'Event {event.event_id} queued for retry.', 'success')
+    except Exception as e:
+        db.session.rollback()
+        flash(f'Error retrying event: {str(e)}', 'error')
+    return redirect(url_for('admin.stripe_event_backlog'))
+
+
 @bp.route('/payments/api')
 @login_required
 def payments_api():
@@ -2014,6 +2096,8 @@ def mark_installment_paid(installment_id):
             for bp in booking.booking_packages:
                 bp.status = 'fully_paid'
         
+        # 同一事务内刷新行程财务汇总
+        refresh_trip_financial_summary(booking.trip_id)
         db.session.commit()
         
         return jsonify({
@@ -2440,42 +2524,19 @@ def add_participant(id):
             if not buyer_name:
                 buyer_name = email.split('@')[0]  # Fallback to email username
                 
-            client = Client.query.filter_by(email=email).first()
-            if not client:
-                client = Client(
-                    name=buyer_name,
-                    first_name=buyer_first_name,
-                    last_name=buyer_last_name,
-                    email=email,
-                    phone=buyer_info.get('phone'),
-                    address=buyer_info.get('address'),
-                    city=buyer_info.get('city'),
-                    state=buyer_info.get('state'),
-                    zip_code=buyer_info.get('zip_code'),
-                    country=buyer_info.get('country')
-                )
-                db.session.add(client)
-                db.session.flush()
-            else:
-                # Update existing client with new buyer info if provided
-                if buyer_first_name:
-                    client.first_name = buyer_first_name
-                if buyer_last_name:
-                    client.last_name = buyer_last_name
-                if buyer_name:
-                    client.name = buyer_name
-                if buyer_info.get('phone'):
-                    client.phone = buyer_info.get('phone')
-                if buyer_info.get('address'):
-                    client.address = buyer_info.get('address')
-                if buyer_info.get('city'):
-                    client.city = buyer_info.get('city')
-                if buyer_info.get('state'):
-                    client.state = buyer_info.get('state')
-                if buyer_info.get('zip_code'):
-                    client.zip_code = buyer_info.get('zip_code')
-                if buyer_info.get('country'):
-                    client.country = buyer_info.get('country')
+            # 按规范化邮箱查找或创建客户（已有客户用非空的新资料更新）
+            client = upsert_client(
+                email,
+                name=buyer_name,
+                first_name=buyer_first_name,
+                last_name=buyer_last_name,
+                phone=buyer_info.get('phone'),
+                address=buyer_info.get('address'),
+                city=buyer_info.get('city'),
+                state=buyer_info.get('state'),
+                zip_code=buyer_info.get('zip_code'),
+                country=buyer_info.get('country')
+            )
             
             # 2. Create Booking
             packages_data = data.get('packages', [])  # New format: list of {package_id, quantity, payment_plan_type}
@@ -2592,6 +2653,9 @@ def add_participant(id):
                         )
                         db.session.add(ba)
             
+            # 同一事务内刷新行程财务汇总
+            refresh_trip_financial_summary(trip.id)
+            recount_trip_inventory(trip.id)
             db.session.commit()
             return jsonify({'success': True, 'message': 'Participants added successfully'})
             
@@ -2653,80 +2717,48 @@ def manage_booking(trip_id, booking_id):
                     'addons': participant_addons
                 })
             
-            # 获取所有附加项（包括直接关联到 booking 的，不通过 participant）
-            all_addons = []
-            addons_total = 0.0
-            seen_addon_ids = set()
-            
-            # 方法1：通过 participant.addons 获取
-            for p in booking.participants:
-                for ba in p.addons:
-                    if ba.addon and ba.id not in seen_addon_ids:
-                        addon_price = float(ba.addon.price) if ba.addon.price else 0.0
-                        quantity = int(ba.quantity) if ba.quantity else 1
-                        addons_total += addon_price * quantity
-                        all_addons.append({
-                            'id': ba.addon.id,
-                            'name': ba.addon.name,
-                            'price': addon_price,
-                            'quantity': quantity,
-                            'subtotal': addon_price * quantity,
-                            'participant_name': p.name if p else None
-                        })
-                        seen_addon_ids.add(ba.id)
+            # 获取所有附加项和套餐金额（定价模块，附加项按 BookingAddOn.id 去重）
+            pricing = price_booking(booking)
+            participant_names = {p.id: p.name for p in booking.participants}
             
-            # 方法2：通过 booking.addons 获取（直接关联的）
-            for ba in booking.addons:
-                if ba.addon and ba.id not in seen_addon_ids:
-                    addon_price = float(ba.addon.price) if ba.addon.price else 0.0
-                    quantity = int(ba.quantity) if ba.quantity else 1
-                    addons_total += addon_price * quantity
-                    participant = ba.participant
-                    all_addons.append({
-                        'id': ba.addon.id,
-                        'name': ba.addon.name,
-                        'price': addon_price,
-                        'quantity': quantity,
-                        'subtotal': addon_price * quantity,
-                        'participant_name': participant.name if participant else None
-                    })
-                    seen_addon_ids.add(ba.id)
+            all_addons = []
+            for addon_item in pricing['addons']:
+                ba = addon_item['booking_addon']
+                participant_name = participant_names.get(ba.participant_id)
+                if participant_name is None and ba.participant_id is not None and ba.participant:
+                    participant_name = ba.participant.name
+                all_addons.append({
+                    'id': addon_item['addon'].id,
+                    'name': addon_item['name'],
+                    'price': addon_item['price'],
+                    'quantity': addon_item['quantity'],
+                    'subtotal': addon_item['subtotal'],
+                    'participant_name': participant_name
+                })
+            addons_total = pricing['addons_total']
             
-            # 计算套餐金额
-            packages_total = 0.0
+            packages_total = pricing['packages_total']
             packages_data = []
-            has_packages = False
-            
-            for bp in booking.booking_packages:
-                if bp.package:
-                    package_price = float(bp.package.price) if bp.package.price is not None else 0.0
-                    quantity = int(bp.quantity) if bp.quantity is not None else 1
-                    subtotal = package_price * quantity
-                    packages_total += subtotal
-                    has_packages = True
-                    
-                    # 获取分期付款配置
-                    payment_plan_config = None
-                    if bp.payment_plan_type == 'deposit_installment' and bp.package.payment_plan_config:
-                        payment_plan_config = bp.package.payment_plan_config
-                    
-                    packages_data.append({
-                        'id': bp.package.id,
-                        'name': bp.package.name,
-                        'price': package_price,
-                        'quantity': quantity,
-                        'subtotal': subtotal,
-                        'payment_plan_type': bp.payment_plan_type,
-                        'payment_plan_config': payment_plan_config
-                    })
-            
-            # 计算应付金额（扣除折扣）
-            discount_amount = float(booking.discount_amount) if booking.discount_amount else 0.0
-            expected_amount = max(0.0, packages_total + addons_total - discount_amount)
+            for package_item in pricing['packages']:
+                bp = package_item['booking_package']
+                
+                # 获取分期付款配置
+                payment_plan_config = None
+                if bp.payment_plan_type == 'deposit_installment' and bp.package.payment_plan_config:
+                    payment_plan_config = bp.package.payment_plan_config
+                
+                packages_data.append({
+                    'id': bp.package.id,
+                    'name': package_item['name'],
+                    'price': package_item['price'],
+                    'quantity': package_item['quantity'],
+                    'subtotal': package_item['subtotal'],
+                    'payment_plan_type': bp.payment_plan_type,
+                    'payment_plan_config': payment_plan_config
+                })
             
-            # Fallback for legacy bookings
-            if not has_packages:
-                expected_amount = float(booking.amount_paid) if booking.amount_paid is not None else 0.0
+            # 计算应付金额（扣除折扣；没有套餐的旧预订以已付金额为准）
+            expected_amount = pricing['expected']
             
             # 获取支付历史
             payments = []
@@ -2854,6 +2886,8 @@ def manage_booking(trip_id, booking_id):
                     # Log error but don't fail the whole request
                     print(f"Error updating participants: {e}")
             
+            refresh_trip_financial_summary(booking.trip_id)
+            recount_trip_inventory(booking.trip_id)
             db.session.commit()
             return jsonify({'success': True, 'message': 'Booking updated successfully'})
         
@@ -2862,6 +2896,8 @@ def manage_booking(trip_id, booking_id):
             booking.status = form.status.data
             booking.amount_paid = form.amount_paid.data
             booking.special_requests = form.special_requests.data
+            refresh_trip_financial_summary(booking.trip_id)
+            recount_trip_inventory(booking.trip_id)
             db.session.commit()
             
             if request.is_json or request.headers.get('Content-Type') == 'application/json':
@@ -2891,45 +2927,24 @@ def generate_receipt(trip_id, booking_id):
         flash('Booking does not belong to this trip', 'error')
         return redirect(url_for('admin.manage_trip', id=trip_id))
     
-    # 计算应付金额
-    expected_amount = 0.0
-    has_packages = False
-    
-    # Calculate from BookingPackages
-    for bp in booking.booking_packages:
-        if bp.package:  # Check if package exists
-            package_price = float(bp.package.price) if bp.package.price is not None else 0.0
-            quantity = int(bp.quantity) if bp.quantity is not None else 1
-            expected_amount += package_price * quantity
-            has_packages = True
-    
-    # 添加附加项金额
-    for participant in booking.participants:
-        for booking_addon in participant.addons:
-            if booking_addon.addon:  # Check if addon exists
-                addon_price = float(booking_addon.addon.price) if booking_addon.addon.price is not None else 0.0
-                quantity = int(booking_addon.quantity) if booking_addon.quantity is not None else 0
-                expected_amount += addon_price * quantity
-    
-    # 扣除折扣金额
-    discount_amount = float(booking.discount_amount) if booking.discount_amount else 0.0
-    expected_amount = max(0.0, expected_amount - discount_amount)
-    
-    # Fallback for legacy bookings
-    if not has_packages:
-        expected_amount = float(booking.amount_paid) if booking.amount_paid is not None else 0.0
+    # 计算应付金额（定价模块：套餐 + 参与者/整单附加项 - 折扣）
+    pricing = price_booking(booking)
+    expected_amount = pricing['expected']
     
     # 收集参与者信息
     participants_info = []
+    participant_ids = set()
     for participant in booking.participants:
+        participant_ids.add(participant.id)
         addons_info = []
-        for booking_addon in participant.addons:
-            addons_info.append({
-                'name': booking_addon.addon.name,
-                'quantity': booking_addon.quantity,
-                'price': booking_addon.addon.price,
-                'total': booking_addon.addon.price * booking_addon.quantity
-            })
+        for addon_item in pricing['addons']:
+            if addon_item['participant_id'] == participant.id:
+                addons_info.append({
+                    'name': addon_item['name'],
+                    'quantity': addon_item['quantity'],
+                    'price': addon_item['price'],
+                    'total': addon_item['subtotal']
+                })
         participants_info.append({
             'name': participant.name,
             'email': participant.email,
@@ -2937,11 +2952,25 @@ def generate_receipt(trip_id, booking_id):
             'addons': addons_info
         })
     
+    # 整单附加项（未关联到本预订参与者的 add-on）
+    booking_addons_info = [
+        {
+            'name': addon_item['name'],
+            'quantity': addon_item['quantity'],
+            'price': addon_item['price'],
+            'total': addon_item['subtotal']
+        }
+        for addon_item in pricing['addons']
+        if addon_item['participant_id'] not in participant_ids
+    ]
+    
     return render_template('admin/trips/receipt.html',
                          trip=trip,
                          booking=booking,
+                         pricing=pricing,
                          expected_amount=expected_amount,
-                         participants_info=participants_info)
+                         participants_info=participants_info,
+                         booking_addons_info=booking_addons_info)
 
 
 @bp.route('/trips/<int:id>/financials')
@@ -2949,60 +2978,14 @@ def generate_receipt(trip_id, booking_id):
 def get_trip_financials(id):
     """获取行程的财务数据（用于 AJAX 更新）"""
     trip = Trip.query.get_or_404(id)
-    bookings = trip.bookings.all() if trip.bookings else []
-    
-    # Financial Calculations (same logic as manage_trip)
-    # amount_paid 是客户实际支付的基础金额（不含 Stripe 手续费）
-    total_paid = sum(b.amount_paid or 0.0 for b in bookings)
-    total_gross = 0.0
-    total_discount = 0.0
-    total_expected = 0.0
-    
-    for b in bookings:
-        booking_gross = 0.0
-        has_packages = False
-        seen_addon_ids = set()
-        
-        # Calculate expected amount from BookingPackages
-        for bp in b.booking_packages:
-            if bp.package:  # Check if package exists
-                package_price = float(bp.package.price) if bp.package.price is not None else 0.0
-                quantity = int(bp.quantity) if bp.quantity is not None else 1
-                booking_gross += package_price * quantity
-                has_packages = True
-        
-        # Add add-ons prices (通过 participant.addons)
-        for participant in b.participants:
-            for booking_addon in participant.addons:
-                if booking_addon.addon and booking_addon.id not in seen_addon_ids:
-                    addon_price = float(booking_addon.addon.price) if booking_addon.addon.price is not None else 0.0
-                    quantity = int(booking_addon.quantity) if booking_addon.quantity is not None else 0
-                    booking_gross += addon_price * quantity
-                    seen_addon_ids.add(booking_addon.id)
-        
-        # Add add-ons prices (直接通过 booking.addons)
-        for booking_addon in b.addons:
-            if booking_addon.addon and booking_addon.id not in seen_addon_ids:
-                addon_price = float(booking_addon.addon.price) if booking_addon.addon.price is not None else 0.0
-                quantity = int(booking_addon.quantity) if booking_addon.quantity is not None else 0
-                booking_gross += addon_price * quantity
-                seen_addon_ids.add(booking_addon.id)
-        
-        # 折扣金额
-        discount = float(b.discount_amount) if b.discount_amount else 0.0
-        booking_expected = max(0.0, booking_gross - discount)
-        
-        # Fallback for legacy bookings without BookingPackages
-        if not has_packages:
-            booking_gross = float(b.amount_paid) if b.amount_paid is not None else 0.0
-            booking_expected = booking_gross
-            discount = 0.0
-        
-        total_gross += booking_gross
-        total_discount += discount
-        total_expected += booking_expected
     
-    total_pending = total_expected - total_paid
+    # 读取行程财务汇总（与 manage_trip 同一数据源）
+    stats = get_trip_financial_summaries([trip.id])[trip.id]
+    total_gross = stats['amount_gross']
+    total_discount = stats['amount_discount']
+    total_expected = stats['amount_expected']
+    total_paid = stats['amount_paid']
+    total_pending = stats['amount_available']
     
     return jsonify({
         'success': True,
@@ -3073,6 +3056,9 @@ def refund_booking(trip_id, booking_id):
         # Create refund record (you may want to create a Refund model for this)
         # For now, we'll just update the booking
         
+        # 同一事务内刷新行程财务汇总
+        refresh_trip_financial_summary(trip.id)
+        recount_trip_inventory(trip.id)
         db.session.commit()
         
         return jsonify({
@@ -3132,6 +3118,9 @@ def delete_booking(trip_id, booking_id):
         # 6. 最后删除Booking本身
         db.session.delete(booking)
         
+        # 7. 同一事务内刷新行程财务汇总
+        refresh_trip_financial_summary(trip.id)
+        recount_trip_inventory(trip.id)
         db.session.commit()
         
         return jsonify({'success': True, 'message': 'Booking deleted successfully'})
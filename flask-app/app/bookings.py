@@ -0,0 +1,170 @@
+"""
+预订落库模块
+支付成功后把 PendingBooking 的报名数据写成 Booking 子表：
+先一次性校验并解析套餐 / 附加项（每张表一次 IN 查询），再每张子表一条批量 INSERT。
+数据库支持 INSERT ... RETURNING 时直接取回新行 ID，否则（MySQL）按 booking_id 回查。
+"""
+
+from sqlalchemy import insert
+from flask import current_app
+from app import db
+from app.models import TripPackage, TripAddOn, BookingPackage, BookingParticipant, BookingAddOn
+
+
+class BookingNotCreated(Exception):
+    """支付已成功但无法落成预订（抛出后整个事务回滚，收件箱按退避重试，最终进入死信）"""
+
+    def __init__(self, payment_intent_id, reason):
+        self.payment_intent_id = payment_intent_id
+        self.reason = reason
+        super().__init__(f'Booking not created for payment_intent {payment_intent_id}: {reason}')
+
+
+def _supports_bulk_returning():
+    """当前数据库能否在批量 INSERT 中按参数顺序返回 ID（PostgreSQL / SQLite 3.35+ / MariaDB 10.5+）"""
+    dialect = db.session.get_bind().dialect
+    return bool(getattr(dialect, 'insert_executemany_returning_sort_by_parameter_order', False))
+
+
+def bulk_insert(model, rows, id_filter=None):
+    """
+    一条语句批量插入同一张表的多行；不提交事务
+
+    Args:
+        model: 模型类
+        rows: 列值 dict 列表（Python 端默认值照常生效）
+        id_filter: 需要新行 ID 时传入；不支持 RETURNING 的数据库用它回查（条件必须只命中本次插入的行）
+
+    Returns:
+        list: id_filter 不为空时按 rows 顺序返回新行 ID，否则返回空列表
+    """
+    if not rows:
+        return []
+
+    if id_filter is None:
+        db.session.execute(insert(model), rows)
+        return []
+
+    if _supports_bulk_returning():
+        result = db.session.execute(insert(model).returning(model.id, sort_by_parameter_order=True), rows)
+        return list(result.scalars().all())
+
+    db.session.execute(insert(model), rows)
+    # 同一条多行 INSERT 的自增 ID 按行顺序递增，按 ID 排序即为插入顺序
+    return [row_id for (row_id,) in db.session.query(model.id).filter(id_filter).order_by(model.id).all()]
+
+
+def _to_int(value, default=None):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return default
+
+
+def plan_booking_children(trip_id, booking_data):
+    """
+    校验报名数据并解析出要写入的子表行（不写库）
+
+    套餐 / 附加项各一次查询；不存在或不属于该行程的条目跳过并记录日志。
+
+    Args:
+        trip_id: 行程 ID
+        booking_data: PendingBooking.booking_data
+
+    Returns:
+        dict: {
+            'packages': [BookingPackage 列值],
+            'participants': [BookingParticipant 列值],
+            'addons': [(BookingAddOn 列值, 是否需要关联第一个参与者)]
+        }
+    """
+    packages_data = booking_data.get('packages', []) or []
+    addons_data = booking_data.get('addons', []) or []
+    participants_data = booking_data.get('participants', []) or []
+
+    package_ids = {_to_int(p.get('package_id')) for p in packages_data} - {None}
+    addon_ids = {_to_int(a.get('addon_id')) for a in addons_data} - {None}
+
+    packages = {}
+    if package_ids:
+        packages = {package.id: package for package in TripPackage.query.filter(
+            TripPackage.id.in_(package_ids),
+            TripPackage.trip_id == trip_id
+        ).all()}
+    addons = {}
+    if addon_ids:
+        addons = {addon.id: addon for addon in TripAddOn.query.filter(
+            TripAddOn.id.in_(addon_ids),
+            TripAddOn.trip_id == trip_id
+        ).all()}
+
+    package_rows = []
+    for pkg_data in packages_data:
+        package = packages.get(_to_int(pkg_data.get('package_id')))
+        if package is None:
+            current_app.logger.warning(f"Skipping unknown package {pkg_data.get('package_id')} for trip {trip_id}")
+            continue
+        package_rows.append({
+            'package_id': package.id,
+            'quantity': pkg_data.get('quantity', 1),
+            'payment_plan_type': pkg_data.get('payment_plan_type', 'full'),
+            'status': 'pending',
+            'amount_paid': 0.0
+        })
+
+    participant_rows = [{
+        'name': f"{p.get('first_name', '')} {p.get('last_name', '')}".strip(),
+        'email': p.get('email'),
+        'phone': p.get('phone')
+    } for p in participants_data]
+
+    addon_rows = []
+    for addon_data in addons_data:
+        addon = addons.get(_to_int(addon_data.get('addon_id')))
+        if addon is None:
+            current_app.logger.warning(f"Skipping unknown add-on {addon_data.get('addon_id')} for trip {trip_id}")
+            continue
+        participant_id = addon_data.get('participant_id')
+        addon_rows.append(({
+            'addon_id': addon.id,
+            'participant_id': participant_id,
+            'quantity': addon_data.get('quantity', 1),
+            'price_at_booking': addon.price
+        }, participant_id is None))
+
+    return {'packages': package_rows, 'participants': participant_rows, 'addons': addon_rows}
+
+
+def materialize_booking_children(booking, plan):
+    """
+    按 plan_booking_children 的结果写入子表：每张表一条批量 INSERT；不提交事务
+
+    没有指定参与者的附加项关联到第一个参与者（全局 addon），只有这时才需要取回参与者 ID。
+
+    Returns:
+        dict: 各子表写入行数 {'packages', 'participants', 'addons'}
+    """
+    bulk_insert(BookingPackage, [dict(row, booking_id=booking.id) for row in plan['packages']])
+
+    participant_rows = [dict(row, booking_id=booking.id) for row in plan['participants']]
+    needs_first_participant = any(use_first for _row, use_first in plan['addons'])
+    participant_ids = bulk_insert(
+        BookingParticipant,
+        participant_rows,
+        id_filter=(BookingParticipant.booking_id == booking.id) if needs_first_participant else None
+    )
+    first_participant_id = participant_ids[0] if participant_ids else None
+
+    addon_rows = []
+    for row, use_first in plan['addons']:
+        row = dict(row, booking_id=booking.id)
+        if use_first:
+            row['participant_id'] = first_participant_id
+        addon_rows.append(row)
+    bulk_insert(BookingAddOn, addon_rows)
+
+    return {
+        'packages': len(plan['packages']),
+        'participants': len(participant_rows),
+        'addons': len(addon_rows)
+    }
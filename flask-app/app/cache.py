@@ -0,0 +1,130 @@
+"""
+进程内缓存工具
+每个 gunicorn worker 各自持有一份；跨进程一致性由调用方通过版本戳或短 TTL 保证
+"""
+
+import threading
+import time
+
+
+class TTLCache:
+    """
+    线程安全的 TTL 缓存（带命中/未命中计数）
+
+    Args:
+        ttl: 默认过期秒数；None 表示不过期（只能被显式失效）
+        maxsize: 最大条目数；超出时淘汰最早写入的条目
+    """
+
+    def __init__(self, ttl=None, maxsize=1024):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._data = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get_entry(self, key):
+        """
+        返回 (value, stored_at) 或 None；stored_at 为写入时的 time.time()
+        """
+        now = time.time()
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                value, stored_at, expires_at = entry
+                if expires_at is None or expires_at > now:
+                    self.hits += 1
+                    return value, stored_at
+                del self._data[key]
+            self.misses += 1
+            return None
+
+    def get(self, key, default=None):
+        entry = self.get_entry(key)
+        return entry[0] if entry is not None else default
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        now = time.time()
+        expires_at = now + ttl if ttl is not None else None
+        with self._lock:
+            if key not in self._data and self.maxsize and len(self._data) >= self.maxsize:
+                # dict 保持插入顺序，淘汰最早写入的条目
+                self._data.pop(next(iter(self._data)))
+            self._data[key] = (value, now, expires_at)
+
+    def pop(self, key):
+        with self._lock:
+            entry = self._data.pop(key, None)
+        return entry[0] if entry is not None else None
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': (self.hits / total) if total else 0.0,
+                'size': len(self._data)
+            }
+
+
+class _Call:
+    __slots__ = ('event', 'result', 'error')
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+    合并同一 key 的并发调用：第一个线程执行，其余线程等待并共享结果（或异常）
+
+    Args:
+        timeout: 跟随线程最多等待的秒数；超时后自己执行一次
+    """
+
+    def __init__(self, timeout=None):
+        self.timeout = timeout
+        self._calls = {}
+        self._lock = threading.Lock()
+        self.shared = 0
+
+    def do(self, key, fn):
+        """
+        Returns:
+            tuple: (fn 的返回值, 是否复用了其他线程的结果)
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = _Call()
+                self._calls[key] = call
+
+        if not leader:
+            if call.event.wait(self.timeout):
+                with self._lock:
+                    self.shared += 1
+                if call.error is not None:
+                    raise call.error
+                return call.result, True
+            return fn(), False
+
+        try:
+            call.result = fn()
+            return call.result, False
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+            call.event.set()
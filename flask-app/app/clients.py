@@ -0,0 +1,150 @@
+"""
+客户身份模块
+客户以规范化邮箱（clients.email_normalized，唯一）识别；所有按邮箱写客户的入口都用 upsert_client，
+一条 INSERT ... ON DUPLICATE KEY / ON CONFLICT 完成查找或创建，并发结账不会再产生重复客户。
+merge_duplicate_clients 用于合并唯一约束上线前已存在的重复客户。
+"""
+
+from datetime import datetime
+from sqlalchemy.exc import IntegrityError
+from app import db
+from app.models import Client, Booking, Payment
+
+
+# 合并时从重复客户补全到保留客户的资料字段（保留客户为空时才补）
+PROFILE_FIELDS = ('name', 'first_name', 'last_name', 'phone', 'address', 'city', 'state', 'zip_code', 'country', 'notes')
+
+
+def _upsert_client_id(dialect_name, insert_values, update_values):
+    """按数据库类型执行一条原子 upsert，返回客户 ID；不支持的数据库返回 None"""
+    table = Client.__table__
+
+    if dialect_name in ('mysql', 'mariadb'):
+        from sqlalchemy.dialects.mysql import insert as mysql_insert
+        stmt = mysql_insert(table).values(**insert_values)
+        # id = LAST_INSERT_ID(id)：已存在时让 lastrowid 返回已有行的 ID
+        stmt = stmt.on_duplicate_key_update(id=db.func.last_insert_id(table.c.id), **update_values)
+        return db.session.execute(stmt).lastrowid
+
+    if dialect_name in ('postgresql', 'sqlite'):
+        if dialect_name == 'postgresql':
+            from sqlalchemy.dialects.postgresql import insert as dialect_insert
+        else:
+            from sqlalchemy.dialects.sqlite import insert as dialect_insert
+        stmt = dialect_insert(table).values(**insert_values)
+        # 没有要更新的字段时做一次无变化的更新，保证 RETURNING 有结果
+        set_ = update_values or {'email_normalized': stmt.excluded.email_normalized}
+        stmt = stmt.on_conflict_do_update(index_elements=[table.c.email_normalized], set_=set_).returning(table.c.id)
+        return db.session.execute(stmt).scalar_one()
+
+    return None
+
+
+def upsert_client(email, update_existing=True, **fields):
+    """
+    按规范化邮箱查找或创建客户；不提交事务
+
+    Args:
+        email: 客户邮箱（原样保存在 email，规范化后写入 email_normalized）
+        update_existing: 客户已存在时是否用 fields 中的非空值更新资料
+        **fields: 其他 Client 列（name、first_name、phone 等）；新建时全部写入
+
+    Returns:
+        Client: 新建或已存在的客户
+    """
+    normalized = Client.normalize_email(email)
+    if not normalized:
+        raise ValueError('Client email is required')
+
+    insert_values = dict(fields)
+    insert_values.update(email=email.strip(), email_normalized=normalized, created_at=datetime.utcnow())
+    update_values = {}
+    if update_existing:
+        update_values = {key: value for key, value in fields.items() if value not in (None, '')}
+
+    client_id = _upsert_client_id(db.session.get_bind().dialect.name, insert_values, update_values)
+    if client_id is not None:
+        # 会话里可能已有该客户的旧状态，按数据库重新加载
+        return db.session.get(Client, client_id, populate_existing=True)
+
+    # 其他数据库：先查再插，唯一约束冲突说明并发请求刚创建了同一客户
+    client = Client.query.filter_by(email_normalized=normalized).first()
+    if client is None:
+        try:
+            with db.session.begin_nested():
+                client = Client(email=email.strip(), **fields)
+                db.session.add(client)
+            return client
+        except IntegrityError:
+            client = Client.query.filter_by(email_normalized=normalized).one()
+    for key, value in update_values.items():
+        setattr(client, key, value)
+    return client
+
+
+def _fold_clients(canonical, duplicate_ids):
+    """把重复客户的预订、支付改挂到保留客户，补全资料后删除重复客户"""
+    duplicates = Client.query.filter(Client.id.in_(duplicate_ids)).order_by(Client.id.desc()).all()
+    for field in PROFILE_FIELDS:
+        if getattr(canonical, field):
+            continue
+        # 最近创建的重复客户资料优先
+        for duplicate in duplicates:
+            value = getattr(duplicate, field)
+            if value:
+                setattr(canonical, field, value)
+                break
+
+    bookings = Booking.query.filter(Booking.client_id.in_(duplicate_ids)).update(
+        {'client_id': canonical.id}, synchronize_session=False
+    )
+    payments = Payment.query.filter(Payment.client_id.in_(duplicate_ids)).update(
+        {'client_id': canonical.id}, synchronize_session=False
+    )
+    # 批量删除，绕过 Client.payments 的级联删除（支付已改挂）
+    Client.query.filter(Client.id.in_(duplicate_ids)).delete(synchronize_session=False)
+    return bookings, payments
+
+
+def merge_duplicate_clients(dry_run=False):
+    """
+    合并规范化邮箱相同的客户（一次性任务，每组一个事务）
+
+    保留已有 email_normalized 的客户（迁移时每组最早的客户），没有时保留 ID 最小的。
+
+    Returns:
+        dict: {'groups', 'clients_removed', 'bookings_moved', 'payments_moved'}
+    """
+    rows = db.session.query(Client.id, Client.email, Client.email_normalized).filter(
+        Client.email.isnot(None)
+    ).order_by(Client.id).all()
+
+    groups = {}
+    for client_id, email, normalized in rows:
+        key = Client.normalize_email(email)
+        if key:
+            groups.setdefault(key, []).append((client_id, normalized))
+
+    result = {'groups': 0, 'clients_removed': 0, 'bookings_moved': 0, 'payments_moved': 0}
+    for key, members in groups.items():
+        canonical_id = next((client_id for client_id, normalized in members if normalized == key), members[0][0])
+        duplicate_ids = [client_id for client_id, _normalized in members if client_id != canonical_id]
+        if not duplicate_ids and members[0][1] == key:
+            continue
+
+        result['groups'] += 1
+        result['clients_removed'] += len(duplicate_ids)
+        if dry_run:
+            continue
+
+        canonical = db.session.get(Client, canonical_id)
+        if duplicate_ids:
+            bookings, payments = _fold_clients(canonical, duplicate_ids)
+            result['bookings_moved'] += bookings
+            result['payments_moved'] += payments
+        Client.query.filter_by(id=canonical_id).update(
+            {'email_normalized': key}, synchronize_session=False
+        )
+        db.session.commit()
+
+    return result
@@ -0,0 +1,171 @@
+"""
+客户列表模块
+用一条聚合查询生成客户列表（已收金额、最近预订时间），支持服务端排序和 keyset 分页
+"""
+
+import base64
+import json
+from datetime import datetime
+from sqlalchemy import and_, or_
+from app import db
+from app.models import Client, Booking, Trip
+
+
+# 排序字段：collected（已收金额）、last_booking（最近预订时间）、created（客户创建时间）
+CUSTOMER_SORTS = ('created', 'collected', 'last_booking')
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+
+# 没有预订的客户 last_booking 为 NULL，排序/游标比较时统一当作最早时间
+_NO_BOOKING = datetime(1970, 1, 1)
+
+
+def encode_cursor(sort_value, client_id):
+    """把 (排序值, 客户 ID) 编码成 URL 安全的游标字符串"""
+    if isinstance(sort_value, datetime):
+        sort_value = sort_value.isoformat()
+    elif sort_value is not None and not isinstance(sort_value, str):
+        # SUM 在 MySQL 上可能返回 Decimal
+        sort_value = float(sort_value)
+    payload = json.dumps([sort_value, client_id], separators=(',', ':'))
+    return base64.urlsafe_b64encode(payload.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor, sort):
+    """
+    解析游标；格式不对时返回 None（当作第一页）
+
+    Returns:
+        tuple: (sort_value, client_id) 或 None
+    """
+    if not cursor:
+        return None
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        sort_value, client_id = json.loads(base64.urlsafe_b64decode(padded.encode('ascii')).decode('utf-8'))
+        client_id = int(client_id)
+        if sort == 'collected':
+            sort_value = float(sort_value)
+        else:
+            sort_value = datetime.fromisoformat(sort_value)
+    except (ValueError, TypeError):
+        return None
+    return sort_value, client_id
+
+
+def _client_trip_titles(client_ids):
+    """一次查询取出每个客户预订过的行程名（去重，按行程 ID 排序）"""
+    titles = {client_id: [] for client_id in client_ids}
+    if not client_ids:
+        return titles
+
+    rows = db.session.query(
+        Booking.client_id,
+        Trip.id,
+        Trip.title
+    ).join(
+        Trip, Trip.id == Booking.trip_id
+    ).filter(
+        Booking.client_id.in_(client_ids)
+    ).distinct().order_by(Booking.client_id, Trip.id).all()
+
+    for client_id, _trip_id, title in rows:
+        titles[client_id].append(title)
+    return titles
+
+
+def get_customers_page(sort='created', direction='desc', cursor=None, limit=DEFAULT_PAGE_SIZE):
+    """
+    获取一页客户列表
+
+    bookings 先按 client_id 聚合成子查询，再与 clients 左连接；
+    排序值 + 客户 ID 组成 keyset，翻页不需要 OFFSET。
+
+    Args:
+        sort: 'created' | 'collected' | 'last_booking'
+        direction: 'asc' | 'desc'
+        cursor: 上一页返回的 next_cursor；None 表示第一页
+        limit: 每页条数（最大 MAX_PAGE_SIZE）
+
+    Returns:
+        dict: {
+            'customers': [{'client', 'trips', 'collected_amount', 'last_booking_at'}],
+            'next_cursor': 下一页游标，没有更多数据时为 None,
+            'sort', 'direction'
+        }
+    """
+    if sort not in CUSTOMER_SORTS:
+        sort = 'created'
+    if direction not in ('asc', 'desc'):
+        direction = 'desc'
+    limit = max(1, min(int(limit or DEFAULT_PAGE_SIZE), MAX_PAGE_SIZE))
+
+    totals = db.session.query(
+        Booking.client_id.label('client_id'),
+        db.func.sum(Booking.amount_paid).label('collected'),
+        db.func.max(Booking.created_at).label('last_booking')
+    ).filter(
+        Booking.client_id.isnot(None)
+    ).group_by(Booking.client_id).subquery()
+
+    collected = db.func.coalesce(totals.c.collected, 0.0)
+    last_booking = db.func.coalesce(totals.c.last_booking, _NO_BOOKING)
+    # 旧数据 created_at 可能为空
+    created = db.func.coalesce(Client.created_at, _NO_BOOKING)
+    sort_column = {
+        'created': created,
+        'collected': collected,
+        'last_booking': last_booking
+    }[sort]
+
+    query = db.session.query(
+        Client,
+        collected,
+        totals.c.last_booking,
+        sort_column
+    ).outerjoin(totals, totals.c.client_id == Client.id)
+
+    position = decode_cursor(cursor, sort)
+    if position is not None:
+        sort_value, client_id = position
+        if direction == 'desc':
+            query = query.filter(or_(
+                sort_column < sort_value,
+                and_(sort_column == sort_value, Client.id < client_id)
+            ))
+        else:
+            query = query.filter(or_(
+                sort_column > sort_value,
+                and_(sort_column == sort_value, Client.id > client_id)
+            ))
+
+    if direction == 'desc':
+        query = query.order_by(sort_column.desc(), Client.id.desc())
+    else:
+        query = query.order_by(sort_column.asc(), Client.id.asc())
+
+    # 多取一条判断是否还有下一页
+    rows = query.limit(limit + 1).all()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+
+    titles = _client_trip_titles([row[0].id for row in rows])
+    customers = [{
+        'client': client,
+        'trips': titles.get(client.id, []),
+        'collected_amount': float(collected_amount or 0.0),
+        'last_booking_at': last_booking_at
+    } for client, collected_amount, last_booking_at, _sort_value in rows]
+
+    next_cursor = None
+    if has_more and rows:
+        last_row = rows[-1]
+        next_cursor = encode_cursor(last_row[3], last_row[0].id)
+
+    return {
+        'customers': customers,
+        'next_cursor': next_cursor,
+        'sort': sort,
+        'direction': direction
+    }
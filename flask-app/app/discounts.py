@@ -0,0 +1,143 @@
+"""
+折扣码模块
+- 折扣码统一规范化（去空格 + 大写）后存储，查找直接走 discount_codes.code 的唯一索引
+- 进程内缓存折扣码快照（含不存在的码），后台优惠码步骤保存时清空；其他 worker 等 DISCOUNT_CODE_CACHE_TTL 过期
+- 使用次数只通过条件 UPDATE 修改：结账创建 PendingBooking 时占用一次（不超过 max_uses、未过期），
+  PendingBooking 取消或过期时归还
+"""
+
+from datetime import datetime
+from types import SimpleNamespace
+from flask import current_app
+from sqlalchemy import or_
+from app import db
+from app.cache import TTLCache
+from app.models import DiscountCode
+
+
+_code_cache = TTLCache(maxsize=4096)
+
+# 缓存中表示"折扣码不存在"
+_MISSING = object()
+
+
+class DiscountCodeUnavailable(Exception):
+    """折扣码已过期或已达到使用上限"""
+
+    def __init__(self, discount_code_id):
+        self.discount_code_id = discount_code_id
+        super().__init__(f'Discount code {discount_code_id} is no longer available')
+
+
+def _snapshot(code):
+    snapshot = SimpleNamespace(
+        id=code.id,
+        trip_id=code.trip_id,
+        code=code.code,
+        type=code.type,
+        amount=code.amount,
+        used_count=code.used_count or 0,
+        max_uses=code.max_uses,
+        expires_at=code.expires_at
+    )
+    # 折扣计算与模型共用一份实现
+    snapshot.calculate_discount = lambda order_amount: DiscountCode.calculate_discount(snapshot, order_amount)
+    return snapshot
+
+
+def get_discount_code(code):
+    """
+    按折扣码查找（先查进程内缓存）
+
+    Args:
+        code: 用户输入的折扣码（大小写、首尾空格不敏感）
+
+    Returns:
+        SimpleNamespace: 折扣码只读快照（id、trip_id、code、type、amount、used_count、max_uses、expires_at、
+        calculate_discount）；不存在时返回 None。used_count 可能略旧，占用以 redeem_discount_code 为准
+    """
+    normalized = DiscountCode.normalize_code(code)
+    if not normalized:
+        return None
+
+    cached = _code_cache.get(normalized)
+    if cached is not None:
+        return None if cached is _MISSING else cached
+
+    row = DiscountCode.query.filter(DiscountCode.code == normalized).first()
+    snapshot = _snapshot(row) if row else None
+    ttl = current_app.config.get('DISCOUNT_CODE_CACHE_TTL', 60)
+    _code_cache.set(normalized, snapshot if snapshot is not None else _MISSING, ttl=ttl)
+    return snapshot
+
+
+def discount_code_problem(discount_code, trip_id=None, now=None, check_usage=True):
+    """
+    检查折扣码能否用于该行程
+
+    Args:
+        check_usage: 是否检查使用次数（本单已占用该码时传 False）
+
+    Returns:
+        str: 不可用原因（给用户看的提示）；可用时返回 None
+    """
+    now = now or datetime.utcnow()
+    if discount_code.trip_id and trip_id and discount_code.trip_id != int(trip_id):
+        return 'This discount code is not valid for this trip'
+    if discount_code.expires_at and discount_code.expires_at <= now:
+        return 'This discount code has expired'
+    if check_usage and discount_code.max_uses is not None and (discount_code.used_count or 0) >= discount_code.max_uses:
+        return 'This discount code has reached its usage limit'
+    return None
+
+
+def redeem_discount_code(discount_code_id):
+    """
+    占用一次折扣码（原子条件 UPDATE：未过期且未达到 max_uses）；不提交事务
+
+    Returns:
+        bool: 是否占用成功
+    """
+    now = datetime.utcnow()
+    redeemed = DiscountCode.query.filter(
+        DiscountCode.id == discount_code_id,
+        or_(DiscountCode.max_uses.is_(None), db.func.coalesce(DiscountCode.used_count, 0) < DiscountCode.max_uses),
+        or_(DiscountCode.expires_at.is_(None), DiscountCode.expires_at > now)
+    ).update({
+        'used_count': db.func.coalesce(DiscountCode.used_count, 0) + 1
+    }, synchronize_session=False)
+    return redeemed == 1
+
+
+def release_discount_code(discount_code_id):
+    """归还一次占用（PendingBooking 取消 / 过期 / 换码）；不提交事务"""
+    if not discount_code_id:
+        return False
+    released = DiscountCode.query.filter(
+        DiscountCode.id == discount_code_id,
+        DiscountCode.used_count > 0
+    ).update({
+        'used_count': DiscountCode.used_count - 1
+    }, synchronize_session=False)
+    return released == 1
+
+
+def invalidate_discount_codes():
+    """清空本进程的折扣码缓存（后台优惠码步骤保存后调用）"""
+    _code_cache.clear()
+
+
+def release_pending_discount(pending_booking):
+    """
+    归还 PendingBooking 占用的折扣码（取消 / 过期时调用）；不提交事务
+
+    Returns:
+        bool: 是否归还了占用
+    """
+    booking_data = pending_booking.booking_data or {}
+    if not booking_data.get('discount_redeemed'):
+        return False
+    released = release_discount_code(booking_data.get('discount_code_id'))
+    # 重新赋值整个字典，确保 JSON 字段变更被检测到
+    pending_booking.booking_data = dict(booking_data, discount_redeemed=False)
+    return released
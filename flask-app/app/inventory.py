@@ -0,0 +1,441 @@
+"""
+套餐库存模块
+package_inventory 保存每个套餐的 sold / held 计数，只通过原子条件 UPDATE 修改：
+  - 写入 PendingBooking 时锁定名额（held += q，超出容量则失败）
+  - 支付成功时把锁定转为已售（held -= q, sold += q）
+  - 支付失败、PaymentIntent 取消或锁定过期时释放（held -= q）
+后台增删预订等低频操作用 recount_trip_inventory 按 booking_packages 重算
+已付款但名额已售完（锁定过期后被他人买走）时不拒绝，计入已售并在提交后通知管理员处理超卖
+"""
+
+from collections import OrderedDict
+from datetime import datetime
+from flask import current_app
+from sqlalchemy import and_, case, event, or_, update
+from sqlalchemy.exc import IntegrityError
+from app import db
+from app.cache import TTLCache
+from app.models import Booking, BookingPackage, TripPackage, PackageInventory, InventoryHold
+
+
+# 公开页面的剩余名额缓存（按 trip_id，TTL 很短；名额以原子 UPDATE 为准，缓存只影响展示）
+_availability_cache = TTLCache(maxsize=1024)
+
+
+class InventoryUnavailable(Exception):
+    """套餐剩余名额不足"""
+
+    def __init__(self, package_id, requested):
+        self.package_id = package_id
+        self.requested = requested
+        super().__init__(f'Package {package_id} does not have {requested} spots available')
+
+
+def _requested_quantities(packages_data):
+    """把报名数据中的套餐合并为 {package_id: quantity}（按 package_id 排序，固定加锁顺序避免死锁）"""
+    quantities = {}
+    for pkg_data in packages_data or []:
+        try:
+            package_id = int(pkg_data.get('package_id'))
+            quantity = int(pkg_data.get('quantity', 1) or 1)
+        except (TypeError, ValueError):
+            continue
+        if quantity > 0:
+            quantities[package_id] = quantities.get(package_id, 0) + quantity
+    return OrderedDict(sorted(quantities.items()))
+
+
+def _sold_quantities(package_ids):
+    """实时统计已售名额：未取消预订的 BookingPackage.quantity 之和"""
+    if not package_ids:
+        return {}
+    rows = db.session.query(
+        BookingPackage.package_id,
+        db.func.sum(db.func.coalesce(BookingPackage.quantity, 1))
+    ).join(
+        Booking, Booking.id == BookingPackage.booking_id
+    ).filter(
+        BookingPackage.package_id.in_(package_ids),
+        or_(Booking.status.is_(None), Booking.status != 'cancelled')
+    ).group_by(BookingPackage.package_id).all()
+    return {package_id: int(total or 0) for package_id, total in rows}
+
+
+def _held_quantities(package_ids):
+    """统计有效锁定名额"""
+    if not package_ids:
+        return {}
+    rows = db.session.query(
+        InventoryHold.package_id,
+        db.func.sum(InventoryHold.quantity)
+    ).filter(
+        InventoryHold.package_id.in_(package_ids),
+        InventoryHold.status == 'held'
+    ).group_by(InventoryHold.package_id).all()
+    return {package_id: int(total or 0) for package_id, total in rows}
+
+
+def ensure_inventory(package_ids):
+    """
+    为还没有库存行的套餐创建 package_inventory 行（按 booking_packages 初始化 sold）
+
+    并发创建同一行时依赖主键冲突（savepoint + IntegrityError）跳过
+    """
+    package_ids = sorted({pid for pid in package_ids if pid is not None})
+    if not package_ids:
+        return
+    existing = {
+        row[0] for row in db.session.query(PackageInventory.package_id)
+        .filter(PackageInventory.package_id.in_(package_ids)).all()
+    }
+    missing = [pid for pid in package_ids if pid not in existing]
+    if not missing:
+        return
+
+    packages = TripPackage.query.filter(TripPackage.id.in_(missing)).all()
+    sold = _sold_quantities(missing)
+    held = _held_quantities(missing)
+    for package in packages:
+        try:
+            with db.session.begin_nested():
+                db.session.add(PackageInventory(
+                    package_id=package.id,
+                    trip_id=package.trip_id,
+                    capacity=package.capacity or None,
+                    sold=sold.get(package.id, 0),
+                    held=held.get(package.id, 0)
+                ))
+        except IntegrityError:
+            # 其他请求已创建
+            pass
+
+
+def get_package_availability(package_ids):
+    """
+    读取套餐剩余名额（只读：读库存行，没有库存行的套餐才实时统计）
+
+    Returns:
+        dict: {package_id: 剩余名额；不限量为 None}
+    """
+    package_ids = list({pid for pid in package_ids if pid is not None})
+    if not package_ids:
+        return {}
+
+    availability = {}
+    for inventory in PackageInventory.query.filter(PackageInventory.package_id.in_(package_ids)).all():
+        availability[inventory.package_id] = inventory.available
+
+    missing = [pid for pid in package_ids if pid not in availability]
+    if missing:
+        sold = _sold_quantities(missing)
+        held = _held_quantities(missing)
+        for package_id, capacity in db.session.query(TripPackage.id, TripPackage.capacity).filter(TripPackage.id.in_(missing)).all():
+            if not capacity:
+                availability[package_id] = None
+            else:
+                availability[package_id] = max(capacity - sold.get(package_id, 0) - held.get(package_id, 0), 0)
+
+    return availability
+
+
+def get_trip_availability(trip_id):
+    """
+    读取行程下所有可售套餐的剩余名额（带 AVAILABILITY_CACHE_TTL 秒缓存）
+
+    套餐与库存行一次 LEFT JOIN 查出；没有库存行的套餐再用一次 GROUP BY 实时统计
+
+    Returns:
+        dict: {package_id: 剩余名额；不限量为 None}
+    """
+    cached = _availability_cache.get(trip_id)
+    if cached is not None:
+        return cached
+
+    rows = db.session.query(
+        TripPackage.id,
+        TripPackage.capacity,
+        PackageInventory.package_id,
+        PackageInventory.capacity,
+        PackageInventory.sold,
+        PackageInventory.held
+    ).outerjoin(
+        PackageInventory, PackageInventory.package_id == TripPackage.id
+    ).filter(
+        TripPackage.trip_id == trip_id,
+        TripPackage.status == 'available'
+    ).all()
+
+    availability = {}
+    missing = {}
+    for package_id, package_capacity, inventory_id, capacity, sold, held in rows:
+        if inventory_id is None:
+            missing[package_id] = package_capacity
+        elif capacity is None:
+            availability[package_id] = None
+        else:
+            availability[package_id] = max(capacity - (sold or 0) - (held or 0), 0)
+
+    if missing:
+        sold = _sold_quantities(list(missing.keys()))
+        held = _held_quantities(list(missing.keys()))
+        for package_id, capacity in missing.items():
+            if not capacity:
+                availability[package_id] = None
+            else:
+                availability[package_id] = max(capacity - sold.get(package_id, 0) - held.get(package_id, 0), 0)
+
+    _availability_cache.set(trip_id, availability, ttl=current_app.config.get('AVAILABILITY_CACHE_TTL', 5))
+    return availability
+
+
+def invalidate_trip_availability(trip_id):
+    """使行程剩余名额缓存失效（本进程）"""
+    _availability_cache.pop(trip_id)
+
+
+def find_unavailable_package(packages_data):
+    """
+    预检查报名数据中的套餐名额（不加锁，只用于在创建 PaymentIntent 之前快速失败）
+
+    Returns:
+        (package_id, requested) 或 None
+    """
+    requested = _requested_quantities(packages_data)
+    availability = get_package_availability(list(requested.keys()))
+    for package_id, quantity in requested.items():
+        available = availability.get(package_id)
+        if available is not None and quantity > available:
+            return package_id, quantity
+    return None
+
+
+def _increment(package_id, quantity, held_delta=0, sold_delta=0, check_capacity=True):
+    """
+    原子条件 UPDATE；check_capacity 时只在 sold + held + quantity <= capacity 时更新
+
+    Returns:
+        bool: 是否更新成功
+    """
+    conditions = [PackageInventory.package_id == package_id]
+    if check_capacity:
+        conditions.append(or_(
+            PackageInventory.capacity.is_(None),
+            PackageInventory.sold + PackageInventory.held + quantity <= PackageInventory.capacity
+        ))
+    values = {'updated_at': datetime.utcnow()}
+    if held_delta:
+        # 计数不能为负（重算与释放交错时兜底）
+        values['held'] = case(
+            (PackageInventory.held + held_delta < 0, 0),
+            else_=PackageInventory.held + held_delta
+        )
+    if sold_delta:
+        values['sold'] = PackageInventory.sold + sold_delta
+    result = db.session.execute(
+        update(PackageInventory).where(and_(*conditions)).values(**values),
+        execution_options={'synchronize_session': False}
+    )
+    return result.rowcount > 0
+
+
+def create_holds(pending_booking, packages_data):
+    """
+    为 PendingBooking 锁定名额（与 PendingBooking 同一事务提交，过期时间相同）
+
+    Raises:
+        InventoryUnavailable: 某个套餐名额不足；调用方回滚事务即可撤销已锁定的部分
+    """
+    requested = _requested_quantities(packages_data)
+    ensure_inventory(list(requested.keys()))
+
+    for package_id, quantity in requested.items():
+        if not _increment(package_id, quantity, held_delta=quantity):
+            raise InventoryUnavailable(package_id, quantity)
+        db.session.add(InventoryHold(
+            package_id=package_id,
+            pending_booking_id=pending_booking.id,
+            payment_intent_id=pending_booking.payment_intent_id,
+            quantity=quantity,
+            status='held',
+            expires_at=pending_booking.expires_at
+        ))
+
+
+def convert_holds(payment_intent_id, packages_data, allow_oversell=False):
+    """
+    支付成功：把锁定转为已售；没有有效锁定的套餐（锁定已过期释放、旧流程）按容量条件直接计入已售
+
+    在 savepoint 中执行。名额不足时：
+      - allow_oversell=False：回滚本函数的全部修改并抛出 InventoryUnavailable
+      - allow_oversell=True（钱已收到）：不按容量条件计入已售，记录超卖，事务提交后通知管理员
+
+    Returns:
+        list: 超卖的 (package_id, quantity)
+    """
+    requested = _requested_quantities(packages_data)
+    ensure_inventory(list(requested.keys()))
+    now = datetime.utcnow()
+    oversold = []
+
+    with db.session.begin_nested():
+        holds = InventoryHold.query.filter_by(
+            payment_intent_id=payment_intent_id,
+            status='held'
+        ).order_by(InventoryHold.package_id).with_for_update().all()
+        held_by_package = {hold.package_id: hold for hold in holds}
+
+        for package_id, quantity in requested.items():
+            hold = held_by_package.pop(package_id, None)
+            if hold is not None:
+                # 已锁定的名额直接转为已售；数量变化的差额按容量条件补足
+                extra = quantity - hold.quantity
+                needed, held_delta = max(extra, 0), -hold.quantity
+                hold.status = 'converted'
+                hold.resolved_at = now
+            else:
+                needed, held_delta = quantity, 0
+            converted = _increment(
+                package_id, needed,
+                held_delta=held_delta,
+                sold_delta=quantity,
+                check_capacity=needed > 0
+            )
+            if not converted:
+                if not allow_oversell:
+                    raise InventoryUnavailable(package_id, quantity)
+                _increment(package_id, needed, held_delta=held_delta, sold_delta=quantity, check_capacity=False)
+                oversold.append((package_id, needed))
+
+        # 报名数据中已不存在的套餐，释放其锁定
+        for hold in held_by_package.values():
+            _increment(hold.package_id, hold.quantity, held_delta=-hold.quantity, check_capacity=False)
+            hold.status = 'released'
+            hold.resolved_at = now
+
+    if oversold:
+        db.session.info.setdefault('oversold_packages', []).append((payment_intent_id, oversold))
+    return oversold
+
+
+def release_holds(payment_intent_id):
+    """
+    释放 PaymentIntent 的有效锁定（支付失败 / PaymentIntent 取消）；不提交事务
+
+    Returns:
+        int: 释放的锁定条数
+    """
+    holds = InventoryHold.query.filter_by(
+        payment_intent_id=payment_intent_id,
+        status='held'
+    ).order_by(InventoryHold.package_id).with_for_update().all()
+    now = datetime.utcnow()
+    for hold in holds:
+        _increment(hold.package_id, hold.quantity, held_delta=-hold.quantity, check_capacity=False)
+        hold.status = 'released'
+        hold.resolved_at = now
+    return len(holds)
+
+
+def release_expired_holds(now=None, batch_size=500):
+    """
+    释放已过期的锁定（定时任务调用）；不提交事务
+
+    Returns:
+        int: 释放的锁定条数
+    """
+    now = now or datetime.utcnow()
+    holds = InventoryHold.query.filter(
+        InventoryHold.status == 'held',
+        InventoryHold.expires_at < now
+    ).order_by(InventoryHold.package_id).limit(batch_size).with_for_update().all()
+    for hold in holds:
+        _increment(hold.package_id, hold.quantity, held_delta=-hold.quantity, check_capacity=False)
+        hold.status = 'released'
+        hold.resolved_at = now
+    return len(holds)
+
+
+def recount_trip_inventory(trip_id):
+    """
+    按 booking_packages 和有效锁定重算行程下所有套餐的库存行（后台增删/取消预订、修改套餐容量后调用）
+
+    锁定库存行后重算，不提交事务。拿到行锁后的统计读到锁等待期间已提交的预订和锁定
+    （MySQL 依赖 READ COMMITTED，见 config.SQLALCHEMY_ENGINE_OPTIONS）；
+    之后才提交的并发锁定 / 转售仍通过 _increment 的原子 UPDATE 叠加在重算结果上。
+    剩余名额缓存在事务提交后失效，避免其他请求把提交前的旧值重新写入缓存。
+    """
+    if not trip_id:
+        return
+    packages = db.session.query(TripPackage.id, TripPackage.capacity).filter(TripPackage.trip_id == trip_id).all()
+    package_ids = [package_id for package_id, _capacity in packages]
+    if not package_ids:
+        return
+    ensure_inventory(package_ids)
+
+    rows = {
+        inventory.package_id: inventory for inventory in PackageInventory.query.filter(
+            PackageInventory.package_id.in_(package_ids)
+        ).order_by(PackageInventory.package_id).with_for_update().all()
+    }
+    sold = _sold_quantities(package_ids)
+    held = _held_quantities(package_ids)
+    for package_id, capacity in packages:
+        inventory = rows.get(package_id)
+        if inventory is None:
+            continue
+        inventory.capacity = capacity or None
+        inventory.sold = sold.get(package_id, 0)
+        inventory.held = held.get(package_id, 0)
+
+    db.session.info.setdefault('availability_dirty_trip_ids', set()).add(trip_id)
+
+
+@event.listens_for(db.session, 'after_commit')
+def _invalidate_availability_after_commit(session):
+    for trip_id in session.info.pop('availability_dirty_trip_ids', ()):
+        invalidate_trip_availability(trip_id)
+
+
+@event.listens_for(db.session, 'after_rollback')
+def _discard_availability_invalidations(session):
+    session.info.pop('availability_dirty_trip_ids', None)
+
+
+def _send_oversell_alert(payment_intent_id, oversold):
+    """超卖通知（发给 RECIPIENT_EMAIL）：已收款的预订超出套餐容量，需要管理员调整容量、安排或退款"""
+    from app.utils import send_email_via_ses
+
+    packages = {package.id: package for package in TripPackage.query.filter(
+        TripPackage.id.in_([package_id for package_id, _quantity in oversold])
+    ).all()}
+    lines = [
+        f"- {packages[package_id].name if package_id in packages else package_id} "
+        f"(package {package_id}): {quantity} over capacity"
+        for package_id, quantity in oversold
+    ]
+    text_body = (
+        f"Payment {payment_intent_id} succeeded after its seat hold expired and the package sold out.\n"
+        f"The booking was created and counted as sold:\n" + "\n".join(lines) +
+        "\n\nPlease raise the package capacity, rearrange the booking, or refund the customer."
+    )
+    html_body = '<p>' + text_body.replace('\n', '<br>') + '</p>'
+    recipient = current_app.config.get('RECIPIENT_EMAIL', 'info@nhtours.com')
+    sender = current_app.config.get('SENDER_EMAIL') or recipient
+    send_email_via_ses(sender, recipient, f"Package oversold - payment {payment_intent_id}", html_body, text_body)
+
+
+@event.listens_for(db.session, 'after_commit')
+def _report_oversell_after_commit(session):
+    for payment_intent_id, oversold in session.info.pop('oversold_packages', ()):
+        current_app.logger.error(
+            "package oversold after payment payment_intent_id=%s packages=%s", payment_intent_id, oversold
+        )
+        try:
+            _send_oversell_alert(payment_intent_id, oversold)
+        except Exception as e:
+            current_app.logger.error(f"Failed to send oversell alert for {payment_intent_id}: {str(e)}")
+
+
+@event.listens_for(db.session, 'after_rollback')
+def _discard_oversell_reports(session):
+    session.info.pop('oversold_packages', None)
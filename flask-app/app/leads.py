@@ -0,0 +1,83 @@
+"""
+线索（Lead）列表模块
+状态统计用一次 GROUP BY；列表按 (created_at, id) keyset 分页，支持状态和日期范围筛选
+"""
+
+from datetime import datetime, timedelta
+from sqlalchemy import and_, or_
+from app import db
+from app.models import Lead
+from app.customers import encode_cursor, decode_cursor
+
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+
+
+def get_lead_stats():
+    """
+    按状态统计线索数量（一次 GROUP BY status，走 ix_leads_status_created_at）
+
+    Returns:
+        dict: {'total', 'new', 'replied', 'converted', 'archived'}
+    """
+    stats = {status: 0 for status in Lead.STATUSES}
+    rows = db.session.query(Lead.status, db.func.count(Lead.id)).group_by(Lead.status).all()
+    for status, count in rows:
+        # 旧数据可能没有状态，按 new 统计
+        key = status or 'new'
+        stats[key] = stats.get(key, 0) + int(count or 0)
+    stats['total'] = sum(stats.values())
+    return stats
+
+
+def get_leads_page(status=None, date_from=None, date_to=None, search=None, cursor=None, limit=DEFAULT_PAGE_SIZE):
+    """
+    获取一页线索（按创建时间倒序）
+
+    Args:
+        status: 状态筛选；None / 'all' 表示全部
+        date_from / date_to: 创建日期范围（date，含首尾）
+        search: 按姓名、邮箱、电话、组织模糊搜索
+        cursor: 上一页返回的 next_cursor
+        limit: 每页条数（最大 MAX_PAGE_SIZE）
+
+    Returns:
+        dict: {'leads': [Lead], 'next_cursor': 下一页游标或 None}
+    """
+    limit = max(1, min(int(limit or DEFAULT_PAGE_SIZE), MAX_PAGE_SIZE))
+    query = Lead.query
+
+    if status and status != 'all':
+        query = query.filter(Lead.status == status)
+    if date_from:
+        query = query.filter(Lead.created_at >= datetime.combine(date_from, datetime.min.time()))
+    if date_to:
+        query = query.filter(Lead.created_at < datetime.combine(date_to + timedelta(days=1), datetime.min.time()))
+    if search:
+        pattern = f'%{search}%'
+        query = query.filter(or_(
+            Lead.name.ilike(pattern),
+            Lead.email.ilike(pattern),
+            Lead.phone.ilike(pattern),
+            Lead.organization.ilike(pattern)
+        ))
+
+    position = decode_cursor(cursor, 'created')
+    if position is not None:
+        created_at, lead_id = position
+        query = query.filter(or_(
+            Lead.created_at < created_at,
+            and_(Lead.created_at == created_at, Lead.id < lead_id)
+        ))
+
+    # 多取一条判断是否还有下一页
+    leads = query.order_by(Lead.created_at.desc(), Lead.id.desc()).limit(limit + 1).all()
+    has_more = len(leads) > limit
+    leads = leads[:limit]
+
+    next_cursor = None
+    if has_more and leads and leads[-1].created_at:
+        next_cursor = encode_cursor(leads[-1].created_at, leads[-1].id)
+
+    return {'leads': leads, 'next_cursor': next_cursor}
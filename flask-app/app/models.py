@@ -2,8 +2,10 @@
 数据库模型定义
 """
 
+import json
 from datetime import datetime
 from flask_login import UserMixin
+from sqlalchemy.orm import validates
 from werkzeug.security import generate_password_hash, check_password_hash
 from app import db, login_manager
 
@@ -61,6 +63,10 @@ trip_cities = db.Table('trip_cities',
 class Trip(db.Model):
     """行程模型"""
     __tablename__ = 'trips'
+    __table_args__ = (
+        # 日历按日期窗口查询重叠行程
+        db.Index('ix_trips_start_end', 'start_date', 'end_date'),
+    )
     
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String(128), index=True)
@@ -85,6 +91,7 @@ class Trip(db.Model):
 
     # WeTravel 风格字段
     status = db.Column(db.String(20), default='draft') # draft, published, archived
+    setup_complete = db.Column(db.Boolean, default=False, nullable=False) # 必需步骤（basics/description/packages）是否已完成
     capacity = db.Column(db.Integer) # 最大名额 (Total Capacity)
     min_capacity = db.Column(db.Integer, default=0) # 最小成团人数
     spots_sold = db.Column(db.Integer, default=0) # 已售名额
@@ -146,6 +153,9 @@ class TripPackage(db.Model):
     # Removed min_per_booking and max_per_booking - customers can add any number of packages
     currency = db.Column(db.String(3), default='USD')
     
+    # 付款计划缓存的版本戳（价格 / payment_plan_config 修改时自动刷新）
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    
     def __repr__(self):
         return f'<TripPackage {self.name}>'
 
@@ -189,9 +199,27 @@ class BuyerInfoField(db.Model):
     display_order = db.Column(db.Integer, default=0)  # 显示顺序
     options = db.Column(db.JSON)  # 对于 select 类型，存储选项（如 ["Option 1", "Option 2"]）
     
+    # 新建行程默认带的必填字段
+    DEFAULT_FIELDS = (
+        ('First Name', 'text'),
+        ('Last Name', 'text'),
+        ('Email', 'email'),
+        ('Phone', 'phone'),
+    )
+    
     # 关联
     trip = db.relationship('Trip', backref=db.backref('buyer_info_fields', lazy='dynamic', cascade='all, delete-orphan'))
     
+    @classmethod
+    def build_defaults(cls, trip):
+        """为行程生成默认必填字段（只加入 session，不提交；trip 可以还没有 ID）"""
+        fields = [
+            cls(trip=trip, field_name=name, field_type=field_type, is_required=True, display_order=order)
+            for order, (name, field_type) in enumerate(cls.DEFAULT_FIELDS)
+        ]
+        db.session.add_all(fields)
+        return fields
+    
     def __repr__(self):
         return f'<BuyerInfoField {self.field_name} (Trip {self.trip_id})>'
 
@@ -201,13 +229,26 @@ class DiscountCode(db.Model):
     
     id = db.Column(db.Integer, primary_key=True)
     trip_id = db.Column(db.Integer, db.ForeignKey('trips.id'), nullable=True) # If null, Global code? User said "Global and Trip Specific"
-    code = db.Column(db.String(64), unique=True, index=True, nullable=False)
+    code = db.Column(db.String(64), unique=True, index=True, nullable=False)  # 规范化后存储（去空格 + 大写），见 normalize_code
     type = db.Column(db.String(20), default='fixed') # fixed ($) or percent (%)
     amount = db.Column(db.Float, nullable=False)
-    used_count = db.Column(db.Integer, default=0)  # 使用次数
+    used_count = db.Column(db.Integer, default=0)  # 使用次数（只通过 app.discounts 的条件 UPDATE 修改）
+    max_uses = db.Column(db.Integer, nullable=True)  # 最多使用次数；为空表示不限
+    expires_at = db.Column(db.DateTime, nullable=True)  # 过期时间（UTC）；为空表示不过期
     
     # 注意：trip 关系已在 Trip 模型中通过 backref='trip' 定义
     
+    @staticmethod
+    def normalize_code(code):
+        """折扣码规范化：去掉首尾空格并转大写；空值返回 None"""
+        if not code:
+            return None
+        return code.strip().upper() or None
+    
+    @validates('code')
+    def _normalize_code(self, key, code):
+        return DiscountCode.normalize_code(code)
+    
     def calculate_discount(self, order_amount):
         """计算折扣金额"""
         if self.type == 'fixed':
@@ -245,9 +286,11 @@ class Client(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(64), index=True)  # 保留用于兼容性
     email = db.Column(db.String(120), index=True)
+    # 去空格 + 小写后的邮箱，唯一；客户身份以它为准（写入统一走 app.clients.upsert_client）
+    email_normalized = db.Column(db.String(120), unique=True, index=True)
     phone = db.Column(db.String(20))
     notes = db.Column(db.Text)
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
     
     # 新增字段（用于默认值，不是强制要求）
     first_name = db.Column(db.String(64))
@@ -261,6 +304,18 @@ class Client(db.Model):
     # 简单的订单关联（反向关系由 Payment.client 定义）
     payments = db.relationship('Payment', lazy='dynamic', cascade='all, delete-orphan')
     
+    @staticmethod
+    def normalize_email(email):
+        """客户身份用的邮箱：去掉首尾空格并转小写；空值返回 None"""
+        if not email:
+            return None
+        return email.strip().lower() or None
+    
+    @validates('email')
+    def _sync_email_normalized(self, key, email):
+        self.email_normalized = Client.normalize_email(email)
+        return email
+    
     @property
     def full_name(self):
         """返回完整姓名"""
@@ -319,8 +374,8 @@ class Payment(db.Model):
     
     # 时间戳
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
-    paid_at = db.Column(db.DateTime)  # 支付完成时间
-    refunded_at = db.Column(db.DateTime)  # 退款时间
+    paid_at = db.Column(db.DateTime, index=True)  # 支付完成时间（收入汇总增量任务按范围查询）
+    refunded_at = db.Column(db.DateTime, index=True)  # 退款时间
     
     # 元数据（JSON 格式，存储额外信息）
     payment_metadata = db.Column(db.JSON)  # 存储 Stripe metadata 等（注意：不能使用 metadata，这是 SQLAlchemy 保留字段）
@@ -338,16 +393,58 @@ class Payment(db.Model):
 class Lead(db.Model):
     """潜在客户/线索模型 (来自 Contact 表单)"""
     __tablename__ = 'leads'
+    __table_args__ = (
+        # 按状态筛选 + 按时间倒序分页
+        db.Index('ix_leads_status_created_at', 'status', 'created_at'),
+    )
+    
+    STATUSES = ('new', 'replied', 'converted', 'archived')
     
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(128)) # First + Last Name
     email = db.Column(db.String(120), index=True)
     phone = db.Column(db.String(20))
     organization = db.Column(db.String(200))
-    interest = db.Column(db.Text) # JSON or Comma-separated string
+    interest = db.Column(db.Text) # JSON 数组（写入时已规范化，见 normalize_interests）
     message = db.Column(db.Text)
-    status = db.Column(db.String(20), default='new') # new, replied, archived, converted
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    status = db.Column(db.String(20), default='new', nullable=False) # new, replied, archived, converted
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+    
+    @staticmethod
+    def normalize_interests(value):
+        """
+        把表单提交的兴趣（列表 / JSON 字符串 / 逗号分隔字符串）规范化为去重后的字符串列表
+        """
+        if value is None:
+            return []
+        if isinstance(value, str):
+            text = value.strip()
+            if not text:
+                return []
+            try:
+                value = json.loads(text)
+            except (ValueError, TypeError):
+                value = text.split(',')
+        if not isinstance(value, (list, tuple)):
+            value = [value]
+        
+        interests = []
+        for item in value:
+            item = str(item).strip() if item is not None else ''
+            if item and item not in interests:
+                interests.append(item)
+        return interests
+    
+    @property
+    def interest_list(self):
+        """兴趣列表（interest 已是规范化的 JSON 数组，只需一次 json.loads）"""
+        if not self.interest:
+            return []
+        try:
+            interests = json.loads(self.interest)
+        except (ValueError, TypeError):
+            return Lead.normalize_interests(self.interest)
+        return interests if isinstance(interests, list) else Lead.normalize_interests(interests)
     
     def __repr__(self):
         return f'<Lead {self.email}>'
@@ -356,6 +453,10 @@ class Lead(db.Model):
 class Booking(db.Model):
     """预订模型"""
     __tablename__ = 'bookings'
+    __table_args__ = (
+        # 客户列表按客户聚合 amount_paid / 最近预订时间（覆盖索引）
+        db.Index('ix_bookings_client_created_paid', 'client_id', 'created_at', 'amount_paid'),
+    )
     
     id = db.Column(db.Integer, primary_key=True)
     trip_id = db.Column(db.Integer, db.ForeignKey('trips.id'))
@@ -488,6 +589,10 @@ class BookingAddOn(db.Model):
 class PendingBooking(db.Model):
     """待支付报名数据临时存储模型（支付成功前存储完整报名数据）"""
     __tablename__ = 'pending_bookings'
+    __table_args__ = (
+        # 过期清理任务按状态 + 过期时间分批扫描
+        db.Index('ix_pending_bookings_status_expires_at', 'status', 'expires_at'),
+    )
     
     id = db.Column(db.Integer, primary_key=True)
     trip_id = db.Column(db.Integer, db.ForeignKey('trips.id'), nullable=False)
@@ -498,7 +603,7 @@ class PendingBooking(db.Model):
     
     # 时间戳
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
-    expires_at = db.Column(db.DateTime)  # 可选：设置过期时间（例如24小时后自动清理）
+    expires_at = db.Column(db.DateTime)  # 过期时间（24小时），过期后由 sweep_pending_bookings 标记为 expired 并在保留期后删除
     
     # 状态
     status = db.Column(db.String(20), default='pending')  # 'pending', 'completed', 'expired', 'cancelled'
@@ -597,4 +702,172 @@ class Message(db.Model):
     created_by = db.relationship('User', backref=db.backref('messages', lazy='dynamic'))
     
     def __repr__(self):
-        return f'<Message {self.id} - {self.subject}>'
\ No newline at end of file
+        return f'<Message {self.id} - {self.subject}>'
+
+class TripFinancialSummary(db.Model):
+    """行程财务汇总（账本）表：每个行程一行，在改变金额的写操作的同一事务内刷新"""
+    __tablename__ = 'trip_financial_summary'
+    
+    trip_id = db.Column(db.Integer, db.ForeignKey('trips.id', ondelete='CASCADE'), primary_key=True)
+    
+    # 金额（美元，口径与 app.stats.calculate_trips_stats 一致）
+    amount_gross = db.Column(db.Float, default=0.0, nullable=False)  # 原价总额
+    amount_discount = db.Column(db.Float, default=0.0, nullable=False)  # 折扣总额
+    amount_expected = db.Column(db.Float, default=0.0, nullable=False)  # 净应收金额
+    amount_paid = db.Column(db.Float, default=0.0, nullable=False)  # 已收金额（不含手续费）
+    amount_pending = db.Column(db.Float, default=0.0, nullable=False)  # 待收金额（expected - paid）
+    
+    # 数量
+    booking_count = db.Column(db.Integer, default=0, nullable=False)
+    participant_count = db.Column(db.Integer, default=0, nullable=False)
+    
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    
+    def to_stats(self):
+        """转换为与 calculate_trips_stats 相同结构的字典（模板直接复用）"""
+        return {
+            'booking_count': self.booking_count or 0,
+            'participants_count': self.participant_count or 0,
+            'amount_paid': self.amount_paid or 0.0,
+            'amount_gross': self.amount_gross or 0.0,
+            'amount_discount': self.amount_discount or 0.0,
+            'amount_expected': self.amount_expected or 0.0,
+            'amount_available': self.amount_pending or 0.0
+        }
+    
+    def __repr__(self):
+        return f'<TripFinancialSummary trip={self.trip_id} paid={self.amount_paid}>'
+
+
+class RevenueDaily(db.Model):
+    """每日收入汇总表（按 日期 + 行程 + 支付状态 汇总，来源为 payments 表）"""
+    __tablename__ = 'revenue_daily'
+    __table_args__ = (
+        db.UniqueConstraint('day', 'trip_id', 'status', name='uq_revenue_daily_day_trip_status'),
+    )
+    
+    id = db.Column(db.Integer, primary_key=True)
+    day = db.Column(db.Date, nullable=False, index=True)  # UTC 日期
+    trip_id = db.Column(db.Integer, db.ForeignKey('trips.id', ondelete='SET NULL'), nullable=True, index=True)
+    status = db.Column(db.String(20), nullable=False)  # Payment.status（succeeded / refunded / partially_refunded）
+    
+    # 当天支付（按 paid_at 归日）
+    payment_count = db.Column(db.Integer, default=0, nullable=False)
+    gross_cents = db.Column(db.BigInteger, default=0, nullable=False)  # final_amount_cents 之和（含手续费）
+    fee_cents = db.Column(db.BigInteger, default=0, nullable=False)  # 手续费之和
+    
+    # 当天退款（按 refunded_at 归日）
+    refund_count = db.Column(db.Integer, default=0, nullable=False)
+    refunded_cents = db.Column(db.BigInteger, default=0, nullable=False)
+    
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    
+    def __repr__(self):
+        return f'<RevenueDaily {self.day} trip={self.trip_id} {self.status}>'
+
+
+class RollupWatermark(db.Model):
+    """汇总任务水位线（记录增量任务上次处理到的时间点）"""
+    __tablename__ = 'rollup_watermarks'
+    
+    name = db.Column(db.String(64), primary_key=True)
+    value = db.Column(db.DateTime, nullable=True)  # 为空表示尚未运行（首次运行做全量）
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    
+    def __repr__(self):
+        return f'<RollupWatermark {self.name}={self.value}>'
+
+
+class PackageInventory(db.Model):
+    """套餐库存计数（sold / held 只通过原子条件 UPDATE 修改，见 app.inventory）"""
+    __tablename__ = 'package_inventory'
+    
+    package_id = db.Column(db.Integer, db.ForeignKey('trip_packages.id', ondelete='CASCADE'), primary_key=True)
+    trip_id = db.Column(db.Integer, db.ForeignKey('trips.id', ondelete='CASCADE'), nullable=False, index=True)
+    capacity = db.Column(db.Integer, nullable=True)  # TripPackage.capacity 的副本；为空表示不限量
+    sold = db.Column(db.Integer, default=0, nullable=False)  # 已成交名额（未取消预订的 BookingPackage.quantity 之和）
+    held = db.Column(db.Integer, default=0, nullable=False)  # 结账中被锁定的名额（有效 InventoryHold 之和）
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    
+    @property
+    def available(self):
+        """剩余名额；不限量时为 None"""
+        if self.capacity is None:
+            return None
+        return max(self.capacity - self.sold - self.held, 0)
+    
+    def __repr__(self):
+        return f'<PackageInventory package={self.package_id} sold={self.sold} held={self.held}>'
+
+
+class InventoryHold(db.Model):
+    """结账锁定记录（随 PendingBooking 创建，支付成功时转为已售，失败/过期时释放）"""
+    __tablename__ = 'inventory_holds'
+    __table_args__ = (
+        db.UniqueConstraint('payment_intent_id', 'package_id', name='uq_inventory_holds_pi_package'),
+        db.Index('ix_inventory_holds_status_expires_at', 'status', 'expires_at'),
+    )
+    
+    id = db.Column(db.Integer, primary_key=True)
+    package_id = db.Column(db.Integer, db.ForeignKey('trip_packages.id', ondelete='CASCADE'), nullable=False)
+    pending_booking_id = db.Column(db.Integer, db.ForeignKey('pending_bookings.id', ondelete='SET NULL'), nullable=True)
+    payment_intent_id = db.Column(db.String(128), nullable=False, index=True)
+    quantity = db.Column(db.Integer, nullable=False)
+    status = db.Column(db.String(20), default='held', nullable=False)  # 'held', 'converted', 'released'
+    expires_at = db.Column(db.DateTime, nullable=False)  # 与 PendingBooking.expires_at 一致
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    resolved_at = db.Column(db.DateTime)  # 转为已售或释放的时间
+    
+    def __repr__(self):
+        return f'<InventoryHold {self.id} package={self.package_id} qty={self.quantity} {self.status}>'
+
+
+class StripeEvent(db.Model):
+    """Stripe Webhook 事件收件箱（验签后先落库再返回 200，由后台任务按 PaymentIntent 顺序处理，见 app.stripe_events）"""
+    __tablename__ = 'stripe_events'
+    __table_args__ = (
+        db.Index('ix_stripe_events_status_next_attempt_at', 'status', 'next_attempt_at'),
+        db.Index('ix_stripe_events_object_id_created', 'object_id', 'stripe_created'),
+    )
+    
+    STATUSES = ('pending', 'processing', 'done', 'dead')
+    
+    id = db.Column(db.Integer, primary_key=True)
+    event_id = db.Column(db.String(255), unique=True, nullable=False)  # Stripe event id（evt_...），重复投递靠唯一约束去重
+    event_type = db.Column(db.String(100), nullable=False)
+    object_id = db.Column(db.String(255), nullable=True)  # 排序键：PaymentIntent ID（没有时用事件对象自身 ID）
+    stripe_created = db.Column(db.Integer, nullable=True)  # Stripe 事件创建时间（Unix 秒）
+    payload = db.Column(db.JSON, nullable=False)  # 验签通过的原始事件
+    status = db.Column(db.String(20), default='pending', nullable=False)  # 'pending', 'processing', 'done', 'dead'
+    attempts = db.Column(db.Integer, default=0, nullable=False)
+    next_attempt_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    locked_at = db.Column(db.DateTime)  # 被 worker 领取的时间；超时未完成视为 worker 崩溃，重新放回队列
+    last_error = db.Column(db.Text)
+    received_at = db.Column(db.DateTime, default=datetime.utcnow)
+    processed_at = db.Column(db.DateTime)
+    
+    def __repr__(self):
+        return f'<StripeEvent {self.event_id} {self.event_type} {self.status}>'
+
+
+class ProcessedStripeEvent(db.Model):
+    """
+    Stripe 事件处理台账：处理前先插入，唯一约束冲突说明已处理（或正由其他请求处理），直接跳过
+    - 事件级：(event_id, handler='event')，收件箱任务领取事件时写入
+    - 对象级：(object_id, handler)，一次性处理器（如 PaymentIntent 成功）开始时写入，webhook 与状态轮询兜底共用
+    台账行与处理器的改动在同一事务提交，处理失败回滚时台账行一起消失，之后可以重试
+    """
+    __tablename__ = 'processed_stripe_events'
+    __table_args__ = (
+        db.UniqueConstraint('event_id', 'handler', name='uq_processed_stripe_events_event_handler'),
+        db.UniqueConstraint('object_id', 'handler', name='uq_processed_stripe_events_object_handler'),
+    )
+    
+    id = db.Column(db.Integer, primary_key=True)
+    event_id = db.Column(db.String(255), nullable=True)  # 对象级台账为空
+    object_id = db.Column(db.String(255), nullable=True)  # 事件级台账为空
+    handler = db.Column(db.String(64), nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    def __repr__(self):
+        return f'<ProcessedStripeEvent {self.event_id or self.object_id} {self.handler}>'
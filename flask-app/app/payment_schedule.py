@@ -0,0 +1,206 @@
+"""
+套餐付款计划模块
+把 TripPackage.payment_plan_config 编译成 PaymentSchedule（日期已解析、金额为整数 cents、到期日有序），
+按 (package_id, updated_at) 在进程内缓存；首付款（追缴模式）用二分查找计算过期分期。
+"""
+
+from bisect import bisect_left
+from datetime import date, datetime, timedelta
+from itertools import accumulate
+from flask import current_app
+from app import db
+from app.cache import TTLCache
+from app.models import TripPackage, TripAddOn
+
+
+# 编译结果按 package_id 缓存；版本戳不同即重新编译
+_schedule_cache = TTLCache(maxsize=2048)
+
+# updated_at 在 MySQL 上只精确到秒：刚修改过的套餐不缓存，避免同一秒内的两次保存共用一个版本戳
+_STAMP_SETTLE = timedelta(seconds=1)
+
+
+def _to_cents(value):
+    return int(round(float(value or 0) * 100))
+
+
+def _quantity(value):
+    """报名数据里的数量；缺省为 1"""
+    if value is None or value == '':
+        return 1
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return 1
+
+
+class PaymentSchedule:
+    """
+    单个套餐某个版本的付款计划（只读）
+
+    Attributes:
+        package_id / package_name
+        price_cents: 全款单价
+        has_plan: 是否启用了定金 + 分期
+        deposit_cents: 定金单价
+        due_dates: 分期到期日（升序）
+        amounts_cents: 与 due_dates 对应的分期金额
+        cumulative_cents: amounts_cents 的前缀和，cumulative_cents[k] = 前 k 期之和
+    """
+
+    __slots__ = ('package_id', 'package_name', 'price_cents', 'has_plan', 'deposit_cents',
+                 'due_dates', 'amounts_cents', 'cumulative_cents')
+
+    def __init__(self, package_id, package_name, price_cents, has_plan=False, deposit_cents=0, installments=()):
+        installments = sorted(installments, key=lambda item: item[0])
+        self.package_id = package_id
+        self.package_name = package_name
+        self.price_cents = price_cents
+        self.has_plan = has_plan
+        self.deposit_cents = deposit_cents
+        self.due_dates = [due_date for due_date, _amount in installments]
+        self.amounts_cents = [amount for _due_date, amount in installments]
+        self.cumulative_cents = [0] + list(accumulate(self.amounts_cents))
+
+    @classmethod
+    def compile(cls, package):
+        """从 TripPackage 编译付款计划；无效的分期日期/金额记录一次错误并跳过"""
+        config = package.payment_plan_config or {}
+        price_cents = _to_cents(package.price)
+        if not config.get('enabled'):
+            return cls(package.id, package.name, price_cents)
+
+        installments = []
+        for inst_data in config.get('installments', []) or []:
+            due_date_str = inst_data.get('date')
+            if not due_date_str:
+                continue
+            try:
+                due_date = datetime.strptime(due_date_str, '%Y-%m-%d').date()
+                installments.append((due_date, _to_cents(inst_data.get('amount', 0.0))))
+            except (ValueError, TypeError) as e:
+                current_app.logger.error(
+                    f"Invalid installment date or amount for package {package.id}: {due_date_str}, {str(e)}"
+                )
+
+        deposit = config.get('deposit_amount', 0.0) or config.get('deposit', 0.0)
+        return cls(package.id, package.name, price_cents, has_plan=True,
+                   deposit_cents=_to_cents(deposit), installments=installments)
+
+    def overdue_count(self, as_of):
+        """到期日 < as_of 的分期数"""
+        return bisect_left(self.due_dates, as_of)
+
+    def initial_cents(self, as_of, quantity=1, plan_type='full'):
+        """
+        首付款（追缴模式）：定金 + 所有过期分期；不分期时为全款
+
+        Returns:
+            tuple: (deposit_cents, overdue_cents)，均已乘以数量
+        """
+        if plan_type != 'deposit_installment' or not self.has_plan:
+            return self.price_cents * quantity, 0
+        return self.deposit_cents * quantity, self.cumulative_cents[self.overdue_count(as_of)] * quantity
+
+    def overdue_details(self, as_of, quantity=1):
+        """过期分期明细（用于日志和 metadata）"""
+        return [{
+            'package_name': self.package_name,
+            'due_date': due_date.isoformat(),
+            'amount': amount / 100.0,
+            'quantity': quantity,
+            'total': amount * quantity / 100.0
+        } for due_date, amount in zip(self.due_dates[:self.overdue_count(as_of)], self.amounts_cents)]
+
+
+def get_payment_schedule(package):
+    """取已加载套餐的付款计划（命中缓存则不重新解析）"""
+    stamp = package.updated_at
+    cached = _schedule_cache.get(package.id)
+    if cached is not None and stamp is not None and cached[0] == stamp:
+        return cached[1]
+
+    schedule = PaymentSchedule.compile(package)
+    if stamp is not None and stamp < datetime.utcnow() - _STAMP_SETTLE:
+        _schedule_cache.set(package.id, (stamp, schedule))
+    return schedule
+
+
+def get_payment_schedules(package_ids):
+    """
+    批量取付款计划（一次 IN 查询加载套餐）
+
+    Returns:
+        dict: {package_id: PaymentSchedule}，不存在的套餐不返回
+    """
+    ids = set()
+    for package_id in package_ids:
+        try:
+            ids.add(int(package_id))
+        except (TypeError, ValueError):
+            continue
+    if not ids:
+        return {}
+    packages = TripPackage.query.filter(TripPackage.id.in_(ids)).all()
+    return {package.id: get_payment_schedule(package) for package in packages}
+
+
+def quote_initial_payment(packages_data, addons_data, as_of=None):
+    """
+    按报名数据计算首付款（追缴模式），不需要 Booking 对象
+
+    公式：首付款 = 定金（或全款）+ 所有过期分期 + 所有附加项
+
+    Args:
+        packages_data: [{'package_id', 'quantity', 'payment_plan_type'}]
+        addons_data: [{'addon_id', 'quantity'}]
+        as_of: 计算日期，默认今天
+
+    Returns:
+        dict: {'gross_cents', 'deposit_cents', 'overdue_cents', 'addons_cents', 'overdue_details'}
+    """
+    as_of = as_of or date.today()
+    schedules = get_payment_schedules(pkg_data.get('package_id') for pkg_data in packages_data or [])
+
+    deposit_cents = 0
+    overdue_cents = 0
+    overdue_details = []
+    for pkg_data in packages_data or []:
+        try:
+            schedule = schedules.get(int(pkg_data.get('package_id')))
+        except (TypeError, ValueError):
+            schedule = None
+        if schedule is None:
+            continue
+        quantity = _quantity(pkg_data.get('quantity', 1))
+        plan_type = pkg_data.get('payment_plan_type', 'full')
+        deposit, overdue = schedule.initial_cents(as_of, quantity, plan_type)
+        deposit_cents += deposit
+        overdue_cents += overdue
+        if overdue:
+            overdue_details.extend(schedule.overdue_details(as_of, quantity))
+
+    addons_cents = 0
+    addon_ids = set()
+    for addon_data in addons_data or []:
+        try:
+            addon_ids.add(int(addon_data.get('addon_id')))
+        except (TypeError, ValueError):
+            continue
+    if addon_ids:
+        addon_prices = dict(db.session.query(TripAddOn.id, TripAddOn.price).filter(TripAddOn.id.in_(addon_ids)).all())
+        for addon_data in addons_data:
+            try:
+                price = addon_prices.get(int(addon_data.get('addon_id')))
+            except (TypeError, ValueError):
+                continue
+            if price:
+                addons_cents += _to_cents(price) * _quantity(addon_data.get('quantity', 1))
+
+    return {
+        'gross_cents': deposit_cents + overdue_cents + addons_cents,
+        'deposit_cents': deposit_cents,
+        'overdue_cents': overdue_cents,
+        'addons_cents': addons_cents,
+        'overdue_details': overdue_details
+    }
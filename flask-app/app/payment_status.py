@@ -0,0 +1,107 @@
+"""
+支付状态通知
+Webhook 处理器在事务提交后发布 PaymentIntent / Booking 的状态变化，
+/api/payment/status 的长轮询请求在本进程内等待通知，不再 sleep。
+其他 worker 处理的 webhook 由长轮询每隔 PAYMENT_STATUS_RECHECK_SECONDS 的数据库复查发现。
+等待会占用一个 gthread 线程，因此单次最多等待 PAYMENT_STATUS_MAX_WAIT 秒，
+每个进程同时等待的请求不超过 PAYMENT_STATUS_MAX_WAITERS，其余线程留给其他请求（包括 Stripe webhook）。
+"""
+
+import threading
+from contextlib import contextmanager
+from sqlalchemy import event
+from app import db
+
+
+class _StatusHub:
+    """进程内的按 key 通知（Condition + 版本号，避免错过等待开始前的通知）"""
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._versions = {}
+
+    def version(self, key):
+        with self._cond:
+            return self._versions.get(key, 0)
+
+    def publish(self, key):
+        with self._cond:
+            self._versions[key] = self._versions.get(key, 0) + 1
+            # 只保留最近的 key，避免无限增长（等待方会在超时后回查数据库）
+            if len(self._versions) > 4096:
+                self._versions.pop(next(iter(self._versions)))
+            self._cond.notify_all()
+
+    def wait(self, key, since_version, timeout):
+        """等待 key 的版本号超过 since_version；返回是否收到通知"""
+        with self._cond:
+            return self._cond.wait_for(lambda: self._versions.get(key, 0) > since_version, timeout)
+
+
+_hub = _StatusHub()
+
+_waiters_lock = threading.Lock()
+_waiters = 0
+
+
+@contextmanager
+def long_poll_slot(limit):
+    """
+    占用本进程的一个长轮询名额（不阻塞）
+
+    Yields:
+        bool: 是否拿到名额；名额用完时调用方应立即返回当前状态
+    """
+    global _waiters
+    with _waiters_lock:
+        acquired = _waiters < limit
+        if acquired:
+            _waiters += 1
+    try:
+        yield acquired
+    finally:
+        if acquired:
+            with _waiters_lock:
+                _waiters -= 1
+
+
+def _keys(payment_intent_id=None, booking_id=None):
+    keys = []
+    if payment_intent_id:
+        keys.append(f'pi:{payment_intent_id}')
+    if booking_id:
+        keys.append(f'booking:{booking_id}')
+    return keys
+
+
+def notify_payment_status(payment_intent_id=None, booking_id=None):
+    """标记支付状态已变化；随当前事务提交后发布（回滚则丢弃）"""
+    db.session.info.setdefault('payment_status_keys', set()).update(_keys(payment_intent_id, booking_id))
+
+
+def payment_status_version(payment_intent_id=None, booking_id=None):
+    """开始等待前读取版本号"""
+    key = _keys(payment_intent_id, booking_id)[0]
+    return _hub.version(key)
+
+
+def wait_for_payment_status(since_version, timeout, payment_intent_id=None, booking_id=None):
+    """
+    等待支付状态通知（优先按 payment_intent_id，其次 booking_id）
+
+    Returns:
+        bool: 超时前收到通知返回 True
+    """
+    key = _keys(payment_intent_id, booking_id)[0]
+    return _hub.wait(key, since_version, timeout)
+
+
+@event.listens_for(db.session, 'after_commit')
+def _publish_payment_status_after_commit(session):
+    for key in session.info.pop('payment_status_keys', ()):
+        _hub.publish(key)
+
+
+@event.listens_for(db.session, 'after_rollback')
+def _discard_payment_status(session):
+    session.info.pop('payment_status_keys', None)
@@ -1,8 +1,52 @@
 import json
 import math
+import threading
+import time
 import stripe
 from flask import current_app
-from datetime import datetime, date
+from datetime import date
+from app.cache import TTLCache, SingleFlight
+from app.stripe_client import stripe_call, stripe_configured
+
+
+# 卡片 funding / brand 缓存（按 payment_method_id）：PaymentMethod 的卡信息不会变，报价时反复查询只需一次 Stripe 调用
+_card_details_cache = TTLCache(maxsize=4096)
+# 同一个 payment_method_id 的并发报价合并为一次 Stripe 调用
+_card_details_flight = SingleFlight(timeout=30)
+
+
+class _LatencyStats:
+    """Stripe 调用耗时统计（进程内累计）"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.errors = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self.last_ms = None
+
+    def record(self, elapsed_ms, ok=True):
+        with self._lock:
+            self.calls += 1
+            if not ok:
+                self.errors += 1
+            self.total_ms += elapsed_ms
+            self.max_ms = max(self.max_ms, elapsed_ms)
+            self.last_ms = elapsed_ms
+
+    def stats(self):
+        with self._lock:
+            return {
+                'calls': self.calls,
+                'errors': self.errors,
+                'avg_ms': round(self.total_ms / self.calls, 1) if self.calls else 0.0,
+                'max_ms': round(self.max_ms, 1),
+                'last_ms': round(self.last_ms, 1) if self.last_ms is not None else None
+            }
+
+
+_payment_method_latency = _LatencyStats()
 
 
 def _normalize_metadata(metadata):
@@ -54,9 +98,7 @@ def create_checkout_session(booking, line_items, success_url, cancel_url, mode='
     Returns:
         session: Stripe Session 对象
     """
-    stripe.api_key = current_app.config.get('STRIPE_SECRET_KEY')
-    
-    if not stripe.api_key:
+    if not stripe_configured():
         current_app.logger.error("STRIPE_SECRET_KEY not configured")
         return None
     
@@ -78,7 +120,8 @@ def create_checkout_session(booking, line_items, success_url, cancel_url, mode='
         
         session_metadata = build_booking_metadata(booking, metadata) if metadata is not None else build_booking_metadata(booking)
 
-        session = stripe.checkout.Session.create(
+        session = stripe_call(
+            stripe.checkout.Session.create,
             payment_method_types=['card'],
             line_items=stripe_line_items,
             mode=mode,
@@ -107,9 +150,7 @@ def create_payment_intent(amount, currency='usd', customer_id=None, metadata=Non
     Returns:
         payment_intent: Stripe Payment Intent 对象
     """
-    stripe.api_key = current_app.config.get('STRIPE_SECRET_KEY')
-    
-    if not stripe.api_key:
+    if not stripe_configured():
         current_app.logger.error("STRIPE_SECRET_KEY not configured")
         return None
     
@@ -134,7 +175,7 @@ def create_payment_intent(amount, currency='usd', customer_id=None, metadata=Non
                     )
             payment_intent_params['metadata'] = normalized_metadata
         
-        payment_intent = stripe.PaymentIntent.create(**payment_intent_params)
+        payment_intent = stripe_call(stripe.PaymentIntent.create, **payment_intent_params)
         current_app.logger.info(f"Payment Intent created successfully: {payment_intent.id}")
         return payment_intent
     except stripe.error.StripeError as e:
@@ -152,8 +193,7 @@ def create_payment_intent(amount, currency='usd', customer_id=None, metadata=Non
 
 
 def update_payment_intent_amount(payment_intent_id, amount_cents, metadata=None):
-    stripe.api_key = current_app.config.get('STRIPE_SECRET_KEY')
-    if not stripe.api_key:
+    if not stripe_configured():
         current_app.logger.error("STRIPE_SECRET_KEY not configured")
         return None
     try:
@@ -162,33 +202,50 @@ def update_payment_intent_amount(payment_intent_id, amount_cents, metadata=None)
         }
         if metadata:
             params['metadata'] = _normalize_metadata(metadata)
-        return stripe.PaymentIntent.modify(payment_intent_id, **params)
+        return stripe_call(stripe.PaymentIntent.modify, payment_intent_id, **params)
     except Exception as e:
         current_app.logger.error(f"Stripe Payment Intent update failed: {str(e)}")
         return None
 
 
+def cancel_payment_intent(payment_intent_id):
+    """
+    取消 Payment Intent（不再需要付款时调用）
+
+    Returns:
+        bool: 是否取消成功；失败只记录日志，由调用方决定是否继续
+    """
+    if not stripe_configured():
+        current_app.logger.error("STRIPE_SECRET_KEY not configured")
+        return False
+    try:
+        stripe_call(stripe.PaymentIntent.cancel, payment_intent_id)
+        return True
+    except Exception as e:
+        current_app.logger.warning(f"Failed to cancel Payment Intent {payment_intent_id}: {e}")
+        return False
+
+
 def retrieve_payment_intent(payment_intent_id):
-    stripe.api_key = current_app.config.get('STRIPE_SECRET_KEY')
-    if not stripe.api_key:
+    if not stripe_configured():
         current_app.logger.error("STRIPE_SECRET_KEY not configured")
         return None
     try:
-        return stripe.PaymentIntent.retrieve(payment_intent_id)
+        return stripe_call(stripe.PaymentIntent.retrieve, payment_intent_id)
     except Exception as e:
         current_app.logger.error(f"Stripe Payment Intent retrieve failed: {str(e)}")
         return None
 
 
-def retrieve_payment_method_card_details(payment_method_id):
-    stripe.api_key = current_app.config.get('STRIPE_SECRET_KEY')
-    if not stripe.api_key:
-        current_app.logger.error("STRIPE_SECRET_KEY not configured")
-        return "unknown", "unknown"
+def _fetch_payment_method_card_details(payment_method_id):
+    started = time.perf_counter()
     try:
-        payment_method = stripe.PaymentMethod.retrieve(payment_method_id)
-    except Exception:
+        payment_method = stripe_call(stripe.PaymentMethod.retrieve, payment_method_id)
+    except Exception as e:
+        _payment_method_latency.record((time.perf_counter() - started) * 1000, ok=False)
+        current_app.logger.warning(f"Stripe PaymentMethod retrieve failed: {str(e)}")
         return "unknown", "unknown"
+    _payment_method_latency.record((time.perf_counter() - started) * 1000)
 
     card = getattr(payment_method, "card", None)
     if not card:
@@ -197,6 +254,48 @@ def retrieve_payment_method_card_details(payment_method_id):
     return card.get("funding", "unknown"), card.get("brand", "unknown")
 
 
+def retrieve_payment_method_card_details(payment_method_id):
+    """
+    查询卡片的 funding / brand（用于计算手续费）
+
+    结果按 payment_method_id 缓存 PAYMENT_METHOD_CACHE_TTL 秒；同一卡片的并发请求共享一次 Stripe 调用。
+    查询失败（"unknown"）不缓存，下次报价会重试。
+
+    Returns:
+        tuple: (funding, brand)
+    """
+    if not stripe_configured():
+        current_app.logger.error("STRIPE_SECRET_KEY not configured")
+        return "unknown", "unknown"
+
+    cached = _card_details_cache.get(payment_method_id)
+    if cached is not None:
+        return cached
+
+    def _load():
+        # 等待期间可能已被其他线程写入缓存
+        cached = _card_details_cache.get(payment_method_id)
+        if cached is not None:
+            return cached
+        details = _fetch_payment_method_card_details(payment_method_id)
+        if details[0] != "unknown":
+            ttl = current_app.config.get('PAYMENT_METHOD_CACHE_TTL', 900)
+            _card_details_cache.set(payment_method_id, details, ttl=ttl)
+        return details
+
+    details, _shared = _card_details_flight.do(payment_method_id, _load)
+    return details
+
+
+def payment_method_cache_stats():
+    """卡片信息缓存命中率与 Stripe 调用耗时（后台指标接口展示）"""
+    return {
+        'cache': _card_details_cache.stats(),
+        'coalesced': _card_details_flight.shared,
+        'stripe_latency': _payment_method_latency.stats()
+    }
+
+
 def calculate_fee(base_amount_cents, funding, brand):
     if funding != "credit":
         return 0
@@ -219,9 +318,7 @@ def process_refund(payment_intent_id, amount, reason=None):
     Returns:
         refund: Stripe Refund 对象，如果失败则返回 None
     """
-    stripe.api_key = current_app.config.get('STRIPE_SECRET_KEY')
-    
-    if not stripe.api_key:
+    if not stripe_configured():
         current_app.logger.error("STRIPE_SECRET_KEY not configured")
         return None
     
@@ -230,7 +327,8 @@ def process_refund(payment_intent_id, amount, reason=None):
         amount_cents = int(amount * 100)
         
         # Create refund
-        refund = stripe.Refund.create(
+        refund = stripe_call(
+            stripe.Refund.create,
             payment_intent=payment_intent_id,
             amount=amount_cents,
             reason='requested_by_customer' if reason else None,
@@ -271,28 +369,15 @@ def calculate_booking_total(booking):
     - amount_paid 来自 Booking.amount_paid，也是不含手续费的基础金额
     - Stripe 手续费是在支付时额外收取的，由客户承担，但不进入我们的收入
     """
-    subtotal = 0.0
-    
-    # 计算套餐金额
-    for bp in booking.booking_packages.all():
-        if bp.package and bp.package.price:
-            package_price = float(bp.package.price)
-            quantity = int(bp.quantity) if bp.quantity else 1
-            subtotal += package_price * quantity
-    
-    # 计算附加项金额
-    for addon in booking.addons.all():
-        if addon.addon and addon.addon.price:
-            addon_price = float(addon.addon.price)
-            quantity = int(addon.quantity) if addon.quantity else 1
-            subtotal += addon_price * quantity
+    from app.pricing import price_booking
     
-    # 应用折扣码（从 Booking.discount_amount 获取）
-    discount = float(booking.discount_amount) if booking.discount_amount else 0.0
-    
-    total = max(0.0, subtotal - discount)
-    amount_paid = float(booking.amount_paid) if booking.amount_paid else 0.0
-    amount_due = max(0.0, total - amount_paid)
+    # 套餐 + 附加项（booking 与 participant 两个来源去重）统一由定价模块计算
+    pricing = price_booking(booking)
+    subtotal = pricing['subtotal']
+    discount = pricing['discount']
+    total = pricing['total']
+    amount_paid = pricing['amount_paid']
+    amount_due = pricing['amount_due']
     
     return {
         'subtotal': subtotal,
@@ -326,10 +411,6 @@ def calculate_initial_payment_amount(booking, payment_plan='full'):
         }
     """
     today = date.today()
-    initial_amount = 0.0
-    deposit_amount = 0.0
-    overdue_installments_total = 0.0
-    addons_total = 0.0
     overdue_details = []
     
     # 如果是全款支付，返回总金额
@@ -347,61 +428,34 @@ def calculate_initial_payment_amount(booking, payment_plan='full'):
             'overdue_details': []
         }
     
-    # 计算附加项金额
+    from app.payment_schedule import get_payment_schedule
+    
+    # 计算附加项金额（整数 cents 累加）
+    addons_cents = 0
     for addon in booking.addons.all():
         if addon.addon and addon.addon.price:
-            addon_price = float(addon.addon.price)
             quantity = int(addon.quantity) if addon.quantity else 1
-            addons_total += addon_price * quantity
+            addons_cents += int(round(float(addon.addon.price) * 100)) * quantity
     
-    # 遍历所有 BookingPackage，检查分期付款计划
+    # 遍历所有 BookingPackage：分期套餐取 定金 + 过期分期（预编译付款计划，二分查找），其余取全价
+    deposit_cents = 0
+    overdue_cents = 0
     for bp in booking.booking_packages.all():
         if not bp.package:
             continue
-            
-        # 检查是否有分期付款计划
-        if bp.payment_plan_type == 'deposit_installment' and bp.package.payment_plan_config:
-            config = bp.package.payment_plan_config
-            if config and config.get('enabled'):
-                # 获取定金金额
-                deposit = config.get('deposit_amount', 0.0) or config.get('deposit', 0.0)
-                deposit_amount += float(deposit) * (int(bp.quantity) if bp.quantity else 1)
-                
-                # 检查分期付款计划中的过期分期
-                installments = config.get('installments', [])
-                for inst_data in installments:
-                    due_date_str = inst_data.get('date')
-                    if not due_date_str:
-                        continue
-                    
-                    try:
-                        due_date = datetime.strptime(due_date_str, '%Y-%m-%d').date()
-                        inst_amount = float(inst_data.get('amount', 0.0))
-                        quantity = int(bp.quantity) if bp.quantity else 1
-                        
-                        # 如果到期日期 < 今天，则过期，需要合并到首付款
-                        if due_date < today:
-                            overdue_amount = inst_amount * quantity
-                            overdue_installments_total += overdue_amount
-                            overdue_details.append({
-                                'package_name': bp.package.name,
-                                'due_date': due_date_str,
-                                'amount': inst_amount,
-                                'quantity': quantity,
-                                'total': overdue_amount
-                            })
-                    except (ValueError, TypeError) as e:
-                        current_app.logger.error(f"Invalid installment date or amount: {due_date_str}, {str(e)}")
-                        continue
-        else:
-            # 如果没有分期付款计划，使用套餐全价作为首付款
-            if bp.package and bp.package.price:
-                package_price = float(bp.package.price)
-                quantity = int(bp.quantity) if bp.quantity else 1
-                deposit_amount += package_price * quantity
+        quantity = int(bp.quantity) if bp.quantity else 1
+        schedule = get_payment_schedule(bp.package)
+        deposit, overdue = schedule.initial_cents(today, quantity, bp.payment_plan_type)
+        deposit_cents += deposit
+        overdue_cents += overdue
+        if overdue:
+            overdue_details.extend(schedule.overdue_details(today, quantity))
     
     # 计算首付款总额：定金 + 过期分期 + 附加项
-    initial_amount = deposit_amount + overdue_installments_total + addons_total
+    deposit_amount = deposit_cents / 100.0
+    overdue_installments_total = overdue_cents / 100.0
+    addons_total = addons_cents / 100.0
+    initial_amount = (deposit_cents + overdue_cents + addons_cents) / 100.0
     
     current_app.logger.info(
         f"Initial payment calculated for booking {booking.id}: "
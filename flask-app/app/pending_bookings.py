@@ -0,0 +1,120 @@
+"""
+结账过期清理模块
+PendingBooking 写入时 expires_at = 24 小时后；定时任务按 (status, expires_at) 索引分批处理：
+  - 过期仍未支付的行标记为 expired，归还占用的折扣码（套餐名额锁定与它同时过期，由 release_expired_holds 释放）
+  - 可选：批量取消对应的 PaymentIntent，避免客户在过期后仍能付款
+  - 过期 / 取消 / 完成的行超过保留期后分批删除
+保留期内迟到的支付仍按原报名数据创建预订（_create_booking_from_metadata 接受 expired 状态）。
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from flask import current_app
+from app import db
+from app.models import PendingBooking
+from app.discounts import release_pending_discount
+
+
+# 保留期满后可以删除的状态
+TERMINAL_STATUSES = ('expired', 'cancelled', 'completed')
+
+
+def expire_pending_bookings(now=None, batch_size=500):
+    """
+    把一批已过期的待支付行标记为 expired 并归还折扣码；不提交事务
+
+    行锁使用 SKIP LOCKED，正在被支付回调处理的行留给下一批 / 下一个周期
+
+    Returns:
+        list: 本批过期行的 PaymentIntent ID
+    """
+    now = now or datetime.utcnow()
+    rows = PendingBooking.query.filter(
+        PendingBooking.status == 'pending',
+        PendingBooking.expires_at < now
+    ).order_by(PendingBooking.expires_at).limit(batch_size).with_for_update(skip_locked=True).all()
+    for pending_booking in rows:
+        pending_booking.status = 'expired'
+        release_pending_discount(pending_booking)
+    return [pending_booking.payment_intent_id for pending_booking in rows]
+
+
+def delete_stale_pending_bookings(cutoff, batch_size=500):
+    """
+    删除一批 expires_at 早于 cutoff 的终态行（先按索引取 ID，再按主键删除）；不提交事务
+
+    Returns:
+        int: 删除的行数
+    """
+    ids = [row_id for (row_id,) in db.session.query(PendingBooking.id).filter(
+        PendingBooking.status.in_(TERMINAL_STATUSES),
+        PendingBooking.expires_at < cutoff
+    ).limit(batch_size).all()]
+    if not ids:
+        return 0
+    return PendingBooking.query.filter(PendingBooking.id.in_(ids)).delete(synchronize_session=False)
+
+
+def cancel_payment_intents(payment_intent_ids):
+    """
+    并发取消一组 PaymentIntent（并发数不超过 STRIPE_HTTP_POOL_SIZE，复用连接池）
+
+    已成功 / 处理中的 PaymentIntent Stripe 会拒绝取消，只记录日志；熔断器打开后剩余的直接跳过。
+    取消成功后 Stripe 发送 payment_intent.canceled，收件箱处理时对应行已是 expired，不会重复归还。
+
+    Returns:
+        int: 取消成功的数量
+    """
+    from app.payments import cancel_payment_intent
+    from app.stripe_client import stripe_client_stats
+
+    if not payment_intent_ids:
+        return 0
+    app = current_app._get_current_object()
+
+    def _cancel(payment_intent_id):
+        with app.app_context():
+            if stripe_client_stats()['breaker']['state'] == 'open':
+                return False
+            return cancel_payment_intent(payment_intent_id)
+
+    workers = max(min(app.config.get('STRIPE_HTTP_POOL_SIZE', 10), len(payment_intent_ids)), 1)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return sum(1 for cancelled in executor.map(_cancel, payment_intent_ids) if cancelled)
+
+
+def sweep_pending_bookings(now=None, batch_size=None, cancel_intents=None):
+    """
+    清理过期的 PendingBooking（由定时任务调用）：每批一个事务，直到没有可处理的行
+
+    Args:
+        batch_size: 每批条数（默认 PENDING_BOOKING_SWEEP_BATCH）
+        cancel_intents: 是否取消过期行的 PaymentIntent（默认 PENDING_BOOKING_CANCEL_INTENTS）；在事务提交后调用 Stripe
+
+    Returns:
+        dict: {'expired', 'intents_cancelled', 'deleted'}
+    """
+    now = now or datetime.utcnow()
+    batch_size = batch_size or current_app.config.get('PENDING_BOOKING_SWEEP_BATCH', 500)
+    if cancel_intents is None:
+        cancel_intents = current_app.config.get('PENDING_BOOKING_CANCEL_INTENTS', False)
+    retention = timedelta(hours=current_app.config.get('PENDING_BOOKING_RETENTION_HOURS', 168))
+    result = {'expired': 0, 'intents_cancelled': 0, 'deleted': 0}
+
+    while True:
+        payment_intent_ids = expire_pending_bookings(now, batch_size)
+        db.session.commit()
+        result['expired'] += len(payment_intent_ids)
+        if cancel_intents:
+            result['intents_cancelled'] += cancel_payment_intents(payment_intent_ids)
+        if len(payment_intent_ids) < batch_size:
+            break
+
+    while True:
+        deleted = delete_stale_pending_bookings(now - retention, batch_size)
+        db.session.commit()
+        result['deleted'] += deleted
+        if deleted < batch_size:
+            break
+
+    return result
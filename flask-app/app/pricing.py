@@ -0,0 +1,158 @@
+"""
+预订定价模块
+统一计算预订的原价（套餐 + 附加项）、折扣和应付金额，支持批量计算
+"""
+
+from sqlalchemy import or_
+from sqlalchemy.orm import selectinload
+from app import db
+from app.models import Booking, BookingPackage, BookingParticipant, BookingAddOn
+
+
+def _empty_breakdown(booking):
+    return {
+        'booking': booking,
+        'packages': [],
+        'addons': [],
+        'packages_total': 0.0,
+        'addons_total': 0.0,
+        'subtotal': 0.0,
+        'discount': 0.0,
+        'total': 0.0,
+        'has_packages': False,
+        'gross': 0.0,
+        'expected': 0.0,
+        'amount_paid': 0.0,
+        'amount_due': 0.0
+    }
+
+
+def price_bookings(booking_ids):
+    """
+    批量计算预订金额明细
+
+    一次性加载所有预订的套餐、附加项（selectin 加载 TripPackage / TripAddOn），
+    查询次数固定，与预订数量无关。
+
+    Args:
+        booking_ids: 预订 ID 列表
+
+    Returns:
+        dict: {booking_id: {
+            'booking': Booking 对象,
+            'packages': [{'booking_package', 'package', 'name', 'price', 'quantity', 'subtotal'}],
+            'addons': [{'booking_addon', 'addon', 'participant_id', 'name', 'price', 'quantity', 'subtotal'}],
+            'packages_total': 套餐小计,
+            'addons_total': 附加项小计,
+            'subtotal': 小计（套餐 + 附加项）,
+            'discount': 折扣金额,
+            'total': max(0, subtotal - discount)，净应付金额（不含 Stripe 手续费）,
+            'has_packages': 是否有有效的 BookingPackage,
+            'gross' / 'expected': 报表口径；没有套餐的旧预订以 amount_paid 作为原价和应收，折扣记为 0,
+            'amount_paid': 已支付金额（不含手续费）,
+            'amount_due': max(0, total - amount_paid)
+        }}
+
+    附加项同时来自 booking.addons 和 participant.addons，按 BookingAddOn.id 去重；
+    TripAddOn 已被删除的附加项不计入。
+    """
+    booking_ids = list({bid for bid in booking_ids if bid is not None})
+    if not booking_ids:
+        return {}
+
+    bookings = Booking.query.filter(Booking.id.in_(booking_ids)).all()
+    result = {booking.id: _empty_breakdown(booking) for booking in bookings}
+    if not result:
+        return result
+
+    # 套餐（selectin 加载 TripPackage）
+    booking_packages = BookingPackage.query.options(
+        selectinload(BookingPackage.package)
+    ).filter(
+        BookingPackage.booking_id.in_(booking_ids)
+    ).order_by(BookingPackage.id).all()
+
+    for bp in booking_packages:
+        if not bp.package:
+            continue
+        price = float(bp.package.price) if bp.package.price is not None else 0.0
+        quantity = int(bp.quantity) if bp.quantity is not None else 1
+        breakdown = result[bp.booking_id]
+        breakdown['packages'].append({
+            'booking_package': bp,
+            'package': bp.package,
+            'name': bp.package.name,
+            'price': price,
+            'quantity': quantity,
+            'subtotal': price * quantity
+        })
+        breakdown['packages_total'] += price * quantity
+        breakdown['has_packages'] = True
+
+    # 参与者 -> 预订 映射（用于归集 participant.addons）
+    participant_rows = db.session.query(
+        BookingParticipant.id,
+        BookingParticipant.booking_id
+    ).filter(BookingParticipant.booking_id.in_(booking_ids)).all()
+    participant_booking = {pid: bid for pid, bid in participant_rows}
+
+    # 附加项（selectin 加载 TripAddOn）
+    addon_filter = BookingAddOn.booking_id.in_(booking_ids)
+    if participant_booking:
+        addon_filter = or_(addon_filter, BookingAddOn.participant_id.in_(list(participant_booking.keys())))
+    booking_addons = BookingAddOn.query.options(
+        selectinload(BookingAddOn.addon)
+    ).filter(addon_filter).order_by(BookingAddOn.id).all()
+
+    for ba in booking_addons:
+        if not ba.addon:
+            continue
+        # 同一个 BookingAddOn 可能同时通过 booking 和 participant 关联到（不同的）预订
+        owners = set()
+        if ba.booking_id in result:
+            owners.add(ba.booking_id)
+        if ba.participant_id in participant_booking:
+            owners.add(participant_booking[ba.participant_id])
+
+        price = float(ba.addon.price) if ba.addon.price is not None else 0.0
+        quantity = int(ba.quantity) if ba.quantity is not None else 1
+        for booking_id in owners:
+            breakdown = result[booking_id]
+            breakdown['addons'].append({
+                'booking_addon': ba,
+                'addon': ba.addon,
+                'participant_id': ba.participant_id,
+                'name': ba.addon.name,
+                'price': price,
+                'quantity': quantity,
+                'subtotal': price * quantity
+            })
+            breakdown['addons_total'] += price * quantity
+
+    for booking_id, breakdown in result.items():
+        booking = breakdown['booking']
+        amount_paid = float(booking.amount_paid) if booking.amount_paid else 0.0
+        discount = float(booking.discount_amount) if booking.discount_amount else 0.0
+        subtotal = breakdown['packages_total'] + breakdown['addons_total']
+        total = max(0.0, subtotal - discount)
+
+        breakdown['subtotal'] = subtotal
+        breakdown['discount'] = discount
+        breakdown['total'] = total
+        breakdown['amount_paid'] = amount_paid
+        breakdown['amount_due'] = max(0.0, total - amount_paid)
+
+        if breakdown['has_packages']:
+            breakdown['gross'] = subtotal
+            breakdown['expected'] = total
+        else:
+            # Fallback for legacy bookings without BookingPackages
+            breakdown['gross'] = amount_paid
+            breakdown['expected'] = amount_paid
+
+    return result
+
+
+def price_booking(booking):
+    """计算单个预订的金额明细（price_bookings 的便捷封装）"""
+    return price_bookings([booking.id])[booking.id]
@@ -0,0 +1,280 @@
+"""
+收入汇总模块
+维护 revenue_daily 每日汇总表（增量任务 + 回填），并提供按周/月/季度的时间范围查询
+"""
+
+from datetime import date, datetime, timedelta
+from flask import current_app
+from app import db
+from app.models import Payment, RevenueDaily, RollupWatermark
+
+
+ROLLUP_NAME = 'revenue_daily'
+
+# 每次重算的天数分批大小
+RECOMPUTE_CHUNK_DAYS = 31
+
+GRANULARITIES = ('day', 'week', 'month', 'quarter')
+
+
+def _to_date(value):
+    """func.date() 在 MySQL 返回 date，在 SQLite 返回字符串"""
+    if isinstance(value, datetime):
+        return value.date()
+    if isinstance(value, date):
+        return value
+    return date.fromisoformat(str(value)[:10])
+
+
+def _gross_cents_expr():
+    # 旧数据没有 final_amount_cents 时，用 amount（美元）换算
+    return db.func.coalesce(Payment.final_amount_cents, db.func.round(Payment.amount * 100))
+
+
+def recompute_revenue_days(days):
+    """
+    重算指定日期的 revenue_daily 行（先删后插，幂等）
+
+    Args:
+        days: 日期集合（UTC）
+
+    Returns:
+        int: 写入的汇总行数
+    """
+    days = sorted({_to_date(d) for d in days if d is not None})
+    written = 0
+
+    for start in range(0, len(days), RECOMPUTE_CHUNK_DAYS):
+        chunk = days[start:start + RECOMPUTE_CHUNK_DAYS]
+        chunk_set = set(chunk)
+        range_start = datetime.combine(chunk[0], datetime.min.time())
+        range_end = datetime.combine(chunk[-1] + timedelta(days=1), datetime.min.time())
+
+        RevenueDaily.query.filter(RevenueDaily.day.in_(chunk)).delete(synchronize_session=False)
+
+        buckets = {}
+
+        def _bucket(day, trip_id, status):
+            key = (day, trip_id, status)
+            if key not in buckets:
+                buckets[key] = {
+                    'day': day, 'trip_id': trip_id, 'status': status,
+                    'payment_count': 0, 'gross_cents': 0, 'fee_cents': 0,
+                    'refund_count': 0, 'refunded_cents': 0
+                }
+            return buckets[key]
+
+        # 支付：按 paid_at 归日
+        paid_day = db.func.date(Payment.paid_at)
+        paid_rows = db.session.query(
+            paid_day,
+            Payment.trip_id,
+            Payment.status,
+            db.func.count(Payment.id),
+            db.func.sum(_gross_cents_expr()),
+            db.func.sum(db.func.coalesce(Payment.fee_cents, 0))
+        ).filter(
+            Payment.paid_at >= range_start,
+            Payment.paid_at < range_end
+        ).group_by(paid_day, Payment.trip_id, Payment.status).all()
+
+        for day, trip_id, status, count, gross, fee in paid_rows:
+            day = _to_date(day)
+            if day not in chunk_set:
+                continue
+            bucket = _bucket(day, trip_id, status or 'unknown')
+            bucket['payment_count'] += int(count or 0)
+            bucket['gross_cents'] += int(gross or 0)
+            bucket['fee_cents'] += int(fee or 0)
+
+        # 退款：按 refunded_at 归日
+        refund_day = db.func.date(Payment.refunded_at)
+        refund_rows = db.session.query(
+            refund_day,
+            Payment.trip_id,
+            Payment.status,
+            db.func.count(Payment.id),
+            db.func.sum(db.func.round(db.func.coalesce(Payment.refunded_amount, 0) * 100))
+        ).filter(
+            Payment.refunded_at >= range_start,
+            Payment.refunded_at < range_end
+        ).group_by(refund_day, Payment.trip_id, Payment.status).all()
+
+        for day, trip_id, status, count, refunded in refund_rows:
+            day = _to_date(day)
+            if day not in chunk_set:
+                continue
+            bucket = _bucket(day, trip_id, status or 'unknown')
+            bucket['refund_count'] += int(count or 0)
+            bucket['refunded_cents'] += int(refunded or 0)
+
+        if buckets:
+            db.session.bulk_insert_mappings(RevenueDaily, list(buckets.values()))
+        written += len(buckets)
+
+    return written
+
+
+def _dirty_days_since(since):
+    """找出 since 之后有支付/退款变化的日期；since 为 None 时返回全部历史日期"""
+    paid_day = db.func.date(Payment.paid_at)
+    refund_day = db.func.date(Payment.refunded_at)
+
+    paid_query = db.session.query(paid_day).filter(Payment.paid_at.isnot(None))
+    refund_query = db.session.query(refund_day).filter(Payment.refunded_at.isnot(None))
+    # 退款会改变 Payment.status，原支付日的状态分组也要重算
+    refunded_paid_query = db.session.query(paid_day).filter(
+        Payment.paid_at.isnot(None),
+        Payment.refunded_at.isnot(None)
+    )
+    if since is not None:
+        paid_query = paid_query.filter(Payment.paid_at >= since)
+        refund_query = refund_query.filter(Payment.refunded_at >= since)
+        refunded_paid_query = refunded_paid_query.filter(Payment.refunded_at >= since)
+
+    days = set()
+    for query in (paid_query, refund_query, refunded_paid_query):
+        days.update(_to_date(row[0]) for row in query.distinct().all() if row[0] is not None)
+    return days
+
+
+def update_revenue_rollup():
+    """
+    增量更新 revenue_daily（由定时任务调用）
+
+    从水位线开始（向前多回看 REVENUE_ROLLUP_OVERLAP_MINUTES，覆盖提交较晚的事务）
+    找出变化的日期并整日重算，最后把水位线推进到本次开始时间。
+    水位线行加锁，多个 worker 同时触发时串行执行。
+
+    Returns:
+        dict: {'days', 'rows', 'watermark'}
+    """
+    run_started = datetime.utcnow()
+    overlap = timedelta(minutes=current_app.config.get('REVENUE_ROLLUP_OVERLAP_MINUTES', 10))
+
+    watermark = RollupWatermark.query.filter_by(name=ROLLUP_NAME).with_for_update().first()
+    if watermark is None:
+        watermark = RollupWatermark(name=ROLLUP_NAME)
+        db.session.add(watermark)
+
+    since = watermark.value - overlap if watermark.value else None
+    days = _dirty_days_since(since)
+    rows = recompute_revenue_days(days)
+
+    watermark.value = run_started
+    db.session.commit()
+
+    return {'days': len(days), 'rows': rows, 'watermark': run_started}
+
+
+def backfill_revenue_daily(start_day=None, end_day=None):
+    """
+    回填指定日期范围（含首尾）的 revenue_daily；不传范围时回填全部历史
+
+    Returns:
+        dict: {'days', 'rows'}
+    """
+    days = _dirty_days_since(None)
+    if start_day:
+        days = {d for d in days if d >= start_day}
+    if end_day:
+        days = {d for d in days if d <= end_day}
+    # 范围内没有支付的日期也要清掉旧行
+    if start_day and end_day:
+        current = start_day
+        while current <= end_day:
+            days.add(current)
+            current += timedelta(days=1)
+
+    rows = recompute_revenue_days(days)
+    return {'days': len(days), 'rows': rows}
+
+
+def _period_start(day, granularity):
+    if granularity == 'week':
+        return day - timedelta(days=day.weekday())
+    if granularity == 'month':
+        return day.replace(day=1)
+    if granularity == 'quarter':
+        return day.replace(month=(day.month - 1) // 3 * 3 + 1, day=1)
+    return day
+
+
+def _period_end(period_start, granularity):
+    if granularity == 'week':
+        return period_start + timedelta(days=6)
+    if granularity in ('month', 'quarter'):
+        months = 1 if granularity == 'month' else 3
+        month_index = period_start.month - 1 + months
+        next_start = period_start.replace(year=period_start.year + month_index // 12, month=month_index % 12 + 1)
+        return next_start - timedelta(days=1)
+    return period_start
+
+
+def get_revenue_series(start_day, end_day, granularity='month', trip_id=None):
+    """
+    按周/月/季度汇总收入、手续费、退款（只读 revenue_daily，不扫描 payments）
+
+    Args:
+        start_day / end_day: 日期范围（含首尾，UTC）
+        granularity: 'day' | 'week' | 'month' | 'quarter'
+        trip_id: 可选，只统计单个行程
+
+    Returns:
+        dict: {'buckets': [...], 'totals': {...}}，金额为最小货币单位（cents）
+    """
+    query = db.session.query(
+        RevenueDaily.day,
+        db.func.sum(RevenueDaily.payment_count),
+        db.func.sum(RevenueDaily.gross_cents),
+        db.func.sum(RevenueDaily.fee_cents),
+        db.func.sum(RevenueDaily.refund_count),
+        db.func.sum(RevenueDaily.refunded_cents)
+    ).filter(
+        RevenueDaily.day >= start_day,
+        RevenueDaily.day <= end_day
+    )
+    if trip_id:
+        query = query.filter(RevenueDaily.trip_id == trip_id)
+    rows = query.group_by(RevenueDaily.day).all()
+
+    def _empty(period_start):
+        return {
+            'period_start': period_start.isoformat(),
+            'period_end': _period_end(period_start, granularity).isoformat(),
+            'payment_count': 0,
+            'gross_cents': 0,
+            'fee_cents': 0,
+            'refund_count': 0,
+            'refunded_cents': 0,
+            'net_cents': 0
+        }
+
+    buckets = {}
+    totals = _empty(start_day)
+    totals['period_end'] = end_day.isoformat()
+
+    for day, payment_count, gross, fee, refund_count, refunded in rows:
+        day = _to_date(day)
+        period_start = _period_start(day, granularity)
+        bucket = buckets.setdefault(period_start, _empty(period_start))
+        for target in (bucket, totals):
+            target['payment_count'] += int(payment_count or 0)
+            target['gross_cents'] += int(gross or 0)
+            target['fee_cents'] += int(fee or 0)
+            target['refund_count'] += int(refund_count or 0)
+            target['refunded_cents'] += int(refunded or 0)
+
+    for target in list(buckets.values()) + [totals]:
+        # 净收入 = 收款 - 手续费 - 退款
+        target['net_cents'] = target['gross_cents'] - target['fee_cents'] - target['refunded_cents']
+
+    return {
+        'buckets': [buckets[key] for key in sorted(buckets.keys())],
+        'totals': totals
+    }
+
+
+def get_revenue_watermark():
+    watermark = db.session.get(RollupWatermark, ROLLUP_NAME)
+    return watermark.value if watermark else None
@@ -6,6 +6,7 @@ Flask路由定义
 from flask import Blueprint, render_template, request, jsonify, redirect, abort, url_for, flash, current_app
 from flask_login import current_user
 import json
+import time
 import stripe
 from app.utils import (
     handle_newsletter_submission,
@@ -15,8 +16,8 @@ from app.utils import (
     verify_installment_token,
 )
 from app.models import (
-    Trip, Client, Payment, Booking, db,
-    TripPackage, TripAddOn, BookingPackage, BookingAddOn, BookingParticipant,
+    Trip, Payment, Booking, db,
+    TripPackage, BookingPackage,
     DiscountCode, CustomQuestion, InstallmentPayment, PendingBooking
 )
 from sqlalchemy.orm import joinedload
@@ -31,6 +32,30 @@ from app.payments import (
     retrieve_payment_intent,
     retrieve_payment_method_card_details,
     calculate_fee,
+    cancel_payment_intent,
+)
+from app.stats import refresh_trip_financial_summary
+from app.trip_pages import get_trip_page_snapshot
+from app.payment_schedule import quote_initial_payment
+from app.payment_status import notify_payment_status, payment_status_version, wait_for_payment_status, long_poll_slot
+from app.stripe_events import record_stripe_event, wake_stripe_event_worker, claim_stripe_object
+from app.bookings import plan_booking_children, materialize_booking_children, bulk_insert, BookingNotCreated
+from app.clients import upsert_client
+from app.discounts import (
+    get_discount_code,
+    discount_code_problem,
+    redeem_discount_code,
+    release_discount_code,
+    release_pending_discount,
+    DiscountCodeUnavailable,
+)
+from app.inventory import (
+    InventoryUnavailable,
+    get_trip_availability,
+    find_unavailable_package,
+    create_holds,
+    convert_holds,
+    release_holds,
 )
 from datetime import datetime, date, timedelta
 
@@ -191,59 +216,24 @@ def trip_detail(slug):
     通用行程详情页路由 - 支持多步骤报名
     根据 URL slug 查找行程，如果找不到则返回 404
     """
-    trip = Trip.query.filter_by(slug=slug).first_or_404()
+    # 每次请求只查 id / status / 版本戳；页面内容来自按 slug 缓存的快照
+    trip_row = db.session.query(Trip.id, Trip.status, Trip.updated_at).filter(Trip.slug == slug).first()
+    if trip_row is None:
+        abort(404)
     
     # 可见性检查：如果状态不是已发布且不是管理员，则返回 404
-    if trip.status != 'published' and not current_user.is_authenticated:
+    if trip_row.status != 'published' and not current_user.is_authenticated:
         abort(404)
     
-    # 获取行程项并按日期排序
-    itinerary_items = trip.itinerary_items.order_by('day_number').all() if trip.itinerary_items else []
-    
-    # 获取 Buyer Info 字段配置
-    buyer_info_fields = trip.buyer_info_fields.order_by('display_order').all() if trip.buyer_info_fields else []
-    
-    # 如果没有配置任何字段，自动创建默认必填字段
-    if not buyer_info_fields:
-        from app.models import BuyerInfoField
-        default_fields = [
-            {'field_name': 'First Name', 'field_type': 'text', 'is_required': True, 'display_order': 0},
-            {'field_name': 'Last Name', 'field_type': 'text', 'is_required': True, 'display_order': 1},
-            {'field_name': 'Email', 'field_type': 'email', 'is_required': True, 'display_order': 2},
-            {'field_name': 'Phone', 'field_type': 'phone', 'is_required': True, 'display_order': 3}
-        ]
-        for df in default_fields:
-            new_field = BuyerInfoField(
-                trip_id=trip.id,
-                field_name=df['field_name'],
-                field_type=df['field_type'],
-                is_required=df['is_required'],
-                display_order=df['display_order']
-            )
-            db.session.add(new_field)
-        db.session.commit()
-        # 重新加载字段
-        buyer_info_fields = trip.buyer_info_fields.order_by('display_order').all()
-    
-    # 获取套餐和附加项
-    packages = trip.packages.filter_by(status='available').all() if trip.packages else []
-    addons = trip.add_ons.all() if trip.add_ons else []
-    custom_questions = trip.questions.all() if trip.questions else []
-
-    package_spots_available = {}
-    for package in packages:
-        if not package.capacity:
-            continue
-        booked = BookingPackage.query.filter(
-            BookingPackage.package_id == package.id,
-            BookingPackage.status.in_(["pending", "deposit_paid", "fully_paid"]),
-        ).count()
-        package_spots_available[package.id] = max(package.capacity - booked, 0)
-        
     form = BookingForm()
     
+    # 提交报名时才加载完整的 Trip 对象（页面渲染只用快照）
+    is_ajax = request.is_json or request.headers.get('X-Requested-With') == 'XMLHttpRequest'
+    if request.method == 'POST' or is_ajax:
+        trip = db.session.get(Trip, trip_row.id)
+    
     # 处理 AJAX 提交（多步骤表单）
-    if request.is_json or request.headers.get('X-Requested-With') == 'XMLHttpRequest':
+    if is_ajax:
         return handle_booking_submission(request, trip)
     
     # 处理传统表单提交（向后兼容）
@@ -251,39 +241,19 @@ def trip_detail(slug):
         # 使用 buyer_email 作为主要邮箱（优先于兼容字段 email）
         buyer_email = form.buyer_email.data or form.email.data
         
-        # 查找现有客户或创建新客户
-        client = Client.query.filter_by(email=buyer_email).first()
-        if not client:
-            # 使用 buyer 信息创建 Client
-            client = Client(
-                name=f"{form.buyer_first_name.data} {form.buyer_last_name.data}".strip() or form.name.data,
-                first_name=form.buyer_first_name.data,
-                last_name=form.buyer_last_name.data,
-                email=buyer_email,
-                phone=form.buyer_phone.data or form.phone.data,
-                address=form.buyer_address.data,
-                city=form.buyer_city.data,
-                state=form.buyer_state.data,
-                zip_code=form.buyer_zip_code.data,
-                country=form.buyer_country.data
-            )
-            db.session.add(client)
-        else:
-            # 更新现有客户信息
-            client.name = f"{form.buyer_first_name.data} {form.buyer_last_name.data}".strip() or client.name
-            client.first_name = form.buyer_first_name.data or client.first_name
-            client.last_name = form.buyer_last_name.data or client.last_name
-            client.phone = form.buyer_phone.data or form.phone.data or client.phone
-            if form.buyer_address.data:
-                client.address = form.buyer_address.data
-            if form.buyer_city.data:
-                client.city = form.buyer_city.data
-            if form.buyer_state.data:
-                client.state = form.buyer_state.data
-            if form.buyer_zip_code.data:
-                client.zip_code = form.buyer_zip_code.data
-            if form.buyer_country.data:
-                client.country = form.buyer_country.data
+        # 按规范化邮箱查找或创建客户（一条 upsert；已有客户用非空的新资料更新）
+        client = upsert_client(
+            buyer_email,
+            name=f"{form.buyer_first_name.data} {form.buyer_last_name.data}".strip() or form.name.data,
+            first_name=form.buyer_first_name.data,
+            last_name=form.buyer_last_name.data,
+            phone=form.buyer_phone.data or form.phone.data,
+            address=form.buyer_address.data,
+            city=form.buyer_city.data,
+            state=form.buyer_state.data,
+            zip_code=form.buyer_zip_code.data,
+            country=form.buyer_country.data
+        )
         db.session.flush()
         
         # 创建 Booking 记录（包含完整的 Buyer Info）
@@ -322,6 +292,8 @@ def trip_detail(slug):
             status='pending'
         )
         db.session.add(payment)
+        db.session.flush()
+        refresh_trip_financial_summary(trip.id)
         db.session.commit()
         
         # 创建 Stripe Checkout Session
@@ -345,18 +317,52 @@ def trip_detail(slug):
         # flash('测试模式：报名信息已保存，模拟支付成功！')
         return redirect(url_for('main.booking_success'))
 
+    snapshot = get_trip_page_snapshot(trip_row.id, slug, trip_row.updated_at)
+    if snapshot is None:
+        abort(404)
+
+    # 剩余名额：一次查询读出全部套餐的库存计数（短 TTL 缓存），页面加载后由 availability 接口刷新
+    package_spots_available = {
+        package_id: available
+        for package_id, available in get_trip_availability(trip_row.id).items()
+        if available is not None
+    }
+
     return render_template('booking/trip_booking.html',
-                         trip=trip,
+                         trip=snapshot['trip'],
                          form=form,
-                         itinerary_items=itinerary_items,
-                         buyer_info_fields=buyer_info_fields,
-                         packages=packages,
-                         addons=addons,
-                         custom_questions=custom_questions,
+                         itinerary_items=snapshot['itinerary_items'],
+                         buyer_info_fields=snapshot['buyer_info_fields'],
+                         packages=snapshot['packages'],
+                         addons=snapshot['addons'],
+                         custom_questions=snapshot['custom_questions'],
                          package_spots_available=package_spots_available,
                          publishable_key=current_app.config.get('STRIPE_PUBLISHABLE_KEY'))
 
 
+@bp.route('/trips/<slug>/availability')
+def trip_availability(slug):
+    """
+    套餐剩余名额 JSON（报名组件定时刷新用）
+
+    Returns:
+        {'success': True, 'trip_id': ..., 'packages': {package_id: 剩余名额或 null（不限量）}}
+    """
+    trip = db.session.query(Trip.id, Trip.status).filter(Trip.slug == slug).first()
+    if not trip or (trip.status != 'published' and not current_user.is_authenticated):
+        abort(404)
+    
+    availability = get_trip_availability(trip.id)
+    response = jsonify({
+        'success': True,
+        'trip_id': trip.id,
+        'packages': {str(package_id): available for package_id, available in availability.items()}
+    })
+    response.cache_control.public = True
+    response.cache_control.max_age = current_app.config.get('AVAILABILITY_CACHE_TTL', 5)
+    return response
+
+
 def handle_booking_submission(request, trip):
     """
     处理多步骤报名提交
@@ -390,115 +396,26 @@ def handle_booking_submission(request, trip):
         if not buyer_info.get('email'):
             return jsonify({'success': False, 'error': 'Buyer email is required'}), 400
         
-        # 检查库存（不锁定，只检查）
-        for pkg_data in packages_data:
-            package = TripPackage.query.get(pkg_data.get('package_id'))
-            if not package:
-                continue
-            
-            if package.capacity:
-                # 计算已售名额（只计算已支付成功的预订）
-                spots_sold = BookingPackage.query.filter(
-                    BookingPackage.package_id == package.id,
-                    BookingPackage.status.in_(['deposit_paid', 'fully_paid'])
-                ).with_entities(
-                    db.func.sum(BookingPackage.quantity)
-                ).scalar() or 0
-                
-                # 检查库存是否足够
-                if spots_sold + pkg_data.get('quantity', 1) > package.capacity:
-                    return jsonify({
-                        'success': False, 
-                        'error': f'Package "{package.name}" is sold out'
-                    }), 400
+        # 预检查库存（读库存计数，不加锁）；真正的锁定在写入 PendingBooking 时原子完成
+        unavailable = find_unavailable_package(packages_data)
+        if unavailable:
+            package = TripPackage.query.get(unavailable[0])
+            return jsonify({
+                'success': False, 
+                'error': f'Package "{package.name if package else unavailable[0]}" is sold out'
+            }), 400
         
         # 计算首付款金额（使用追缴模式）
-        # 直接计算，不创建临时Booking对象
-        deposit_amount = 0.0
-        overdue_installments_total = 0.0
-        addons_total = 0.0
+        # 直接按报名数据计算，不创建临时Booking对象；套餐付款计划已预编译（整数 cents + 二分查找）
         today = date.today()
-        overdue_details = []
-        
-        # 计算套餐金额和过期分期
-        for pkg_data in packages_data:
-            package = TripPackage.query.get(pkg_data.get('package_id'))
-            if not package:
-                continue
-            
-            quantity = pkg_data.get('quantity', 1)
-            pkg_payment_plan = pkg_data.get('payment_plan_type', 'full')
-            
-            current_app.logger.debug(
-                f"Processing package {package.id} ({package.name}): "
-                f"payment_plan_type={pkg_payment_plan}, quantity={quantity}, "
-                f"has_payment_plan_config={bool(package.payment_plan_config)}"
-            )
-            
-            if pkg_payment_plan == 'deposit_installment' and package.payment_plan_config:
-                config = package.payment_plan_config
-                if config and config.get('enabled'):
-                    # 获取定金金额
-                    deposit = config.get('deposit_amount', 0.0) or config.get('deposit', 0.0)
-                    deposit_amount += float(deposit) * quantity
-                    
-                    # 检查过期分期
-                    installments = config.get('installments', [])
-                    current_app.logger.debug(
-                        f"Package {package.id} has {len(installments)} installments, today={today}"
-                    )
-                    for inst_data in installments:
-                        due_date_str = inst_data.get('date')
-                        if not due_date_str:
-                            continue
-                        
-                        try:
-                            due_date = datetime.strptime(due_date_str, '%Y-%m-%d').date()
-                            inst_amount = float(inst_data.get('amount', 0.0))
-                            
-                            current_app.logger.debug(
-                                f"Checking installment: due_date={due_date_str} ({due_date}), "
-                                f"amount={inst_amount}, today={today}, is_overdue={due_date < today}"
-                            )
-                            
-                            # 如果到期日期 < 今天，则过期，需要合并到首付款
-                            if due_date < today:
-                                overdue_amount = inst_amount * quantity
-                                overdue_installments_total += overdue_amount
-                                overdue_details.append({
-                                    'package_name': package.name,
-                                    'due_date': due_date_str,
-                                    'amount': inst_amount,
-                                    'quantity': quantity,
-                                    'total': overdue_amount
-                                })
-                                current_app.logger.info(
-                                    f"Found overdue installment: package={package.name}, "
-                                    f"due_date={due_date_str}, amount={inst_amount}, "
-                                    f"quantity={quantity}, total={overdue_amount}"
-                                )
-                        except (ValueError, TypeError) as e:
-                            current_app.logger.error(f"Invalid installment date or amount: {due_date_str}, {str(e)}")
-                            continue
-                else:
-                    # 如果没有分期付款计划，使用套餐全价作为首付款
-                    if package.price:
-                        deposit_amount += float(package.price) * quantity
-            else:
-                # 全款支付：使用套餐全价
-                if package.price:
-                    deposit_amount += float(package.price) * quantity
-        
-        # 计算附加项金额
-        for addon_data in addons_data:
-            addon = TripAddOn.query.get(addon_data.get('addon_id'))
-            if addon and addon.price:
-                addon_price = float(addon.price)
-                quantity = addon_data.get('quantity', 1)
-                addons_total += addon_price * quantity
+        quote = quote_initial_payment(packages_data, addons_data, today)
+        deposit_amount = quote['deposit_cents'] / 100.0
+        overdue_installments_total = quote['overdue_cents'] / 100.0
+        addons_total = quote['addons_cents'] / 100.0
+        overdue_details = quote['overdue_details']
         
         # 计算首付款总额：定金 + 过期分期 + 附加项
-        gross_amount = deposit_amount + overdue_installments_total + addons_total
+        gross_amount = quote['gross_cents'] / 100.0
         
         # 验证并应用折扣码（只在首次支付时扣减）
         discount_code_id = None
@@ -506,13 +423,15 @@ def handle_booking_submission(request, trip):
         discount_code_info = None
         
         if discount_code_str:
-            discount_code = DiscountCode.query.filter(
-                db.func.upper(DiscountCode.code) == discount_code_str.upper()
-            ).first()
+            # 走进程内缓存 + code 唯一索引；使用次数在创建 PendingBooking 时原子占用
+            discount_code = get_discount_code(discount_code_str)
             
             if discount_code:
-                # 检查是否适用于该行程
-                if discount_code.trip_id is None or discount_code.trip_id == trip.id:
+                # 检查是否适用于该行程、是否过期或用完
+                problem = discount_code_problem(discount_code, trip.id)
+                if problem:
+                    current_app.logger.info(f"Discount code {discount_code.code} not applied: {problem}")
+                else:
                     discount_amount = discount_code.calculate_discount(gross_amount)
                     discount_code_id = discount_code.id
                     discount_code_info = {
@@ -566,6 +485,7 @@ def handle_booking_submission(request, trip):
             'discount_code_id': discount_code_id,
             'discount_amount': discount_amount,
             'discount_code_info': discount_code_info,
+            'discount_redeemed': bool(discount_code_id),  # 已占用一次使用次数（取消 / 过期时归还）
             'payment_method': payment_method,
             'payment_flow': booking_data.get('payment_flow', 'embedded'),
             'base_amount_cents': base_amount_cents,
@@ -626,12 +546,39 @@ def handle_booking_submission(request, trip):
                 status='pending'
             )
             db.session.add(pending_booking)
+            db.session.flush()
+            
+            # 锁定名额（与 PendingBooking 同一事务，随 expires_at 过期）
+            create_holds(pending_booking, packages_data)
+            # 占用折扣码（条件 UPDATE，超出 max_uses 或已过期则整单回滚）
+            if discount_code_id and not redeem_discount_code(discount_code_id):
+                raise DiscountCodeUnavailable(discount_code_id)
             db.session.commit()
             
             current_app.logger.info(
                 f"PendingBooking created: id={pending_booking.id}, payment_intent_id={payment_intent_id}, trip_id={trip.id}"
             )
             
+        except InventoryUnavailable as e:
+            db.session.rollback()
+            current_app.logger.info(
+                f"Inventory hold failed for trip {trip.id}: package={e.package_id}, quantity={e.requested}"
+            )
+            # 名额已被抢完，取消刚创建的 Payment Intent
+            cancel_payment_intent(payment_intent_id)
+            package = TripPackage.query.get(e.package_id)
+            return jsonify({
+                'success': False,
+                'error': f'Package "{package.name if package else e.package_id}" is sold out'
+            }), 400
+        except DiscountCodeUnavailable as e:
+            db.session.rollback()
+            current_app.logger.info(f"Discount code {e.discount_code_id} exhausted or expired at checkout for trip {trip.id}")
+            cancel_payment_intent(payment_intent_id)
+            return jsonify({
+                'success': False,
+                'error': 'This discount code is no longer available. Please remove it and try again.'
+            }), 400
         except Exception as e:
             db.session.rollback()
             current_app.logger.error(
@@ -858,54 +805,11 @@ def api_payment_quote():
             # 如果没有存储的金额（None），重新计算（使用追缴模式）
             # 注意：base_amount_cents=0 是有效值（例如折扣后金额为0），不应重新计算
             # 从booking_data中重新计算首付款金额
-            packages_data = booking_data.get('packages', [])
-            addons_data = booking_data.get('addons', [])
-            deposit_amount = 0.0
-            overdue_installments_total = 0.0
-            addons_total = 0.0
-            today = date.today()
-            
-            # 重新计算（使用追缴模式）
-            for pkg_data in packages_data:
-                package = TripPackage.query.get(pkg_data.get('package_id'))
-                if not package:
-                    continue
-                
-                quantity = pkg_data.get('quantity', 1)
-                pkg_payment_plan = pkg_data.get('payment_plan_type', 'full')
-                
-                if pkg_payment_plan == 'deposit_installment' and package.payment_plan_config:
-                    config = package.payment_plan_config
-                    if config and config.get('enabled'):
-                        deposit = config.get('deposit_amount', 0.0) or config.get('deposit', 0.0)
-                        deposit_amount += float(deposit) * quantity
-                        
-                        installments = config.get('installments', [])
-                        for inst_data in installments:
-                            due_date_str = inst_data.get('date')
-                            if not due_date_str:
-                                continue
-                            try:
-                                due_date = datetime.strptime(due_date_str, '%Y-%m-%d').date()
-                                inst_amount = float(inst_data.get('amount', 0.0))
-                                if due_date < today:
-                                    overdue_installments_total += inst_amount * quantity
-                            except (ValueError, TypeError):
-                                continue
-                    else:
-                        if package.price:
-                            deposit_amount += float(package.price) * quantity
-                else:
-                    if package.price:
-                        deposit_amount += float(package.price) * quantity
-            
-            for addon_data in addons_data:
-                addon = TripAddOn.query.get(addon_data.get('addon_id'))
-                if addon and addon.price:
-                    addons_total += float(addon.price) * addon_data.get('quantity', 1)
-            
-            base_amount = deposit_amount + overdue_installments_total + addons_total
-            base_amount_cents = int(round(base_amount * 100))
+            quote = quote_initial_payment(booking_data.get('packages', []), booking_data.get('addons', []))
+            deposit_amount = quote['deposit_cents'] / 100.0
+            overdue_installments_total = quote['overdue_cents'] / 100.0
+            addons_total = quote['addons_cents'] / 100.0
+            base_amount_cents = quote['gross_cents']
             
             # 更新PendingBooking中的金额
             pending_booking.booking_data['base_amount_cents'] = base_amount_cents
@@ -1012,21 +916,32 @@ def api_payment_quote():
     })
 
 
-@bp.route('/api/payment/intent', methods=['POST'])
-def api_payment_intent():
-    data = request.get_json(silent=True) or {}
+def _apply_payment_quote(data):
+    """
+    计算报价（基础金额 + 手续费）并更新对应的 PaymentIntent 金额和 metadata
+
+    Args:
+        data: 请求 JSON（booking_id / installment_id / payment_intent_id、payment_method_id、payment_plan、payment_step）
+
+    Returns:
+        tuple: (响应 dict, HTTP 状态码)；成功时响应包含完整报价和 payment_intent_id
+    """
     booking_id = data.get('booking_id')
     installment_id = data.get('installment_id')
     payment_intent_id = data.get('payment_intent_id')  # 新增：支持通过payment_intent_id更新
     payment_method_id = data.get('payment_method_id')
     payment_plan = data.get('payment_plan', 'full')
     payment_step = data.get('payment_step')
+    booking = None
+    installment = None
+    payment = None
+    pending_booking = None
 
     if not payment_method_id:
-        return jsonify({'error': 'missing_parameters', 'message': 'payment_method_id is required'}), 400
+        return {'error': 'missing_parameters', 'message': 'payment_method_id is required'}, 400
     
     if not booking_id and not installment_id and not payment_intent_id:
-        return jsonify({'error': 'missing_parameters', 'message': 'booking_id, installment_id, or payment_intent_id is required'}), 400
+        return {'error': 'missing_parameters', 'message': 'booking_id, installment_id, or payment_intent_id is required'}, 400
 
     # 优先处理 payment_intent_id（新流程：首次支付，还没有Booking）
     if payment_intent_id:
@@ -1037,13 +952,13 @@ def api_payment_intent():
         ).first()
         
         if not pending_booking:
-            return jsonify({'error': 'pending_booking_not_found'}), 404
+            return {'error': 'pending_booking_not_found'}, 404
         
         booking_data = pending_booking.booking_data
         base_amount_cents = booking_data.get('base_amount_cents')
         
         if base_amount_cents is None:
-            return jsonify({'error': 'invalid_amount', 'message': 'No base amount found in pending booking'}), 400
+            return {'error': 'invalid_amount', 'message': 'No base amount found in pending booking'}, 400
         
         current_app.logger.info(
             f"Updating Payment Intent {payment_intent_id} with base_amount_cents={base_amount_cents}"
@@ -1059,7 +974,7 @@ def api_payment_intent():
         
         installment = InstallmentPayment.query.get(installment_id)
         if not installment:
-            return jsonify({'error': 'installment_not_found'}), 404
+            return {'error': 'installment_not_found'}, 404
         
         # 使用 installment 的金额
         base_amount_cents = int(round(float(installment.amount) * 100))
@@ -1074,7 +989,7 @@ def api_payment_intent():
         ).first()
         
         if not payment or not payment.stripe_payment_intent_id:
-            return jsonify({'error': 'payment_intent_not_found'}), 404
+            return {'error': 'payment_intent_not_found'}, 404
         
         payment_intent_id = payment.stripe_payment_intent_id
         
@@ -1085,7 +1000,7 @@ def api_payment_intent():
     elif booking_id:
         booking = Booking.query.get(booking_id)
         if not booking:
-            return jsonify({'error': 'booking_not_found'}), 404
+            return {'error': 'booking_not_found'}, 404
         
         # 获取支付计划类型（从booking的payment_plan_type推断，或使用默认值）
         payment_plan = payment_plan or 'full'
@@ -1099,7 +1014,7 @@ def api_payment_intent():
             total_info = calculate_booking_total(booking)
             remaining_amount = max((total_info['total'] or 0.0) - (booking.amount_paid or 0.0), 0.0)
             if remaining_amount <= 0:
-                return jsonify({'error': 'no_balance_due'}), 400
+                return {'error': 'no_balance_due'}, 400
             base_amount_cents = int(round(remaining_amount * 100))
         elif payment_step == 'initial' or (not payment_step and booking.amount_paid == 0):
             # 首次支付：使用追缴模式计算首付款（包括过期分期）
@@ -1128,19 +1043,28 @@ def api_payment_intent():
         if not payment:
             payment = payments_query.first()
         if not payment or not payment.stripe_payment_intent_id:
-            return jsonify({'error': 'payment_intent_not_found'}), 404
+            return {'error': 'payment_intent_not_found'}, 404
         if payment.status != 'pending':
-            return jsonify({'error': 'payment_not_pending'}), 409
+            return {'error': 'payment_not_pending'}, 409
         payment_intent_id = payment.stripe_payment_intent_id
     
     else:
         # 这种情况理论上不应该发生（所有参数都为空已在前面检查）
-        return jsonify({'error': 'missing_parameters'}), 400
+        return {'error': 'missing_parameters'}, 400
 
     funding, brand = retrieve_payment_method_card_details(payment_method_id)
     fee_cents = calculate_fee(base_amount_cents, funding, brand)
     tax_amount_cents = 0
     final_amount_cents = base_amount_cents + fee_cents + tax_amount_cents
+    quote = {
+        'payment_intent_id': payment_intent_id,
+        'funding': funding,
+        'brand': brand,
+        'base_amount': base_amount_cents,
+        'fee': fee_cents,
+        'tax_amount': tax_amount_cents,
+        'final_amount': final_amount_cents,
+    }
 
     # 检查是否已经是最新的（避免重复更新）
     if booking_id and payment:
@@ -1149,10 +1073,7 @@ def api_payment_intent():
             and payment.final_amount_cents == final_amount_cents
             and payment.status == 'pending'
         ):
-            return jsonify({
-                'payment_intent_id': payment_intent_id,
-                'final_amount': final_amount_cents,
-            })
+            return quote, 200
         source = 'installment_payoff' if payment_step == 'payoff' else 'trip_booking'
         quote_metadata = build_booking_metadata(booking, {
             'payment_flow': 'payment_intent',
@@ -1169,8 +1090,9 @@ def api_payment_intent():
             'base_amount': base_amount_cents,
         })
     elif payment_intent_id and not booking_id:
-        # 新流程：使用PendingBooking数据构建metadata
-        pending_booking = PendingBooking.query.filter_by(payment_intent_id=payment_intent_id).first()
+        # 新流程：使用PendingBooking数据构建metadata（前面已加载过则直接复用）
+        if pending_booking is None:
+            pending_booking = PendingBooking.query.filter_by(payment_intent_id=payment_intent_id).first()
         if pending_booking:
             booking_data = pending_booking.booking_data
             quote_metadata = {
@@ -1206,10 +1128,7 @@ def api_payment_intent():
                 and payment.final_amount_cents == final_amount_cents
                 and payment.status == 'pending'
             ):
-                return jsonify({
-                    'payment_intent_id': payment_intent_id,
-                    'final_amount': final_amount_cents,
-                })
+                return quote, 200
         quote_metadata = build_booking_metadata(installment.booking, {
             'payment_flow': 'installment',
             'payment_plan': 'installment',
@@ -1232,7 +1151,7 @@ def api_payment_intent():
         quote_metadata
     )
     if not updated_intent:
-        return jsonify({'error': 'payment_intent_update_failed'}), 500
+        return {'error': 'payment_intent_update_failed'}, 500
 
     # 更新Payment记录（如果存在）
     if booking_id and payment:
@@ -1295,10 +1214,7 @@ def api_payment_intent():
             payment.payment_metadata = quote_metadata
             db.session.commit()
 
-    return jsonify({
-        'payment_intent_id': payment_intent_id,
-        'final_amount': final_amount_cents,
-    })
+    return quote, 200
 
 
 @bp.route('/booking/success')
@@ -1343,88 +1259,124 @@ def payment_pending():
     )
 
 
-@bp.route('/api/payment/status')
-def api_payment_status():
-    booking_id = request.args.get('booking_id', type=int)
-    payment_intent_id = request.args.get('payment_intent_id')
+@bp.route('/api/payment/intent', methods=['POST'])
+def api_payment_intent():
+    """更新 PaymentIntent 金额（旧接口，保留兼容；新结账流程使用 /api/payment/checkout）"""
+    result, status = _apply_payment_quote(request.get_json(silent=True) or {})
+    if status != 200:
+        return jsonify(result), status
+    return jsonify({
+        'payment_intent_id': result['payment_intent_id'],
+        'final_amount': result['final_amount'],
+    })
 
-    payment = None
+
+@bp.route('/api/payment/checkout', methods=['POST'])
+def api_payment_checkout():
+    """
+    报价 + 更新 PaymentIntent 合并为一次请求（下单时调用）
+
+    参数与 /api/payment/intent 相同；返回完整报价：
+    {'payment_intent_id', 'funding', 'brand', 'base_amount', 'fee', 'tax_amount', 'final_amount'}（cents）
+    """
+    result, status = _apply_payment_quote(request.get_json(silent=True) or {})
+    return jsonify(result), status
+
+
+def _payment_status_response(payment):
+    redirect_url = None
+    if payment.status == 'succeeded' and payment.booking_id:
+        redirect_url = url_for('main.booking_success', booking_id=payment.booking_id, _external=True)
+    return {
+        'status': payment.status or 'pending',
+        'booking_id': payment.booking_id,
+        'payment_intent_id': payment.stripe_payment_intent_id,
+        'redirect_url': redirect_url,
+    }
+
+
+def _find_status_payment(booking_id, payment_intent_id):
     if payment_intent_id:
-        payment = Payment.query.filter_by(stripe_payment_intent_id=payment_intent_id).first()
-    elif booking_id:
-        payment = Payment.query.filter(
+        return Payment.query.filter_by(stripe_payment_intent_id=payment_intent_id).first()
+    if booking_id:
+        return Payment.query.filter(
             Payment.booking_id == booking_id,
             Payment.stripe_payment_intent_id.isnot(None)
         ).order_by(Payment.created_at.desc()).first()
+    return None
+
+
+def _read_payment_status(booking_id, payment_intent_id):
+    """
+    只读数据库判断支付状态
+
+    Returns:
+        dict: 已有结果时返回响应内容；仍在等待 webhook 时返回 None
+    """
+    payment = _find_status_payment(booking_id, payment_intent_id)
+    if payment:
+        if payment.status == 'pending':
+            return None
+        return _payment_status_response(payment)
+
+    if payment_intent_id:
+        pending_booking = PendingBooking.query.filter_by(payment_intent_id=payment_intent_id).first()
+        if pending_booking and pending_booking.status == 'cancelled':
+            return {'status': 'failed', 'payment_intent_id': payment_intent_id}
+
+    # 检查是否是 $0 订单（有 Booking 但没有 Payment）
+    if booking_id:
+        booking = Booking.query.get(booking_id)
+        if booking and booking.status in ('deposit_paid', 'fully_paid'):
+            return {
+                'status': 'succeeded',
+                'booking_id': booking_id,
+                'payment_intent_id': payment_intent_id,
+                'redirect_url': url_for('main.booking_success', booking_id=booking_id, _external=True),
+            }
+    return None
+
+
+def _reconcile_payment_status(booking_id, payment_intent_id):
+    """
+    等待结束仍未收到 webhook 结果时，向 Stripe 查询一次 PaymentIntent（webhook 延迟或丢失时的兜底）
+    """
+    payment = _find_status_payment(booking_id, payment_intent_id)
 
-    # 如果没有Payment记录，检查PendingBooking（新流程：首次支付）
     if not payment and payment_intent_id:
         pending_booking = PendingBooking.query.filter_by(
             payment_intent_id=payment_intent_id
         ).first()
-        
-        if pending_booking:
-            # 如果 PendingBooking 已完成，说明 Webhook 已处理，等待 Payment 记录出现
-            if pending_booking.status == 'completed':
-                # 等待一下让 Webhook 完成 Payment 记录创建
-                import time
-                time.sleep(0.5)
-                payment = Payment.query.filter_by(stripe_payment_intent_id=payment_intent_id).first()
-                if not payment:
-                    # 仍在处理中，返回 pending
-                    return jsonify({'status': 'pending', 'payment_intent_id': payment_intent_id}), 200
-            elif pending_booking.status == 'pending':
-                # 直接查询Stripe API检查Payment Intent状态
-                intent = retrieve_payment_intent(payment_intent_id)
-                if intent and intent.get('status') == 'succeeded':
-                    # 再次检查 Payment 记录是否已被 webhook 创建（防止竞态条件）
-                    payment = Payment.query.filter_by(stripe_payment_intent_id=payment_intent_id).first()
-                    if not payment:
-                        # 等待一下，给 Webhook 一个机会处理
-                        import time
-                        time.sleep(1)
-                        db.session.expire_all()  # 刷新 session 缓存
-                        payment = Payment.query.filter_by(stripe_payment_intent_id=payment_intent_id).first()
-                        
-                        if not payment:
-                            # 支付成功，Webhook 可能还没处理，尝试创建
-                            current_app.logger.info(
-                                f"Payment Intent {payment_intent_id} succeeded, creating Booking from PendingBooking (fallback)"
-                            )
-                            try:
-                                handle_booking_payment_intent_succeeded(intent)
-                            except Exception as e:
-                                db.session.rollback()
-                                current_app.logger.warning(f"Error creating booking (may already exist): {str(e)}")
-                            # 重新查询Payment记录
-                            payment = Payment.query.filter_by(stripe_payment_intent_id=payment_intent_id).first()
-                    else:
-                        current_app.logger.info(f"Payment for {payment_intent_id} already exists (created by webhook)")
-                elif intent and intent.get('status') in {'requires_payment_method', 'canceled', 'requires_action'}:
-                    # 支付失败或需要操作
-                    return jsonify({
-                        'status': 'failed' if intent.get('status') in {'requires_payment_method', 'canceled'} else 'requires_action',
-                        'payment_intent_id': payment_intent_id,
-                    }), 200
-                else:
-                    # 仍在处理中
-                    return jsonify({'status': 'pending', 'payment_intent_id': payment_intent_id}), 200
+        # PendingBooking 已完成说明 webhook 正在写入 Payment，下次轮询即可读到
+        if not pending_booking or pending_booking.status not in ('pending', 'expired'):
+            return {'status': 'pending', 'payment_intent_id': payment_intent_id}
+
+        intent = retrieve_payment_intent(payment_intent_id)
+        if intent and intent.get('status') == 'succeeded':
+            # 支付成功，Webhook 可能还没处理，尝试创建
+            current_app.logger.info(
+                f"Payment Intent {payment_intent_id} succeeded, creating Booking from PendingBooking (fallback)"
+            )
+            try:
+                handle_booking_payment_intent_succeeded(intent)
+            except Exception as e:
+                db.session.rollback()
+                current_app.logger.warning(f"Error creating booking (may already exist): {str(e)}")
+            payment = Payment.query.filter_by(stripe_payment_intent_id=payment_intent_id).first()
+        elif intent and intent.get('status') in {'requires_payment_method', 'canceled', 'requires_action'}:
+            # 支付失败或需要操作
+            return {
+                'status': 'failed' if intent.get('status') in {'requires_payment_method', 'canceled'} else 'requires_action',
+                'payment_intent_id': payment_intent_id,
+            }
 
     if not payment:
-        # 检查是否是 $0 订单（有 Booking 但没有 Payment）
-        if booking_id:
-            booking = Booking.query.get(booking_id)
-            if booking and booking.status in ('deposit_paid', 'fully_paid'):
-                # $0 订单已成功
-                return jsonify({
-                    'status': 'succeeded',
-                    'booking_id': booking_id,
-                    'payment_intent_id': payment_intent_id,
-                    'redirect_url': url_for('main.booking_success', booking_id=booking_id, _external=True),
-                }), 200
-        return jsonify({'status': 'pending', 'payment_intent_id': payment_intent_id}), 200
-
-    # 如果Payment状态是pending，再次检查Stripe状态
+        return _read_payment_status(booking_id, payment_intent_id) or {
+            'status': 'pending',
+            'payment_intent_id': payment_intent_id
+        }
+
+    # 如果Payment状态是pending，检查Stripe状态
     if payment.status == 'pending' and payment.stripe_payment_intent_id:
         intent = retrieve_payment_intent(payment.stripe_payment_intent_id)
         if intent and intent.get('status') == 'succeeded':
@@ -1441,18 +1393,61 @@ def api_payment_status():
     # 重新查询以获取最新状态
     db.session.expire_all()
     payment = Payment.query.filter_by(id=payment.id).first()
-    
-    # 构建 redirect_url
-    redirect_url = None
-    if payment.status == 'succeeded' and payment.booking_id:
-        redirect_url = url_for('main.booking_success', booking_id=payment.booking_id, _external=True)
+    return _payment_status_response(payment)
 
-    return jsonify({
-        'status': payment.status or 'pending',
-        'booking_id': payment.booking_id,
-        'payment_intent_id': payment.stripe_payment_intent_id,
-        'redirect_url': redirect_url,
-    }), 200
+
+@bp.route('/api/payment/status')
+def api_payment_status():
+    """
+    支付状态（长轮询）
+
+    参数:
+    - booking_id / payment_intent_id
+    - wait: 最多等待秒数（默认 0，立即返回；上限 PAYMENT_STATUS_MAX_WAIT）
+
+    等待期间不 sleep：本进程的 webhook 处理器提交后立即唤醒，其他 worker 的结果由定期的数据库复查发现。
+    等待结束仍未确认时才向 Stripe 查询一次。
+    本进程同时等待的请求已达 PAYMENT_STATUS_MAX_WAITERS 时不等待，返回 pending 和 retry_after（秒）。
+    """
+    booking_id = request.args.get('booking_id', type=int)
+    payment_intent_id = request.args.get('payment_intent_id') or None
+    if not booking_id and not payment_intent_id:
+        return jsonify({'status': 'pending', 'payment_intent_id': None}), 200
+
+    max_wait = current_app.config.get('PAYMENT_STATUS_MAX_WAIT', 5)
+    recheck = current_app.config.get('PAYMENT_STATUS_RECHECK_SECONDS', 1)
+    wait = max(0.0, min(request.args.get('wait', 0, type=float) or 0.0, max_wait))
+
+    version = payment_status_version(payment_intent_id, booking_id)
+    result = _read_payment_status(booking_id, payment_intent_id)
+    if result is not None or wait <= 0:
+        if result is None:
+            result = _reconcile_payment_status(booking_id, payment_intent_id)
+        return jsonify(result), 200
+
+    with long_poll_slot(current_app.config.get('PAYMENT_STATUS_MAX_WAITERS', 2)) as acquired:
+        if not acquired:
+            # 等待名额用完：立即返回，客户端稍后重试，不占用线程
+            return jsonify({
+                'status': 'pending',
+                'payment_intent_id': payment_intent_id,
+                'retry_after': current_app.config.get('PAYMENT_STATUS_BUSY_RETRY_SECONDS', 2)
+            }), 200
+
+        deadline = time.monotonic() + wait
+        while result is None:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            if wait_for_payment_status(version, min(remaining, recheck), payment_intent_id, booking_id):
+                version = payment_status_version(payment_intent_id, booking_id)
+            # 结束当前读事务，才能读到其他连接刚提交的数据
+            db.session.rollback()
+            result = _read_payment_status(booking_id, payment_intent_id)
+
+    if result is None:
+        result = _reconcile_payment_status(booking_id, payment_intent_id)
+    return jsonify(result), 200
 
 
 @bp.route('/api/discount/validate', methods=['POST'])
@@ -1467,7 +1462,7 @@ def api_validate_discount():
     """
     data = request.get_json(silent=True) or {}
     
-    code = data.get('code', '').strip().upper()
+    code = DiscountCode.normalize_code(data.get('code', ''))
     trip_id = data.get('trip_id')
     order_amount = float(data.get('order_amount', 0) or 0)
     
@@ -1477,10 +1472,8 @@ def api_validate_discount():
             'message': 'Please enter a discount code'
         }), 200
     
-    # 查找折扣码
-    discount_code = DiscountCode.query.filter(
-        db.func.upper(DiscountCode.code) == code
-    ).first()
+    # 查找折扣码（进程内缓存，未命中时按 code 唯一索引查询）
+    discount_code = get_discount_code(code)
     
     if not discount_code:
         return jsonify({
@@ -1488,11 +1481,12 @@ def api_validate_discount():
             'message': 'Invalid discount code'
         }), 200
     
-    # 检查是否适用于该行程
-    if discount_code.trip_id and trip_id and discount_code.trip_id != int(trip_id):
+    # 检查是否适用于该行程、是否过期或用完
+    problem = discount_code_problem(discount_code, trip_id)
+    if problem:
         return jsonify({
             'valid': False,
-            'message': 'This discount code is not valid for this trip'
+            'message': problem
         }), 200
     
     # 计算折扣金额
@@ -1550,6 +1544,32 @@ def api_apply_discount():
         old_base_amount_cents = booking_data.get('base_amount_cents', 0)
         gross_amount = (old_base_amount_cents / 100) + old_discount
     
+    try:
+        discount_code_id = int(discount_code_id) if discount_code_id else None
+    except (TypeError, ValueError):
+        return jsonify({'success': False, 'message': 'Invalid discount code'}), 400
+    
+    redeemed_code_id = booking_data.get('discount_code_id') if booking_data.get('discount_redeemed') else None
+    
+    # 折扣金额按服务端的折扣码重新计算
+    if discount_code_id:
+        discount_code = db.session.get(DiscountCode, discount_code_id)
+        problem = discount_code_problem(
+            discount_code, pending_booking.trip_id, check_usage=discount_code_id != redeemed_code_id
+        ) if discount_code else 'Invalid discount code'
+        if problem:
+            return jsonify({'success': False, 'message': problem}), 400
+        discount_amount = discount_code.calculate_discount(gross_amount)
+    else:
+        discount_amount = 0.0
+    
+    # 换码时占用新码、归还旧码（条件 UPDATE，与 PendingBooking 同一事务）
+    if discount_code_id != redeemed_code_id:
+        if discount_code_id and not redeem_discount_code(discount_code_id):
+            db.session.rollback()
+            return jsonify({'success': False, 'message': 'This discount code has reached its usage limit'}), 400
+        release_discount_code(redeemed_code_id)
+    
     # 计算新的 base_amount（应用折扣后）
     new_base_amount = max(0, gross_amount - discount_amount)
     new_base_amount_cents = int(round(new_base_amount * 100))
@@ -1557,6 +1577,7 @@ def api_apply_discount():
     # 更新 booking_data
     booking_data['discount_code_id'] = discount_code_id
     booking_data['discount_amount'] = discount_amount
+    booking_data['discount_redeemed'] = bool(discount_code_id)
     booking_data['base_amount_cents'] = new_base_amount_cents
     booking_data['gross_amount'] = gross_amount  # 保存原始金额以便后续计算
     
@@ -1618,7 +1639,8 @@ def api_create_free_booking():
     
     try:
         # 复用现有的 booking 创建逻辑
-        booking = _create_booking_from_metadata(payment_intent_id)
+        # 没有收款：名额售完时直接拒绝，不超卖
+        booking = _create_booking_from_metadata(payment_intent_id, allow_oversell=False)
         
         if not booking:
             return jsonify({'success': False, 'message': 'Failed to create booking'}), 500
@@ -1643,11 +1665,8 @@ def api_create_free_booking():
         db.session.commit()
         
         # 取消 Stripe Payment Intent（因为不需要实际付款）
-        try:
-            stripe.PaymentIntent.cancel(payment_intent_id)
+        if cancel_payment_intent(payment_intent_id):
             current_app.logger.info(f"Cancelled Payment Intent {payment_intent_id} for $0 booking")
-        except Exception as e:
-            current_app.logger.warning(f"Failed to cancel Payment Intent {payment_intent_id}: {e}")
         
         current_app.logger.info(
             f"Free booking created: booking_id={booking.id}, payment_intent_id={payment_intent_id}, "
@@ -1667,6 +1686,13 @@ def api_create_free_booking():
             'redirect_url': url_for('main.booking_success', booking_id=booking.id, _external=True)
         }), 200
         
+    except InventoryUnavailable as e:
+        db.session.rollback()
+        package = TripPackage.query.get(e.package_id)
+        return jsonify({
+            'success': False,
+            'message': f'Package "{package.name if package else e.package_id}" is sold out'
+        }), 400
     except Exception as e:
         db.session.rollback()
         current_app.logger.error(f"Error creating free booking: {e}")
@@ -2079,29 +2105,45 @@ def stripe_webhook():
         current_app.logger.error(f"Invalid signature: {str(e)}")
         return jsonify({'error': 'Invalid signature'}), 400
     
-    # 处理不同的事件类型
+    # 先落库再返回 200：处理交给后台任务（app.stripe_events），Stripe 不会因处理慢而超时重发
     event_type = event['type']
-    current_app.logger.info(f"Received Stripe webhook: {event_type}")
+    current_app.logger.info(f"Received Stripe webhook: {event_type} ({event['id']})")
     
     try:
-        if event_type == 'checkout.session.completed':
-            handle_checkout_completed(event['data']['object'])
-        elif event_type == 'payment_intent.succeeded':
-            handle_booking_payment_intent_succeeded(event['data']['object'])
-            handle_payment_intent_succeeded(event['data']['object'])
-        elif event_type == 'payment_intent.payment_failed':
-            handle_payment_intent_failed(event['data']['object'])
-        elif event_type == 'charge.refunded':
-            handle_refund(event['data']['object'])
-        else:
-            current_app.logger.info(f"Unhandled event type: {event_type}")
-        
-        return jsonify({'status': 'success'}), 200
+        created = record_stripe_event(json.loads(payload))
+        db.session.commit()
     except Exception as e:
-        current_app.logger.error(f"Error processing webhook {event_type}: {str(e)}")
-        import traceback
-        traceback.print_exc()
-        return jsonify({'error': 'Webhook processing failed'}), 500
+        db.session.rollback()
+        current_app.logger.error(f"Error storing webhook {event_type}: {str(e)}")
+        return jsonify({'error': 'Webhook storage failed'}), 500
+    
+    if created:
+        wake_stripe_event_worker(current_app._get_current_object())
+    else:
+        current_app.logger.info(f"Duplicate Stripe webhook ignored: {event['id']}")
+    return jsonify({'status': 'success'}), 200
+
+
+def dispatch_stripe_event(event):
+    """
+    按事件类型调用对应的处理器（由收件箱后台任务调用，见 app.stripe_events）
+    处理器抛出异常时由调用方回滚并安排重试
+    """
+    event_type = event['type']
+    
+    if event_type == 'checkout.session.completed':
+        handle_checkout_completed(event['data']['object'])
+    elif event_type == 'payment_intent.succeeded':
+        handle_booking_payment_intent_succeeded(event['data']['object'])
+        handle_payment_intent_succeeded(event['data']['object'])
+    elif event_type == 'payment_intent.payment_failed':
+        handle_payment_intent_failed(event['data']['object'])
+    elif event_type == 'payment_intent.canceled':
+        handle_payment_intent_canceled(event['data']['object'])
+    elif event_type == 'charge.refunded':
+        handle_refund(event['data']['object'])
+    else:
+        current_app.logger.info(f"Unhandled event type: {event_type}")
 
 
 def handle_checkout_completed(session):
@@ -2117,6 +2159,11 @@ def handle_checkout_completed(session):
         except (TypeError, ValueError):
             return None
     
+    # 处理台账：同一 Checkout Session 只处理一次
+    if not claim_stripe_object(session.get('id'), 'checkout_completed'):
+        current_app.logger.info(f"Checkout session {session.get('id')} already processed, skipping")
+        return
+    
     booking_id = session.get('metadata', {}).get('booking_id')
     if not booking_id:
         current_app.logger.error("No booking_id in session metadata")
@@ -2227,6 +2274,8 @@ def handle_checkout_completed(session):
             if config and config.get('enabled'):
                 create_installment_payments(booking, bp, config)
     
+    # 同一事务内刷新行程财务汇总
+    refresh_trip_financial_summary(booking.trip_id)
     db.session.commit()
     
     # 发送确认邮件
@@ -2238,11 +2287,14 @@ def handle_checkout_completed(session):
     current_app.logger.info(f"Successfully processed checkout for booking {booking_id}")
 
 
-def _create_booking_from_metadata(payment_intent_id):
+def _create_booking_from_metadata(payment_intent_id, allow_oversell=True):
     """
     从PendingBooking表创建Booking和所有相关记录
     这是支付成功后才执行的，确保只有付款成功的客户才会出现在系统中
     幂等性：如果已存在 Payment 记录，返回关联的 Booking
+
+    Args:
+        allow_oversell: 名额已售完时是否仍创建预订（已收款为 True；$0 预订传 False，售完抛出 InventoryUnavailable）
     """
     from app.models import PendingBooking
     
@@ -2252,10 +2304,10 @@ def _create_booking_from_metadata(payment_intent_id):
         current_app.logger.info(f"Payment already exists for {payment_intent_id}, returning existing booking {existing_payment.booking_id}")
         return Booking.query.get(existing_payment.booking_id)
     
-    # 从PendingBooking表获取完整报名数据
-    pending_booking = PendingBooking.query.filter_by(
-        payment_intent_id=payment_intent_id,
-        status='pending'
+    # 从PendingBooking表获取完整报名数据（已过期但仍在保留期内的行照常处理：迟到的支付也要落成预订）
+    pending_booking = PendingBooking.query.filter(
+        PendingBooking.payment_intent_id == payment_intent_id,
+        PendingBooking.status.in_(('pending', 'expired'))
     ).first()
     
     if not pending_booking:
@@ -2290,44 +2342,34 @@ def _create_booking_from_metadata(payment_intent_id):
         current_app.logger.error(f"No buyer email in payment_intent {payment_intent_id}")
         return None
     
-    # 查找或创建 Client（支付成功后才创建客户记录）
-    client = Client.query.filter_by(email=buyer_email).first()
-    if not client:
-        client = Client(
-            name=f"{buyer_info.get('first_name', '')} {buyer_info.get('last_name', '')}".strip(),
-            first_name=buyer_info.get('first_name'),
-            last_name=buyer_info.get('last_name'),
-            email=buyer_email,
-            phone=buyer_info.get('phone'),
-            address=buyer_info.get('address'),
-            city=buyer_info.get('city'),
-            state=buyer_info.get('state'),
-            zip_code=buyer_info.get('zip_code'),
-            country=buyer_info.get('country')
-        )
-        db.session.add(client)
-        db.session.flush()
+    # 先校验并解析全部子表数据（套餐 / 附加项各一次查询），再写库
+    children = plan_booking_children(trip.id, booking_data)
+    
+    # 查找或创建 Client（支付成功后才创建客户记录；已有客户保持原资料）
+    client = upsert_client(
+        buyer_email,
+        update_existing=False,
+        name=f"{buyer_info.get('first_name', '')} {buyer_info.get('last_name', '')}".strip(),
+        first_name=buyer_info.get('first_name'),
+        last_name=buyer_info.get('last_name'),
+        phone=buyer_info.get('phone'),
+        address=buyer_info.get('address'),
+        city=buyer_info.get('city'),
+        state=buyer_info.get('state'),
+        zip_code=buyer_info.get('zip_code'),
+        country=buyer_info.get('country')
+    )
     
-    # 再次检查库存（支付成功时再次确认）
     packages_data = booking_data.get('packages', [])
-    for pkg_data in packages_data:
-        package = TripPackage.query.get(pkg_data.get('package_id'))
-        if not package:
-            continue
-        
-        if package.capacity:
-            spots_sold = BookingPackage.query.filter(
-                BookingPackage.package_id == package.id,
-                BookingPackage.status.in_(['deposit_paid', 'fully_paid'])
-            ).with_entities(
-                db.func.sum(BookingPackage.quantity)
-            ).scalar() or 0
-            
-            if spots_sold + pkg_data.get('quantity', 1) > package.capacity:
-                current_app.logger.error(
-                    f"Package {package.id} sold out when processing payment_intent {payment_intent_id}"
-                )
-                return None
+    
+    # 支付成功：锁定的名额转为已售（锁定已过期时按容量条件重新占用）
+    # 钱已收到时名额售完也照常落成预订：记为超卖，提交后通知管理员（调整容量、安排或退款）；
+    # allow_oversell=False（$0 预订）时抛出 InventoryUnavailable
+    oversold = convert_holds(payment_intent_id, packages_data, allow_oversell=allow_oversell)
+    if oversold:
+        current_app.logger.error(
+            f"Packages oversold when processing payment_intent {payment_intent_id}: {oversold}"
+        )
     
     # 计算参与者总数
     total_participants = sum(p.get('quantity', 1) for p in packages_data)
@@ -2368,71 +2410,22 @@ def _create_booking_from_metadata(payment_intent_id):
     db.session.add(booking)
     db.session.flush()
     
-    # 更新折扣码使用次数
-    if discount_code_id:
-        discount_code = DiscountCode.query.get(discount_code_id)
-        if discount_code:
-            discount_code.used_count = (discount_code.used_count or 0) + 1
-            current_app.logger.info(
-                f"Discount code {discount_code.code} used_count updated to {discount_code.used_count}"
+    # 折扣码使用次数已在结账时占用；旧的 PendingBooking（没有占用记录）在这里补记一次
+    if discount_code_id and not booking_data.get('discount_redeemed'):
+        if not redeem_discount_code(discount_code_id):
+            current_app.logger.warning(
+                f"Discount code {discount_code_id} over its limit when completing payment_intent {payment_intent_id}"
             )
     
-    # 创建 BookingPackage 记录
-    for pkg_data in packages_data:
-        package = TripPackage.query.get(pkg_data.get('package_id'))
-        if not package:
-            continue
-        
-        booking_package = BookingPackage(
-            booking_id=booking.id,
-            package_id=package.id,
-            quantity=pkg_data.get('quantity', 1),
-            payment_plan_type=pkg_data.get('payment_plan_type', 'full'),
-            status='pending',
-            amount_paid=0.0
-        )
-        db.session.add(booking_package)
-    
-    # 先创建 BookingParticipant 记录（需要在创建 BookingAddOn 之前）
-    participants_data = booking_data.get('participants', [])
-    participants_list = []
-    for participant_data in participants_data:
-        participant_name = f"{participant_data.get('first_name', '')} {participant_data.get('last_name', '')}".strip()
-        participant = BookingParticipant(
-            booking_id=booking.id,
-            name=participant_name,
-            email=participant_data.get('email'),
-            phone=participant_data.get('phone')
-        )
-        db.session.add(participant)
-        participants_list.append(participant)
-    
-    # Flush 以确保 participant.id 可用
-    db.session.flush()
-    
-    # 创建 BookingAddOn 记录
-    addons_data = booking_data.get('addons', [])
-    for addon_data in addons_data:
-        addon = TripAddOn.query.get(addon_data.get('addon_id'))
-        if not addon:
-            continue
-        
-        # 如果指定了 participant_id，使用它；否则关联到第一个参与者（或所有参与者）
-        participant_id = addon_data.get('participant_id')
-        if participant_id is None and participants_list:
-            # 如果没有指定参与者，关联到第一个参与者（全局 addon）
-            participant_id = participants_list[0].id
-        
-        booking_addon = BookingAddOn(
-            booking_id=booking.id,
-            participant_id=participant_id,
-            addon_id=addon.id,
-            quantity=addon_data.get('quantity', 1),
-            price_at_booking=addon.price
-        )
-        db.session.add(booking_addon)
+    # BookingPackage / BookingParticipant / BookingAddOn 各一条批量 INSERT
+    counts = materialize_booking_children(booking, children)
+    current_app.logger.info(
+        f"Materialized booking {booking.id}: packages={counts['packages']} "
+        f"participants={counts['participants']} addons={counts['addons']}"
+    )
     
-    db.session.flush()
+    # 新预订计入行程财务汇总（随调用方事务一起提交）
+    refresh_trip_financial_summary(booking.trip_id)
     return booking
 
 
@@ -2450,7 +2443,7 @@ def handle_booking_payment_intent_succeeded(payment_intent):
     payment_intent_id = payment_intent['id']
     metadata = payment_intent.get('metadata', {}) or {}
     
-    # 检查是否已处理过此 payment_intent（防止重复处理）
+    # 检查是否已处理过此 payment_intent（台账上线前的旧数据）
     existing_payment = Payment.query.filter_by(
         stripe_payment_intent_id=payment_intent_id,
         status='succeeded'
@@ -2467,6 +2460,12 @@ def handle_booking_payment_intent_succeeded(payment_intent):
         handle_payment_intent_succeeded(payment_intent)
         return
     
+    # 处理台账：webhook 与状态轮询兜底共用，重复调用只花一次插入。
+    # 台账随本事务提交，之后所有失败路径都必须抛异常（回滚台账），不能直接 return
+    if not claim_stripe_object(payment_intent_id, 'booking_payment_intent_succeeded'):
+        current_app.logger.info(f"Payment Intent {payment_intent_id} already claimed by booking handler, skipping")
+        return
+    
     # 检查是否已有Booking（通过booking_id）
     booking_id = metadata.get('booking_id')
     booking = None
@@ -2483,7 +2482,7 @@ def handle_booking_payment_intent_succeeded(payment_intent):
         booking = _create_booking_from_metadata(payment_intent_id)
         if not booking:
             current_app.logger.error(f"Failed to create booking from PendingBooking for payment_intent {payment_intent_id}")
-            return
+            raise BookingNotCreated(payment_intent_id, 'booking could not be created from PendingBooking')
         
         # 标记PendingBooking为已完成
         pending_booking = PendingBooking.query.filter_by(payment_intent_id=payment_intent_id).first()
@@ -2558,8 +2557,9 @@ def handle_booking_payment_intent_succeeded(payment_intent):
     else:
         booking.status = 'deposit_paid'  # 首次支付成功，即使是定金也算正式客户
     
-    # 更新 BookingPackage 状态
-    for bp in booking.booking_packages.all():
+    # 更新 BookingPackage 状态（套餐一次性预加载）
+    booking_packages = booking.booking_packages.options(joinedload(BookingPackage.package)).all()
+    for bp in booking_packages:
         if is_full_payment:
             bp.status = 'fully_paid'
         else:
@@ -2569,13 +2569,15 @@ def handle_booking_payment_intent_succeeded(payment_intent):
             package_amount = (float(bp.package.price) if bp.package and bp.package.price else 0.0) * (int(bp.quantity) if bp.quantity else 1)
             bp.amount_paid = (bp.amount_paid or 0.0) + (base_amount * package_amount / total_info['subtotal'])
 
-    # 如果是分期付款，创建 InstallmentPayment 记录
+    # 如果是分期付款，创建 InstallmentPayment 记录（所有套餐合并为一条批量 INSERT）
     if booking.installments.count() == 0:
-        for bp in booking.booking_packages.all():
+        installment_rows = []
+        for bp in booking_packages:
             if bp.payment_plan_type == 'deposit_installment' and bp.package and bp.package.payment_plan_config:
                 config = bp.package.payment_plan_config
                 if config and config.get('enabled'):
-                    create_installment_payments(booking, bp, config)
+                    installment_rows.extend(installment_payment_rows(booking, bp, config))
+        bulk_insert(InstallmentPayment, installment_rows)
     
     # Payoff 支付成功：取消所有未支付的 installment
     if metadata.get('payment_step') == 'payoff':
@@ -2583,6 +2585,10 @@ def handle_booking_payment_intent_succeeded(payment_intent):
             inst.status = 'cancelled'
             current_app.logger.info(f"Cancelled installment {inst.id} (booking {booking.id}) due to payoff payment")
 
+    # 同一事务内刷新行程财务汇总
+    refresh_trip_financial_summary(booking.trip_id)
+    # 提交后唤醒等待该支付结果的状态请求
+    notify_payment_status(payment_intent_id, booking.id)
     db.session.commit()
 
     # 发送确认邮件
@@ -2606,6 +2612,11 @@ def handle_payment_intent_succeeded(payment_intent):
 
     payment_intent_id = payment_intent['id']
     
+    # 处理台账：webhook 会在 handle_booking_payment_intent_succeeded 之后再调用一次，只处理一次
+    if not claim_stripe_object(payment_intent_id, 'payment_intent_succeeded'):
+        current_app.logger.info(f"Payment Intent {payment_intent_id} already claimed by installment handler, skipping")
+        return
+    
     total_amount_cents = payment_intent['amount']  # 总金额（含手续费）
     metadata = payment_intent.get('metadata', {}) or {}
     base_amount_cents = _parse_int(metadata.get('base_amount'))
@@ -2703,6 +2714,9 @@ def handle_payment_intent_succeeded(payment_intent):
     if brand:
         payment.brand = brand
     
+    # 同一事务内刷新行程财务汇总
+    refresh_trip_financial_summary(booking.trip_id)
+    notify_payment_status(payment_intent_id, booking.id)
     db.session.commit()
     
     # 发送确认邮件
@@ -2724,12 +2738,46 @@ def handle_payment_intent_failed(payment_intent):
     payment = Payment.query.filter_by(stripe_payment_intent_id=payment_intent_id).first()
     if payment and payment.status != 'succeeded':
         payment.status = 'failed'
-        db.session.commit()
+
+    # 释放结账时锁定的名额（客户用同一 PaymentIntent 重试成功时会按容量重新占用）
+    released = release_holds(payment_intent_id)
+    notify_payment_status(payment_intent_id, payment.booking_id if payment else None)
+    db.session.commit()
+    if released:
+        current_app.logger.info(f"Released {released} inventory holds for failed Payment Intent {payment_intent_id}")
 
     # 可以在这里记录失败原因、发送通知等
     # 但通常不需要更新 Booking 状态（因为支付未成功）
 
 
+def handle_payment_intent_canceled(payment_intent):
+    """
+    处理 Payment Intent 取消事件：释放锁定名额，PendingBooking 标记为 cancelled
+    """
+    payment_intent_id = payment_intent['id']
+    
+    # 取消是终态，只处理一次
+    if not claim_stripe_object(payment_intent_id, 'payment_intent_canceled'):
+        current_app.logger.info(f"Payment Intent {payment_intent_id} cancel already processed, skipping")
+        return
+    
+    released = release_holds(payment_intent_id)
+    pending_booking = PendingBooking.query.filter_by(
+        payment_intent_id=payment_intent_id,
+        status='pending'
+    ).first()
+    if pending_booking:
+        pending_booking.status = 'cancelled'
+        release_pending_discount(pending_booking)
+    notify_payment_status(payment_intent_id)
+    db.session.commit()
+    
+    current_app.logger.info(
+        f"Payment Intent {payment_intent_id} canceled: released_holds={released}, "
+        f"pending_booking={'cancelled' if pending_booking else 'none'}"
+    )
+
+
 def handle_refund(refund_data):
     """
     处理退款事件
@@ -2757,34 +2805,39 @@ def handle_refund(refund_data):
         payment.status = 'partially_refunded'
     payment.refunded_at = datetime.utcnow()
     
+    # 同一事务内刷新行程财务汇总
+    refresh_trip_financial_summary(payment.trip_id or (payment.booking.trip_id if payment.booking else None))
     db.session.commit()
     
     current_app.logger.info(f"Refund processed for payment {payment.id}")
 
 
-def create_installment_payments(booking, booking_package, payment_plan_config):
+def installment_payment_rows(booking, booking_package, payment_plan_config):
     """
-    创建分期付款记录（追缴模式：跳过过期分期，因为它们已合并到首付款中）
+    生成分期付款记录的列值（追缴模式：跳过过期分期，因为它们已合并到首付款中）
+    
+    Returns:
+        list: InstallmentPayment 列值 dict 列表（由调用方批量插入）
     """
     today = date.today()
+    rows = []
     
     deposit = payment_plan_config.get('deposit_amount', 0.0) or payment_plan_config.get('deposit', 0.0)
     installments = payment_plan_config.get('installments', [])
     quantity = int(booking_package.quantity) if booking_package.quantity else 1
     
-    # 创建定金记录（installment_number = 0）
+    # 定金记录（installment_number = 0）
     if deposit > 0:
-        installment = InstallmentPayment(
-            booking_id=booking.id,
-            installment_number=0,
-            amount=float(deposit) * quantity,
-            due_date=today,  # 定金立即到期
-            status='paid' if booking.status in ['deposit_paid', 'fully_paid'] else 'pending',
-            paid_at=datetime.utcnow() if booking.status in ['deposit_paid', 'fully_paid'] else None
-        )
-        db.session.add(installment)
+        rows.append({
+            'booking_id': booking.id,
+            'installment_number': 0,
+            'amount': float(deposit) * quantity,
+            'due_date': today,  # 定金立即到期
+            'status': 'paid' if booking.status in ['deposit_paid', 'fully_paid'] else 'pending',
+            'paid_at': datetime.utcnow() if booking.status in ['deposit_paid', 'fully_paid'] else None
+        })
     
-    # 创建分期付款记录（跳过过期分期）
+    # 分期付款记录（跳过过期分期）
     installment_number = 1
     for inst_data in installments:
         due_date_str = inst_data.get('date')
@@ -2805,19 +2858,27 @@ def create_installment_payments(booking, booking_package, payment_plan_config):
                 continue
             
             # 只创建未过期的分期付款记录
-            installment = InstallmentPayment(
-                booking_id=booking.id,
-                installment_number=installment_number,
-                amount=inst_amount,
-                due_date=due_date,
-                status='pending'
-            )
-            db.session.add(installment)
+            rows.append({
+                'booking_id': booking.id,
+                'installment_number': installment_number,
+                'amount': inst_amount,
+                'due_date': due_date,
+                'status': 'pending'
+            })
             installment_number += 1
             
         except (ValueError, TypeError) as e:
             current_app.logger.error(f"Invalid installment date or amount: {due_date_str}, {str(e)}")
             continue
+    
+    return rows
+
+
+def create_installment_payments(booking, booking_package, payment_plan_config):
+    """
+    创建分期付款记录（一条批量 INSERT）
+    """
+    bulk_insert(InstallmentPayment, installment_payment_rows(booking, booking_package, payment_plan_config))
 
 
 def send_booking_confirmation_email(booking, is_full_payment):
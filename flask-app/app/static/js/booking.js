@@ -1630,8 +1630,9 @@
                 return false;
             }
             
-            console.log("Sending quote request:", requestBody);
-            const response = await fetch("/api/payment/quote", {
+            // 报价和更新 PaymentIntent 合并为一次请求，下单时不需要再调用 /api/payment/intent
+            console.log("Sending checkout quote request:", requestBody);
+            const response = await fetch("/api/payment/checkout", {
                 method: "POST",
                 headers: { "Content-Type": "application/json" },
                 body: JSON.stringify(requestBody),
@@ -1730,9 +1731,11 @@
             }
         }
 
-        if (!lastQuote) {
+        // 报价请求（/api/payment/checkout）已按当前卡片更新了 PaymentIntent 金额，这里直接确认支付
+        if (!lastQuote || !lastQuote.payment_intent_id) {
+            lastPaymentMethodId = null;
             await requestEmbeddedQuote(false);
-            if (!lastQuote) {
+            if (!lastQuote || !lastQuote.payment_intent_id) {
                 if (submitButton) {
                     submitButton.disabled = false;
                     submitButton.textContent = 'Place Order';
@@ -1742,33 +1745,6 @@
         }
 
         try {
-            // 新流程：使用 payment_intent_id（还没有创建Booking）
-            const requestBody = {
-                installment_id: null,
-                payment_method_id: lastPaymentMethodId,
-                payment_plan: embeddedPaymentSession.payment_plan || "full",
-                payment_step: "initial",
-            };
-            
-            // 如果有 payment_intent_id，使用它（新流程）
-            if (embeddedPaymentSession.payment_intent_id) {
-                requestBody.payment_intent_id = embeddedPaymentSession.payment_intent_id;
-            } 
-            // 如果有 booking_id，使用它（旧流程或已存在的Booking）
-            else if (embeddedPaymentSession.booking_id) {
-                requestBody.booking_id = embeddedPaymentSession.booking_id;
-            }
-            
-            const response = await fetch("/api/payment/intent", {
-                method: "POST",
-                headers: { "Content-Type": "application/json" },
-                body: JSON.stringify(requestBody),
-            });
-            const result = await response.json();
-            if (!response.ok) {
-                throw new Error(result.error || "Payment update failed");
-            }
-
             const { error } = await stripeInstance.confirmPayment({
                 elements: elementsInstance,
                 confirmParams: {
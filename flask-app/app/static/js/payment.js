@@ -342,7 +342,8 @@ if (placeOrderButton) {
             const currentPaymentStep = isPayoffMode ? 'payoff' : (paymentStep || null);
             const currentInstallmentId = (isPayoffMode && bookingId) ? null : (installmentId || null);
             
-            const response = await fetch("/api/payment/intent", {
+            // 一次请求完成报价 + 更新 PaymentIntent，并用服务端最终金额刷新摘要
+            const response = await fetch("/api/payment/checkout", {
                 method: "POST",
                 headers: { "Content-Type": "application/json" },
                 body: JSON.stringify({
@@ -357,6 +358,8 @@ if (placeOrderButton) {
             if (!response.ok) {
                 throw new Error(result.error || "Payment update failed");
             }
+            lastQuote = result;
+            updateSummary(result);
 
             const { error } = await stripe.confirmPayment({
                 elements,
@@ -0,0 +1,463 @@
+"""
+行程财务统计模块
+用少量 GROUP BY 查询批量计算多个行程的参与者数量与金额汇总
+"""
+
+from datetime import date, datetime, timedelta
+from sqlalchemy import and_, case, event, select, union
+from sqlalchemy.exc import IntegrityError
+from flask import current_app, g, has_app_context
+from app import db
+from app.cache import TTLCache
+from app.models import Trip, Booking, BookingPackage, BookingParticipant, BookingAddOn, TripPackage, TripAddOn, TripFinancialSummary
+
+
+# 账本行与实时计算之间允许的金额误差（浮点累加顺序不同）
+DRIFT_TOLERANCE = 0.005
+
+
+def _empty_stats():
+    return {
+        'booking_count': 0,
+        'participants_count': 0,
+        'amount_paid': 0.0,
+        'amount_gross': 0.0,
+        'amount_discount': 0.0,
+        'amount_expected': 0.0,
+        'amount_available': 0.0
+    }
+
+
+def calculate_trips_stats(trip_ids):
+    """
+    批量计算行程的统计信息（参与者数量、已付金额、应付金额）
+
+    Args:
+        trip_ids: 行程 ID 列表
+
+    Returns:
+        dict: {trip_id: {'booking_count', 'participants_count', 'amount_paid', 'amount_gross',
+                         'amount_discount', 'amount_expected', 'amount_available'}}
+        没有预订的行程返回全 0
+
+    口径说明（与原逐条计算保持一致）：
+    - amount_paid: Booking.amount_paid 之和（不含 Stripe 手续费）
+    - amount_gross: 套餐 + 附加项原价；附加项按 BookingAddOn.id 去重
+      （同时来自 booking.addons 和 participant.addons）
+    - amount_expected: 每个预订 max(0, gross - discount) 之和
+    - 没有 BookingPackage 的旧预订：gross = expected = amount_paid，折扣记为 0
+    - amount_available: expected - paid
+
+    查询次数固定为 4 次，与行程数和预订数无关。
+    """
+    trip_ids = list({tid for tid in trip_ids if tid is not None})
+    stats = {tid: _empty_stats() for tid in trip_ids}
+    if not trip_ids:
+        return stats
+
+    # 1. 预订基础数据（每个预订一行）
+    bookings = db.session.query(
+        Booking.id,
+        Booking.trip_id,
+        Booking.amount_paid,
+        Booking.discount_amount
+    ).filter(Booking.trip_id.in_(trip_ids)).all()
+    if not bookings:
+        return stats
+
+    # 2. 套餐金额（按预订汇总，只统计套餐仍然存在的 BookingPackage）
+    package_rows = db.session.query(
+        BookingPackage.booking_id,
+        db.func.sum(
+            db.func.coalesce(TripPackage.price, 0.0) * db.func.coalesce(BookingPackage.quantity, 1)
+        )
+    ).join(
+        TripPackage, TripPackage.id == BookingPackage.package_id
+    ).join(
+        Booking, Booking.id == BookingPackage.booking_id
+    ).filter(
+        Booking.trip_id.in_(trip_ids)
+    ).group_by(BookingPackage.booking_id).all()
+    package_totals = {booking_id: float(total or 0.0) for booking_id, total in package_rows}
+
+    # 3. 附加项金额：booking 直连的 add-on 与 participant 关联的 add-on 取并集（UNION 去重）
+    direct_addons = select(
+        BookingAddOn.booking_id.label('booking_id'),
+        BookingAddOn.id.label('booking_addon_id')
+    ).join(
+        Booking, Booking.id == BookingAddOn.booking_id
+    ).where(Booking.trip_id.in_(trip_ids))
+    participant_addons = select(
+        BookingParticipant.booking_id.label('booking_id'),
+        BookingAddOn.id.label('booking_addon_id')
+    ).join(
+        BookingParticipant, BookingParticipant.id == BookingAddOn.participant_id
+    ).join(
+        Booking, Booking.id == BookingParticipant.booking_id
+    ).where(Booking.trip_id.in_(trip_ids))
+    addon_links = union(direct_addons, participant_addons).subquery()
+
+    addon_rows = db.session.query(
+        addon_links.c.booking_id,
+        db.func.sum(
+            db.func.coalesce(TripAddOn.price, 0.0) * db.func.coalesce(BookingAddOn.quantity, 1)
+        )
+    ).select_from(addon_links).join(
+        BookingAddOn, BookingAddOn.id == addon_links.c.booking_addon_id
+    ).join(
+        TripAddOn, TripAddOn.id == BookingAddOn.addon_id
+    ).group_by(addon_links.c.booking_id).all()
+    addon_totals = {booking_id: float(total or 0.0) for booking_id, total in addon_rows}
+
+    # 4. 参与者数量（按行程汇总）
+    participant_rows = db.session.query(
+        Booking.trip_id,
+        db.func.count(BookingParticipant.id)
+    ).join(
+        BookingParticipant, BookingParticipant.booking_id == Booking.id
+    ).filter(
+        Booking.trip_id.in_(trip_ids)
+    ).group_by(Booking.trip_id).all()
+    for trip_id, count in participant_rows:
+        stats[trip_id]['participants_count'] = int(count or 0)
+
+    # 按预订折叠到行程（max(0, gross - discount) 必须逐个预订计算）
+    for booking_id, trip_id, amount_paid, discount_amount in bookings:
+        trip_stats = stats[trip_id]
+        paid = float(amount_paid) if amount_paid else 0.0
+
+        if booking_id in package_totals:
+            booking_gross = package_totals[booking_id] + addon_totals.get(booking_id, 0.0)
+            discount = float(discount_amount) if discount_amount else 0.0
+            booking_expected = max(0.0, booking_gross - discount)
+        else:
+            # Fallback for legacy bookings without BookingPackages
+            booking_gross = paid
+            booking_expected = booking_gross
+            discount = 0.0
+
+        trip_stats['booking_count'] += 1
+        trip_stats['amount_paid'] += paid
+        trip_stats['amount_gross'] += booking_gross
+        trip_stats['amount_discount'] += discount
+        trip_stats['amount_expected'] += booking_expected
+
+    for trip_stats in stats.values():
+        trip_stats['amount_available'] = trip_stats['amount_expected'] - trip_stats['amount_paid']
+
+    return stats
+
+
+def _apply_stats_to_summary(summary, stats):
+    summary.amount_gross = stats['amount_gross']
+    summary.amount_discount = stats['amount_discount']
+    summary.amount_expected = stats['amount_expected']
+    summary.amount_paid = stats['amount_paid']
+    summary.amount_pending = stats['amount_available']
+    summary.booking_count = stats['booking_count']
+    summary.participant_count = stats['participants_count']
+
+
+def refresh_trip_financial_summary(trip_id):
+    """
+    刷新单个行程的财务汇总行（trip_financial_summary）
+
+    在改变金额的写操作中调用，与业务数据处于同一事务；本函数只 flush 不 commit，
+    由调用方统一提交（回滚时汇总行也一起回滚）。
+    先对汇总行加行锁，让同一行程的并发写入串行刷新；拿到锁后重新统计，读到锁等待期间已提交的预订
+    （MySQL 依赖 READ COMMITTED，见 config.SQLALCHEMY_ENGINE_OPTIONS）。
+    汇总行不存在时在 SAVEPOINT 中插入，并发首单的主键冲突只回滚 SAVEPOINT，不影响调用方的事务。
+
+    Args:
+        trip_id: 行程 ID
+
+    Returns:
+        TripFinancialSummary 或 None（trip_id 为空时）
+    """
+    if not trip_id:
+        return None
+
+    summary = TripFinancialSummary.query.filter_by(trip_id=trip_id).with_for_update().first()
+    if summary is None:
+        try:
+            with db.session.begin_nested():
+                db.session.add(TripFinancialSummary(trip_id=trip_id))
+        except IntegrityError:
+            # 并发请求刚创建了该行（插入会等它提交后才报冲突）
+            pass
+        summary = TripFinancialSummary.query.filter_by(trip_id=trip_id).with_for_update().one()
+
+    stats = calculate_trips_stats([trip_id])[trip_id]
+    _apply_stats_to_summary(summary, stats)
+
+    # 事务提交后让 Reports 缓存中该行程的条目失效
+    db.session.info.setdefault('report_dirty_trip_ids', set()).add(trip_id)
+    return summary
+
+
+def get_trip_financial_summaries(trip_ids):
+    """
+    读取行程财务汇总（页面读取入口）
+
+    优先读取 trip_financial_summary 预计算行；尚未建立汇总行的行程（例如还没有任何预订）
+    回退到实时批量计算，只读不写。
+
+    Returns:
+        dict: {trip_id: stats}，结构与 calculate_trips_stats 相同
+    """
+    trip_ids = list({tid for tid in trip_ids if tid is not None})
+    if not trip_ids:
+        return {}
+
+    rows = TripFinancialSummary.query.filter(TripFinancialSummary.trip_id.in_(trip_ids)).all()
+    summaries = {row.trip_id: row.to_stats() for row in rows}
+
+    missing = [tid for tid in trip_ids if tid not in summaries]
+    if missing:
+        summaries.update(calculate_trips_stats(missing))
+    return summaries
+
+
+def _diff_stats(stored, live):
+    """比较账本行与实时计算结果，返回有差异的字段 {field: (stored, live)}"""
+    diff = {}
+    for key in ('booking_count', 'participants_count'):
+        if stored[key] != live[key]:
+            diff[key] = (stored[key], live[key])
+    for key in ('amount_gross', 'amount_discount', 'amount_expected', 'amount_paid', 'amount_available'):
+        if abs(stored[key] - live[key]) > DRIFT_TOLERANCE:
+            diff[key] = (stored[key], live[key])
+    return diff
+
+
+def rebuild_trip_financial_summaries(trip_ids, dry_run=False):
+    """
+    按实时计算结果重建汇总行，并报告与现有账本行的差异（drift）
+
+    Args:
+        trip_ids: 需要重建的行程 ID 列表
+        dry_run: True 时只报告差异，不写入
+
+    Returns:
+        list: [{'trip_id', 'missing', 'diff'}]，只包含有差异或缺失的行程
+    """
+    live_stats = calculate_trips_stats(trip_ids)
+    rows = {
+        row.trip_id: row
+        for row in TripFinancialSummary.query.filter(TripFinancialSummary.trip_id.in_(list(live_stats.keys()))).all()
+    }
+
+    drift = []
+    for trip_id, stats in live_stats.items():
+        summary = rows.get(trip_id)
+        if summary is None:
+            drift.append({'trip_id': trip_id, 'missing': True, 'diff': {}})
+            if not dry_run:
+                summary = TripFinancialSummary(trip_id=trip_id)
+                db.session.add(summary)
+                _apply_stats_to_summary(summary, stats)
+            continue
+
+        diff = _diff_stats(summary.to_stats(), stats)
+        if diff:
+            drift.append({'trip_id': trip_id, 'missing': False, 'diff': diff})
+        if not dry_run:
+            _apply_stats_to_summary(summary, stats)
+
+    return drift
+
+
+# ========== Reports 页面缓存 ==========
+# 分类列表：按 (搜索词, 分类, 日期) 缓存行程快照，TTL 较短（行程标题/状态变化不经过支付事件）
+# 行程汇总：按 trip_id 缓存，只在支付/退款/预订事件刷新该行程的汇总行时失效：
+#   - 本进程：事务提交后立即失效（见下方 session 事件）
+#   - 其他 worker：读取时比对 trip_financial_summary.updated_at 版本戳（一次主键查询）
+_report_trip_lists = TTLCache(maxsize=256)
+_report_trip_stats = TTLCache(maxsize=4096)
+
+# TripFinancialSummary.updated_at 在 MySQL 上只精确到秒：刚刷新过的汇总行不缓存，避免同一秒内的两次刷新共用一个版本戳
+_STAMP_SETTLE = timedelta(seconds=1)
+
+# 'all' 只记录所有非草稿行程的 ID（总行程数，包含已归档行程）
+REPORT_CATEGORIES = ('upcoming', 'past', 'deactivated', 'all')
+
+
+def _report_category(trip, today):
+    if trip.status == 'deactivated':
+        return 'deactivated'
+    if trip.status == 'published' and trip.end_date:
+        return 'upcoming' if trip.end_date >= today else 'past'
+    return None
+
+
+def get_report_trip_lists(search, today):
+    """
+    获取 Reports 各分类下的行程快照列表（带缓存）
+
+    Returns:
+        (dict, float): ({category: [trip snapshot dict]}, 最早的缓存写入时间戳)
+    """
+    lists = {}
+    built_at = None
+    for category in REPORT_CATEGORIES:
+        entry = _report_trip_lists.get_entry((search, category, today))
+        if entry is None:
+            lists = None
+            break
+        lists[category] = entry[0]
+        built_at = entry[1] if built_at is None else min(built_at, entry[1])
+    if lists is not None:
+        return lists, built_at
+
+    trips_query = Trip.query.filter(Trip.status != 'draft')
+    if search:
+        trips_query = trips_query.filter(Trip.title.ilike(f'%{search}%'))
+
+    lists = {category: [] for category in REPORT_CATEGORIES}
+    for trip in trips_query.all():
+        lists['all'].append(trip.id)
+        category = _report_category(trip, today)
+        if category is None:
+            continue
+        lists[category].append({
+            'id': trip.id,
+            'title': trip.title,
+            'status': trip.status,
+            'start_date': trip.start_date,
+            'end_date': trip.end_date,
+            'updated_at': trip.updated_at
+        })
+
+    ttl = current_app.config.get('REPORTS_CACHE_TTL', 300)
+    for category, snapshots in lists.items():
+        _report_trip_lists.set((search, category, today), snapshots, ttl=ttl)
+    return lists, None
+
+
+def get_cached_trip_summaries(trip_ids):
+    """
+    读取行程财务汇总（带缓存，按汇总行版本戳校验）
+
+    版本戳是 TripFinancialSummary.updated_at；1 秒内刚刷新的行不写入缓存，
+    条目另有 REPORT_TRIP_STATS_CACHE_TTL 兜底过期。
+
+    Returns:
+        (dict, float): ({trip_id: stats}, 命中条目中最早的写入时间戳；全部未命中为 None)
+    """
+    trip_ids = list({tid for tid in trip_ids if tid is not None})
+    if not trip_ids:
+        return {}, None
+
+    stamps = dict(
+        db.session.query(TripFinancialSummary.trip_id, TripFinancialSummary.updated_at)
+        .filter(TripFinancialSummary.trip_id.in_(trip_ids)).all()
+    )
+
+    summaries = {}
+    oldest = None
+    missing = []
+    for trip_id in trip_ids:
+        entry = _report_trip_stats.get_entry(trip_id)
+        if entry is not None and entry[0]['stamp'] == stamps.get(trip_id):
+            summaries[trip_id] = entry[0]['stats']
+            oldest = entry[1] if oldest is None else min(oldest, entry[1])
+        else:
+            missing.append(trip_id)
+
+    if missing:
+        ttl = current_app.config.get('REPORT_TRIP_STATS_CACHE_TTL', 3600)
+        settled_before = datetime.utcnow() - _STAMP_SETTLE
+        for trip_id, stats in get_trip_financial_summaries(missing).items():
+            summaries[trip_id] = stats
+            stamp = stamps.get(trip_id)
+            if stamp is None or stamp < settled_before:
+                _report_trip_stats.set(trip_id, {'stamp': stamp, 'stats': stats}, ttl=ttl)
+
+    return summaries, oldest
+
+
+def invalidate_trip_report_cache(trip_id):
+    """使 Reports 缓存中单个行程的汇总条目失效"""
+    _report_trip_stats.pop(trip_id)
+
+
+def clear_report_trip_lists():
+    """清空 Reports 分类列表缓存（行程状态、标题等变化时调用）"""
+    _report_trip_lists.clear()
+
+
+def reports_cache_stats():
+    """Reports 缓存命中统计（页面展示用）"""
+    return {
+        'lists': _report_trip_lists.stats(),
+        'trips': _report_trip_stats.stats()
+    }
+
+
+# ========== 侧边栏行程计数缓存 ==========
+# 每个请求内只算一次（flask.g），进程内再缓存 TRIP_COUNTS_CACHE_TTL 秒；
+# 本进程在行程状态变化的事务提交后立即失效，其他 worker 依赖短 TTL
+_trip_counts_cache = TTLCache(maxsize=8)
+
+
+def get_trip_counts():
+    """
+    计算各类型行程的数量，用于侧边栏导航（一次条件聚合查询）
+
+    Returns:
+        dict: {'upcoming', 'past', 'draft', 'deactivated'}
+    """
+    today = date.today()
+    cached = g.get('trip_counts')
+    if cached is not None and cached[0] == today:
+        return cached[1]
+
+    counts = _trip_counts_cache.get(today)
+    if counts is None:
+        published = Trip.status == 'published'
+        row = db.session.query(
+            db.func.sum(case((and_(published, Trip.end_date >= today), 1), else_=0)),
+            db.func.sum(case((and_(published, Trip.end_date < today), 1), else_=0)),
+            db.func.sum(case((Trip.status == 'draft', 1), else_=0)),
+            db.func.sum(case((Trip.status == 'deactivated', 1), else_=0))
+        ).one()
+        counts = {
+            'upcoming': int(row[0] or 0),
+            'past': int(row[1] or 0),
+            'draft': int(row[2] or 0),
+            'deactivated': int(row[3] or 0)
+        }
+        _trip_counts_cache.set(today, counts, ttl=current_app.config.get('TRIP_COUNTS_CACHE_TTL', 30))
+
+    g.trip_counts = (today, counts)
+    return counts
+
+
+def invalidate_trip_counts():
+    """
+    标记行程计数需要失效（行程创建、发布、停用、恢复、归档、删除、复制时调用）
+
+    事务提交后才清除缓存，避免提交前被其他请求用旧数据重新填充
+    """
+    db.session.info['trip_counts_dirty'] = True
+
+
+def clear_trip_counts():
+    """立即清空行程计数缓存（本进程 + 当前请求）"""
+    _trip_counts_cache.clear()
+    if has_app_context():
+        g.pop('trip_counts', None)
+
+
+@event.listens_for(db.session, 'after_commit')
+def _invalidate_report_cache_after_commit(session):
+    for trip_id in session.info.pop('report_dirty_trip_ids', ()):
+        invalidate_trip_report_cache(trip_id)
+    if session.info.pop('trip_counts_dirty', False):
+        clear_trip_counts()
+
+
+@event.listens_for(db.session, 'after_rollback')
+def _discard_report_invalidations(session):
+    session.info.pop('report_dirty_trip_ids', None)
+    session.info.pop('trip_counts_dirty', None)
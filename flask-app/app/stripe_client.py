@@ -0,0 +1,140 @@
+"""
+Stripe 客户端
+每个进程初始化一次：keep-alive 连接池、连接/读取超时、幂等重试（SDK 内置指数退避）和熔断器。
+所有 Stripe API 调用都通过 stripe_call() 发出。
+"""
+
+import os
+import threading
+import time
+import requests
+import stripe
+from requests.adapters import HTTPAdapter
+from flask import current_app
+
+
+class StripeUnavailable(stripe.error.APIConnectionError):
+    """熔断器打开期间直接失败，不再请求 Stripe"""
+
+
+class CircuitBreaker:
+    """
+    连续失败 failure_threshold 次后打开，reset_timeout 秒内的调用直接失败；
+    之后放行一个试探请求（half-open），成功则关闭，失败则重新打开。
+    """
+
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = None
+        self._probing = False
+        self.rejected = 0
+
+    def allow(self):
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if not self._probing and time.monotonic() - self._opened_at >= self.reset_timeout:
+                self._probing = True
+                return True
+            self.rejected += 1
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._probing or self._failures >= self.failure_threshold:
+                self._opened_at = time.monotonic()
+            self._probing = False
+
+    def stats(self):
+        with self._lock:
+            if self._opened_at is None:
+                state = 'closed'
+            elif self._probing:
+                state = 'half_open'
+            else:
+                state = 'open'
+            return {'state': state, 'consecutive_failures': self._failures, 'rejected': self.rejected}
+
+
+_breaker = CircuitBreaker()
+_http_client = None
+_http_client_pid = None
+_client_lock = threading.Lock()
+
+# 网络错误、超时、限流和 Stripe 5xx 计入熔断；卡被拒、参数错误等业务错误不计入
+_BREAKER_ERRORS = (stripe.error.APIConnectionError, stripe.error.APIError, stripe.error.RateLimitError)
+
+
+def init_stripe(app):
+    """在应用工厂中调用：设置 API key、重试次数和熔断参数"""
+    stripe.api_key = app.config.get('STRIPE_SECRET_KEY')
+    # SDK 对 POST 自动附带 Idempotency-Key，重试不会重复扣款
+    stripe.max_network_retries = app.config.get('STRIPE_MAX_NETWORK_RETRIES', 2)
+    _breaker.failure_threshold = app.config.get('STRIPE_BREAKER_FAILURES', 5)
+    _breaker.reset_timeout = app.config.get('STRIPE_BREAKER_RESET_SECONDS', 30)
+
+
+def _ensure_http_client():
+    """按进程创建 HTTP 客户端（gunicorn fork 之后各 worker 持有自己的连接池）"""
+    global _http_client, _http_client_pid
+    pid = os.getpid()
+    if _http_client is not None and _http_client_pid == pid:
+        return _http_client
+    with _client_lock:
+        if _http_client is None or _http_client_pid != pid:
+            config = current_app.config
+            session = requests.Session()
+            pool_size = config.get('STRIPE_HTTP_POOL_SIZE', 10)
+            session.mount('https://', HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size))
+            timeout = (
+                config.get('STRIPE_CONNECT_TIMEOUT', 3.05),
+                config.get('STRIPE_READ_TIMEOUT', 15)
+            )
+            _http_client = stripe.http_client.RequestsClient(timeout=timeout, session=session)
+            _http_client_pid = pid
+            stripe.default_http_client = _http_client
+    return _http_client
+
+
+def stripe_configured():
+    if not stripe.api_key:
+        stripe.api_key = current_app.config.get('STRIPE_SECRET_KEY')
+    return bool(stripe.api_key)
+
+
+def stripe_call(method, *args, **kwargs):
+    """
+    通过共享客户端调用 Stripe API（如 stripe_call(stripe.PaymentIntent.retrieve, pi_id)）
+
+    Raises:
+        StripeUnavailable: 熔断器打开
+        stripe.error.StripeError: SDK 重试后仍失败
+    """
+    _ensure_http_client()
+    if not _breaker.allow():
+        raise StripeUnavailable('Stripe circuit breaker is open')
+    try:
+        result = method(*args, **kwargs)
+    except _BREAKER_ERRORS:
+        _breaker.record_failure()
+        raise
+    except Exception:
+        # 业务错误说明 Stripe 可用
+        _breaker.record_success()
+        raise
+    _breaker.record_success()
+    return result
+
+
+def stripe_client_stats():
+    return {'breaker': _breaker.stats(), 'max_network_retries': stripe.max_network_retries}
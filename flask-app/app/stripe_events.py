@@ -0,0 +1,321 @@
+"""
+Stripe Webhook 事件收件箱
+Webhook 验签后只把事件写入 stripe_events（event_id 唯一，重复投递直接跳过）并立即返回 200；
+后台任务按 PaymentIntent 分组、按 Stripe 创建时间顺序处理，失败按指数退避重试，超过次数进入死信（status='dead'）。
+处理台账（processed_stripe_events）保证同一事件、同一对象的一次性处理器只执行一次。
+"""
+
+from datetime import datetime, timedelta
+import stripe
+from flask import current_app
+from sqlalchemy import and_, or_
+from sqlalchemy.exc import IntegrityError
+from app import db
+from app.models import StripeEvent, ProcessedStripeEvent
+
+
+# 仍占用排序位置的状态：同一 PaymentIntent 的后续事件要等它们结束
+UNFINISHED_STATUSES = ('pending', 'processing')
+
+JOB_ID = 'process_stripe_events'
+
+# 事件级台账的 handler 名
+EVENT_LEDGER_HANDLER = 'event'
+
+
+def _event_object_key(event):
+    """事件的排序键：PaymentIntent ID；charge / checkout session 等对象取其关联的 PaymentIntent，没有时用对象自身 ID"""
+    obj = (event.get('data') or {}).get('object') or {}
+    if obj.get('object') == 'payment_intent':
+        return obj.get('id')
+    payment_intent = obj.get('payment_intent')
+    if isinstance(payment_intent, dict):
+        payment_intent = payment_intent.get('id')
+    return payment_intent or obj.get('id')
+
+
+def record_stripe_event(event):
+    """
+    把验签通过的事件写入收件箱（不提交事务）
+
+    Args:
+        event: 已解析的事件 dict（Webhook 原始 JSON）
+
+    Returns:
+        bool: True 表示新事件；False 表示重复投递，已存在
+    """
+    row = StripeEvent(
+        event_id=event['id'],
+        event_type=event.get('type') or 'unknown',
+        object_id=_event_object_key(event),
+        stripe_created=event.get('created'),
+        payload=event,
+        status='pending',
+        attempts=0,
+        next_attempt_at=datetime.utcnow()
+    )
+    try:
+        with db.session.begin_nested():
+            db.session.add(row)
+    except IntegrityError:
+        return False
+    return True
+
+
+def _claim_ledger(**values):
+    """插入台账行（SAVEPOINT 内），唯一约束冲突返回 False；不提交事务，台账行随调用方的事务一起提交或回滚"""
+    try:
+        with db.session.begin_nested():
+            db.session.add(ProcessedStripeEvent(**values))
+    except IntegrityError:
+        return False
+    return True
+
+
+def claim_stripe_event(event_id):
+    """
+    领取事件级台账（收件箱任务处理事件前调用）
+
+    Returns:
+        bool: True 表示首次处理；False 表示该事件已处理过
+    """
+    return _claim_ledger(event_id=event_id, handler=EVENT_LEDGER_HANDLER)
+
+
+def release_stripe_event_claim(event_id):
+    """事件处理失败时删除事件级台账（已提交的对象级台账保留，重试时对应处理器直接跳过）"""
+    return ProcessedStripeEvent.query.filter_by(
+        event_id=event_id,
+        handler=EVENT_LEDGER_HANDLER
+    ).delete(synchronize_session=False)
+
+
+def claim_stripe_object(object_id, handler):
+    """
+    领取对象级台账（一次性处理器开始时调用，所有入口共用：webhook 收件箱、支付状态轮询兜底）
+
+    并发调用时后插入的一方会等待先插入的事务结束：提交则冲突跳过，回滚则由它接着处理。
+
+    Args:
+        object_id: Stripe 对象 ID（PaymentIntent / Checkout Session）
+        handler: 处理器名
+
+    Returns:
+        bool: True 表示由本次调用处理；False 表示已处理过，应直接返回
+    """
+    if not object_id:
+        return True
+    return _claim_ledger(object_id=object_id, handler=handler)
+
+
+def wake_stripe_event_worker(app):
+    """
+    让本进程的后台任务尽快运行一次（调度器未启动时什么也不做，等下一个周期）
+
+    其他进程正持有任务锁时本次运行直接跳过；那个进程会循环处理到没有可处理的事件，
+    或由下一个 STRIPE_EVENT_POLL_SECONDS 周期处理
+    """
+    scheduler = getattr(app, 'scheduler', None)
+    if scheduler is None:
+        return
+    try:
+        scheduler.modify_job(JOB_ID, next_run_time=datetime.now())
+    except Exception as e:
+        app.logger.debug(f"Could not wake stripe event worker: {str(e)}")
+
+
+def _retry_delay(attempts):
+    base = current_app.config.get('STRIPE_EVENT_RETRY_BASE_SECONDS', 30)
+    cap = current_app.config.get('STRIPE_EVENT_RETRY_MAX_SECONDS', 3600)
+    return timedelta(seconds=min(base * (2 ** max(attempts - 1, 0)), cap))
+
+
+def _release_stale_claims(now):
+    """worker 领取后崩溃的事件（processing 超过 STRIPE_EVENT_LOCK_SECONDS）放回队列"""
+    lock_seconds = current_app.config.get('STRIPE_EVENT_LOCK_SECONDS', 300)
+    return StripeEvent.query.filter(
+        StripeEvent.status == 'processing',
+        StripeEvent.locked_at < now - timedelta(seconds=lock_seconds)
+    ).update({
+        'status': 'pending',
+        'next_attempt_at': now,
+        'locked_at': None
+    }, synchronize_session=False)
+
+
+def _has_earlier_unfinished(event_pk, object_id, stripe_created):
+    """同一 PaymentIntent 是否还有更早的未完成事件（含退避中的事件）"""
+    if not object_id:
+        return False
+    created = stripe_created or 0
+    earlier = db.session.query(StripeEvent.id).filter(
+        StripeEvent.object_id == object_id,
+        StripeEvent.status.in_(UNFINISHED_STATUSES),
+        or_(
+            db.func.coalesce(StripeEvent.stripe_created, 0) < created,
+            and_(db.func.coalesce(StripeEvent.stripe_created, 0) == created, StripeEvent.id < event_pk)
+        )
+    ).first()
+    return earlier is not None
+
+
+def _claim(event_pk, now):
+    """原子领取：pending -> processing，多个 worker 同时运行时只有一个成功"""
+    claimed = StripeEvent.query.filter(
+        StripeEvent.id == event_pk,
+        StripeEvent.status == 'pending'
+    ).update({
+        'status': 'processing',
+        'locked_at': now,
+        'attempts': StripeEvent.attempts + 1
+    }, synchronize_session=False)
+    db.session.commit()
+    return claimed == 1
+
+
+def _record_failure(event_pk, error):
+    """记录失败：未到最大次数时按退避时间放回队列，否则进入死信"""
+    event = db.session.get(StripeEvent, event_pk)
+    if event is None:
+        return 'missing'
+    # 部分处理器可能已提交；去掉事件级台账，重试时只有未完成的处理器会执行
+    release_stripe_event_claim(event.event_id)
+    max_attempts = current_app.config.get('STRIPE_EVENT_MAX_ATTEMPTS', 8)
+    event.last_error = str(error)[:2000]
+    event.locked_at = None
+    if (event.attempts or 0) >= max_attempts:
+        event.status = 'dead'
+        current_app.logger.error(
+            "stripe event dead-lettered event_id=%s type=%s attempts=%s error=%s",
+            event.event_id, event.event_type, event.attempts, event.last_error
+        )
+    else:
+        event.status = 'pending'
+        event.next_attempt_at = datetime.utcnow() + _retry_delay(event.attempts or 0)
+    db.session.commit()
+    return event.status
+
+
+def process_stripe_events(batch_size=None):
+    """
+    处理一批到期的收件箱事件（由定时任务调用）
+
+    候选事件按 (Stripe 创建时间, id) 排序；同一 PaymentIntent 有更早的未完成事件时本次跳过，
+    保证同一 PaymentIntent 的事件按顺序处理。每个事件单独领取、单独提交。
+
+    Args:
+        batch_size: 每批最多处理的事件数（默认 STRIPE_EVENT_BATCH_SIZE）
+
+    Returns:
+        dict: {'processed', 'retried', 'dead', 'deferred'}
+    """
+    from app.routes import dispatch_stripe_event
+
+    batch_size = batch_size or current_app.config.get('STRIPE_EVENT_BATCH_SIZE', 50)
+    now = datetime.utcnow()
+    result = {'processed': 0, 'retried': 0, 'dead': 0, 'deferred': 0}
+
+    if _release_stale_claims(now):
+        db.session.commit()
+
+    candidates = db.session.query(
+        StripeEvent.id,
+        StripeEvent.object_id,
+        StripeEvent.stripe_created
+    ).filter(
+        StripeEvent.status == 'pending',
+        StripeEvent.next_attempt_at <= now
+    ).order_by(
+        db.func.coalesce(StripeEvent.stripe_created, 0),
+        StripeEvent.id
+    ).limit(batch_size).all()
+    db.session.commit()
+
+    # 本批中已失败 / 被跳过的 PaymentIntent，后续事件不再处理
+    blocked = set()
+    for event_pk, object_id, stripe_created in candidates:
+        if object_id and (object_id in blocked or _has_earlier_unfinished(event_pk, object_id, stripe_created)):
+            blocked.add(object_id)
+            result['deferred'] += 1
+            continue
+        if not _claim(event_pk, now):
+            continue
+
+        row = db.session.get(StripeEvent, event_pk)
+        try:
+            if claim_stripe_event(row.event_id):
+                event = stripe.Event.construct_from(row.payload, stripe.api_key)
+                dispatch_stripe_event(event)
+            else:
+                current_app.logger.info(f"Stripe event {row.event_id} already processed, skipping")
+            # 处理器内部可能已经提交；重新取一次，标记完成
+            row = db.session.get(StripeEvent, event_pk)
+            row.status = 'done'
+            row.processed_at = datetime.utcnow()
+            row.locked_at = None
+            row.last_error = None
+            db.session.commit()
+            result['processed'] += 1
+        except Exception as e:
+            db.session.rollback()
+            current_app.logger.error(f"Error processing stripe event {event_pk}: {str(e)}")
+            status = _record_failure(event_pk, e)
+            if object_id:
+                blocked.add(object_id)
+            result['dead' if status == 'dead' else 'retried'] += 1
+
+    return result
+
+
+def retry_dead_event(event_pk):
+    """把死信事件重新放回队列（管理后台手动重试），不提交事务"""
+    event = db.session.get(StripeEvent, event_pk)
+    if event is None or event.status != 'dead':
+        return None
+    event.status = 'pending'
+    event.attempts = 0
+    event.next_attempt_at = datetime.utcnow()
+    event.locked_at = None
+    return event
+
+
+def get_stripe_event_backlog(limit=50):
+    """
+    收件箱积压情况（管理后台）
+
+    Returns:
+        dict: {
+            'counts': {status: 数量},
+            'oldest_pending_at': 最早的待处理事件接收时间,
+            'lag_seconds': 最早待处理事件已等待的秒数,
+            'failing': 重试中的事件列表,
+            'dead': 死信事件列表
+        }
+    """
+    counts = {status: 0 for status in StripeEvent.STATUSES}
+    rows = db.session.query(StripeEvent.status, db.func.count(StripeEvent.id)).group_by(StripeEvent.status).all()
+    for status, count in rows:
+        counts[status] = int(count or 0)
+
+    oldest_pending_at = db.session.query(db.func.min(StripeEvent.received_at)).filter(
+        StripeEvent.status.in_(UNFINISHED_STATUSES)
+    ).scalar()
+    lag_seconds = None
+    if oldest_pending_at:
+        lag_seconds = max(int((datetime.utcnow() - oldest_pending_at).total_seconds()), 0)
+
+    failing = StripeEvent.query.filter(
+        StripeEvent.status == 'pending',
+        StripeEvent.attempts > 0
+    ).order_by(StripeEvent.next_attempt_at).limit(limit).all()
+    dead = StripeEvent.query.filter(
+        StripeEvent.status == 'dead'
+    ).order_by(StripeEvent.id.desc()).limit(limit).all()
+
+    return {
+        'counts': counts,
+        'oldest_pending_at': oldest_pending_at,
+        'lag_seconds': lag_seconds,
+        'failing': failing,
+        'dead': dead
+    }
@@ -1,16 +1,77 @@
 """
 定时任务模块
 使用 APScheduler 实现分期付款提醒等功能
+
+gunicorn 的每个 worker 都会启动调度器；所有任务都用 single_instance 包装：
+推入应用上下文并先取数据库锁，同一任务同一时刻只有一个进程（跨容器）执行，其余进程本次直接跳过。
+任务函数本身不再推入应用上下文。
 """
 
+import zlib
+from contextlib import contextmanager
 from datetime import datetime, timedelta, date
+from functools import wraps
 from flask import current_app, url_for
+from sqlalchemy import text
 from app import db
 from app.models import InstallmentPayment
 from app.utils import send_email_via_ses, generate_installment_token
 
 
-def send_installment_reminders():
+@contextmanager
+def job_lock(name):
+    """
+    跨进程的任务互斥锁（不等待）
+
+    MySQL 用 GET_LOCK，PostgreSQL 用 pg_try_advisory_lock，都绑定在一条专用连接上，
+    进程崩溃时连接断开锁即释放；其他数据库（SQLite 单机开发）不加锁。需要应用上下文。
+
+    Yields:
+        bool: 是否拿到锁
+    """
+    dialect = db.engine.dialect.name
+    if dialect not in ('mysql', 'mariadb', 'postgresql'):
+        yield True
+        return
+
+    lock_name = f'nhtours:{name}'
+    # 自动提交：持锁期间不留空闲事务
+    conn = db.engine.connect().execution_options(isolation_level='AUTOCOMMIT')
+    try:
+        if dialect == 'postgresql':
+            key = zlib.crc32(lock_name.encode())
+            acquired = bool(conn.execute(text('SELECT pg_try_advisory_lock(:key)'), {'key': key}).scalar())
+        else:
+            acquired = conn.execute(text('SELECT GET_LOCK(:name, 0)'), {'name': lock_name}).scalar() == 1
+        try:
+            yield acquired
+        finally:
+            if acquired:
+                if dialect == 'postgresql':
+                    conn.execute(text('SELECT pg_advisory_unlock(:key)'), {'key': key})
+                else:
+                    conn.execute(text('SELECT RELEASE_LOCK(:name)'), {'name': lock_name})
+    finally:
+        conn.close()
+
+
+def single_instance(name):
+    """任务装饰器：在 app 的应用上下文中拿到 job_lock 才执行，否则本次跳过（其他进程正在执行）"""
+    def decorator(func):
+        @wraps(func)
+        def wrapper(app):
+            with app.app_context():
+                with job_lock(name) as acquired:
+                    if not acquired:
+                        app.logger.debug("job %s skipped: running in another process", name)
+                        return None
+                    return func(app)
+        return wrapper
+    return decorator
+
+
+@single_instance('send_installment_reminders')
+def send_installment_reminders(app):
     """
     发送分期付款提醒邮件
     每天运行，检查即将到期的分期付款
@@ -20,89 +81,169 @@ def send_installment_reminders():
     - 到期当天：最后提醒
     - 逾期后：催款邮件（每 3 天一次，最多 3 次）
     """
-    with current_app.app_context():
-        try:
-            today = date.today()
-            
-            # 1. 3 天前提醒
-            three_days_later = today + timedelta(days=3)
-            installments_3days = InstallmentPayment.query.filter(
-                InstallmentPayment.due_date == three_days_later,
-                InstallmentPayment.status == 'pending',
-                InstallmentPayment.reminder_sent == False
-            ).all()
-            
-            for installment in installments_3days:
-                send_installment_reminder_email(installment, days_until_due=3)
-                installment.reminder_sent = True
+    try:
+        today = date.today()
+        
+        # 1. 3 天前提醒
+        three_days_later = today + timedelta(days=3)
+        installments_3days = InstallmentPayment.query.filter(
+            InstallmentPayment.due_date == three_days_later,
+            InstallmentPayment.status == 'pending',
+            InstallmentPayment.reminder_sent == False
+        ).all()
+        
+        for installment in installments_3days:
+            send_installment_reminder_email(installment, days_until_due=3)
+            installment.reminder_sent = True
+            installment.reminder_sent_at = datetime.utcnow()
+            installment.reminder_count = (installment.reminder_count or 0) + 1
+        
+        # 2. 1 天前提醒
+        one_day_later = today + timedelta(days=1)
+        installments_1day = InstallmentPayment.query.filter(
+            InstallmentPayment.due_date == one_day_later,
+            InstallmentPayment.status == 'pending',
+            InstallmentPayment.reminder_count >= 1  # 已经发送过第一次提醒
+        ).all()
+        
+        for installment in installments_1day:
+            # 检查今天是否已经发送过提醒（避免重复）
+            if installment.reminder_sent_at and installment.reminder_sent_at.date() < today:
+                send_installment_reminder_email(installment, days_until_due=1)
                 installment.reminder_sent_at = datetime.utcnow()
                 installment.reminder_count = (installment.reminder_count or 0) + 1
+        
+        # 3. 到期当天提醒
+        installments_today = InstallmentPayment.query.filter(
+            InstallmentPayment.due_date == today,
+            InstallmentPayment.status == 'pending'
+        ).all()
+        
+        for installment in installments_today:
+            # 检查今天是否已经发送过提醒
+            if not installment.reminder_sent_at or installment.reminder_sent_at.date() < today:
+                send_installment_reminder_email(installment, days_until_due=0)
+                installment.reminder_sent_at = datetime.utcnow()
+                installment.reminder_count = (installment.reminder_count or 0) + 1
+        
+        # 4. 逾期催款（每 3 天一次，最多 3 次）
+        overdue_installments = InstallmentPayment.query.filter(
+            InstallmentPayment.due_date < today,
+            InstallmentPayment.status == 'pending',
+            InstallmentPayment.reminder_count < 6  # 最多发送 6 次提醒（3次正常 + 3次催款）
+        ).all()
+        
+        for installment in overdue_installments:
+            # 检查距离上次提醒是否已经超过 3 天
+            days_overdue = (today - installment.due_date).days
+            should_send = False
             
-            # 2. 1 天前提醒
-            one_day_later = today + timedelta(days=1)
-            installments_1day = InstallmentPayment.query.filter(
-                InstallmentPayment.due_date == one_day_later,
-                InstallmentPayment.status == 'pending',
-                InstallmentPayment.reminder_count >= 1  # 已经发送过第一次提醒
-            ).all()
-            
-            for installment in installments_1day:
-                # 检查今天是否已经发送过提醒（避免重复）
-                if installment.reminder_sent_at and installment.reminder_sent_at.date() < today:
-                    send_installment_reminder_email(installment, days_until_due=1)
-                    installment.reminder_sent_at = datetime.utcnow()
-                    installment.reminder_count = (installment.reminder_count or 0) + 1
-            
-            # 3. 到期当天提醒
-            installments_today = InstallmentPayment.query.filter(
-                InstallmentPayment.due_date == today,
-                InstallmentPayment.status == 'pending'
-            ).all()
-            
-            for installment in installments_today:
-                # 检查今天是否已经发送过提醒
-                if not installment.reminder_sent_at or installment.reminder_sent_at.date() < today:
-                    send_installment_reminder_email(installment, days_until_due=0)
-                    installment.reminder_sent_at = datetime.utcnow()
-                    installment.reminder_count = (installment.reminder_count or 0) + 1
-            
-            # 4. 逾期催款（每 3 天一次，最多 3 次）
-            overdue_installments = InstallmentPayment.query.filter(
-                InstallmentPayment.due_date < today,
-                InstallmentPayment.status == 'pending',
-                InstallmentPayment.reminder_count < 6  # 最多发送 6 次提醒（3次正常 + 3次催款）
-            ).all()
-            
-            for installment in overdue_installments:
-                # 检查距离上次提醒是否已经超过 3 天
-                days_overdue = (today - installment.due_date).days
-                should_send = False
-                
-                if not installment.reminder_sent_at:
-                    # 从未发送过提醒，立即发送
+            if not installment.reminder_sent_at:
+                # 从未发送过提醒，立即发送
+                should_send = True
+            else:
+                days_since_last_reminder = (today - installment.reminder_sent_at.date()).days
+                # 每 3 天发送一次催款邮件
+                if days_since_last_reminder >= 3:
                     should_send = True
-                else:
-                    days_since_last_reminder = (today - installment.reminder_sent_at.date()).days
-                    # 每 3 天发送一次催款邮件
-                    if days_since_last_reminder >= 3:
-                        should_send = True
-                
-                if should_send:
-                    send_overdue_reminder_email(installment, days_overdue)
-                    installment.reminder_sent_at = datetime.utcnow()
-                    installment.reminder_count = (installment.reminder_count or 0) + 1
-                    # 标记为逾期状态
-                    if installment.status == 'pending':
-                        installment.status = 'overdue'
             
+            if should_send:
+                send_overdue_reminder_email(installment, days_overdue)
+                installment.reminder_sent_at = datetime.utcnow()
+                installment.reminder_count = (installment.reminder_count or 0) + 1
+                # 标记为逾期状态
+                if installment.status == 'pending':
+                    installment.status = 'overdue'
+        
+        db.session.commit()
+        current_app.logger.info(f"Installment reminders processed: {len(installments_3days) + len(installments_1day) + len(installments_today)} reminders sent")
+        
+    except Exception as e:
+        db.session.rollback()
+        current_app.logger.error(f"Error sending installment reminders: {str(e)}")
+        import traceback
+        traceback.print_exc()
+
+
+@single_instance('update_revenue_rollup')
+def update_revenue_rollup_job(app):
+    """
+    增量更新每日收入汇总表（revenue_daily）
+    按固定间隔运行，从上次水位线继续
+    """
+    from app.revenue import update_revenue_rollup
+    
+    try:
+        result = update_revenue_rollup()
+        app.logger.info(
+            "revenue rollup done days=%s rows=%s watermark=%s",
+            result['days'],
+            result['rows'],
+            result['watermark'].isoformat(),
+        )
+    except Exception as e:
+        db.session.rollback()
+        app.logger.error(f"Error updating revenue rollup: {str(e)}")
+
+
+@single_instance('sweep_expired_checkouts')
+def sweep_expired_checkouts_job(app):
+    """
+    清理过期的结账：PendingBooking 标记过期 / 保留期后删除，释放已过期的套餐名额锁定
+    按批处理，每批一个事务
+    """
+    from app.inventory import release_expired_holds
+    from app.pending_bookings import sweep_pending_bookings
+    
+    try:
+        result = sweep_pending_bookings()
+        released = 0
+        while True:
+            count = release_expired_holds()
             db.session.commit()
-            current_app.logger.info(f"Installment reminders processed: {len(installments_3days) + len(installments_1day) + len(installments_today)} reminders sent")
-            
-        except Exception as e:
-            db.session.rollback()
-            current_app.logger.error(f"Error sending installment reminders: {str(e)}")
-            import traceback
-            traceback.print_exc()
+            released += count
+            if count == 0:
+                break
+        if result['expired'] or result['deleted'] or released:
+            app.logger.info(
+                "pending bookings swept expired=%s deleted=%s intents_cancelled=%s holds_released=%s",
+                result['expired'],
+                result['deleted'],
+                result['intents_cancelled'],
+                released,
+            )
+    except Exception as e:
+        db.session.rollback()
+        app.logger.error(f"Error sweeping expired checkouts: {str(e)}")
+
+
+@single_instance('process_stripe_events')
+def process_stripe_events_job(app):
+    """
+    处理 Stripe Webhook 收件箱（stripe_events）
+    每批一个循环，直到没有可处理的事件；失败的事件按退避时间留给之后的周期
+    """
+    from app.stripe_events import process_stripe_events
+    
+    try:
+        totals = {'processed': 0, 'retried': 0, 'dead': 0, 'deferred': 0}
+        while True:
+            result = process_stripe_events()
+            for key, value in result.items():
+                totals[key] += value
+            if result['processed'] == 0:
+                break
+        if totals['processed'] or totals['retried'] or totals['dead']:
+            app.logger.info(
+                "stripe events processed=%s retried=%s dead=%s deferred=%s",
+                totals['processed'],
+                totals['retried'],
+                totals['dead'],
+                totals['deferred'],
+            )
+    except Exception as e:
+        db.session.rollback()
+        app.logger.error(f"Error processing stripe events: {str(e)}")
 
 
 def send_installment_reminder_email(installment, days_until_due=3):
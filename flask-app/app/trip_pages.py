@@ -0,0 +1,99 @@
+"""
+公开行程报名页快照
+把行程内容、行程安排、购买者字段、套餐、附加项、自定义问题读成只读快照，按 slug 缓存；
+版本戳是 Trip.updated_at（后台行程构造器每次保存任何步骤都会刷新它），因此各 worker 无需广播失效。
+剩余名额和 CSRF token 仍然每次请求单独计算。
+"""
+
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+from flask import current_app
+from sqlalchemy import inspect as sa_inspect
+from app import db
+from app.cache import TTLCache
+from app.models import Trip, ItineraryItem, BuyerInfoField, TripPackage, TripAddOn, CustomQuestion
+
+
+_page_cache = TTLCache(maxsize=512)
+
+# updated_at 在 MySQL 上只精确到秒：刚修改过的行程不缓存，避免同一秒内的两次保存共用一个版本戳
+_STAMP_SETTLE = timedelta(seconds=1)
+
+
+def _freeze(obj):
+    """把 ORM 对象的列值复制成只读属性对象（模板只按属性访问列字段）"""
+    return SimpleNamespace(**{
+        attr.key: getattr(obj, attr.key)
+        for attr in sa_inspect(obj).mapper.column_attrs
+    })
+
+
+def _build_snapshot(trip_id):
+    trip = db.session.get(Trip, trip_id)
+    if trip is None:
+        return None
+
+    return {
+        'trip': _freeze(trip),
+        'itinerary_items': [
+            _freeze(item) for item in
+            ItineraryItem.query.filter_by(trip_id=trip_id).order_by(ItineraryItem.day_number).all()
+        ],
+        'buyer_info_fields': [
+            _freeze(field) for field in
+            BuyerInfoField.query.filter_by(trip_id=trip_id).order_by(BuyerInfoField.display_order).all()
+        ],
+        'packages': [
+            _freeze(package) for package in
+            TripPackage.query.filter_by(trip_id=trip_id, status='available').order_by(TripPackage.id).all()
+        ],
+        'addons': [
+            _freeze(addon) for addon in
+            TripAddOn.query.filter_by(trip_id=trip_id).order_by(TripAddOn.id).all()
+        ],
+        'custom_questions': [
+            _freeze(question) for question in
+            CustomQuestion.query.filter_by(trip_id=trip_id).order_by(CustomQuestion.id).all()
+        ]
+    }
+
+
+def get_trip_page_snapshot(trip_id, slug, updated_at):
+    """
+    获取公开报名页的内容快照
+
+    Args:
+        trip_id: 行程 ID
+        slug: 行程 slug（缓存键）
+        updated_at: 当前 Trip.updated_at（版本戳，调用方已查询过）
+
+    Returns:
+        dict: {'trip', 'itinerary_items', 'buyer_info_fields', 'packages', 'addons', 'custom_questions'}，
+        行程不存在时返回 None
+    """
+    cached = _page_cache.get(slug)
+    if cached is not None:
+        cached_trip_id, cached_stamp, snapshot = cached
+        if cached_trip_id == trip_id and cached_stamp == updated_at:
+            return snapshot
+
+    snapshot = _build_snapshot(trip_id)
+    if snapshot is None:
+        _page_cache.pop(slug)
+        return None
+
+    if updated_at is not None and updated_at < datetime.utcnow() - _STAMP_SETTLE:
+        ttl = current_app.config.get('TRIP_PAGE_CACHE_TTL', 300)
+        _page_cache.set(slug, (trip_id, updated_at, snapshot), ttl=ttl)
+    return snapshot
+
+
+def invalidate_trip_page(trip):
+    """
+    让行程的公开报名页快照失效（刷新 Trip.updated_at，随调用方的事务一起提交）
+
+    套餐、附加项等子表的修改不会触发 Trip 的 onupdate，所以构造器保存时显式刷新版本戳。
+    """
+    trip.updated_at = datetime.utcnow()
+    if trip.slug:
+        _page_cache.pop(trip.slug)
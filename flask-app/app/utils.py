@@ -145,17 +145,15 @@ def handle_contact_submission(data):
     phone = data.get('phone', '').strip()
     organization = data.get('organization', '').strip()
     message = data.get('message', '').strip()
-    interests = data.get('interest', [])
+    # 写入前规范化为字符串列表，后台列表无需再逐条解析
+    interests = Lead.normalize_interests(data.get('interest', []))
     
     # 验证必填字段
     if not first_name or not last_name or not email or not message:
         return False, '请填写所有必填字段'
     
     # 格式化兴趣列表
-    if isinstance(interests, list):
-        interests_str = ', '.join(interests) if interests else '未选择'
-    else:
-        interests_str = str(interests) if interests else '未选择'
+    interests_str = ', '.join(interests) if interests else '未选择'
     
     # 保存到数据库
     try:
@@ -164,7 +162,7 @@ def handle_contact_submission(data):
             email=email,
             phone=phone,
             organization=organization,
-            interest=json.dumps(interests) if isinstance(interests, list) else str(interests),
+            interest=json.dumps(interests),
             message=message,
             status='new'
         )
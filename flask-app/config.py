@@ -26,11 +26,57 @@ class Config:
     # 数据库配置 (必须提供 DATABASE_URL)
     SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL')
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    # MySQL / MariaDB 使用 READ COMMITTED（与 PostgreSQL 默认一致）：加行锁等待后的普通 SELECT 能读到刚提交的数据，
+    # 财务账本刷新、库存重算依赖这一点（REPEATABLE READ 下读的是事务开始时的快照）。需 binlog_format=ROW（MySQL 8 默认）
+    SQLALCHEMY_ENGINE_OPTIONS = (
+        {'isolation_level': 'READ COMMITTED'}
+        if (SQLALCHEMY_DATABASE_URI or '').startswith(('mysql', 'mariadb')) else {}
+    )
 
     # Stripe支付配置
     STRIPE_PUBLISHABLE_KEY = os.environ.get('STRIPE_PUBLISHABLE_KEY')
     STRIPE_SECRET_KEY = os.environ.get('STRIPE_SECRET_KEY')
     STRIPE_WEBHOOK_SECRET = os.environ.get('STRIPE_WEBHOOK_SECRET')
+    STRIPE_CONNECT_TIMEOUT = float(os.environ.get('STRIPE_CONNECT_TIMEOUT', 3.05))
+    STRIPE_READ_TIMEOUT = float(os.environ.get('STRIPE_READ_TIMEOUT', 15))  # 远低于 gunicorn 的 120 秒超时
+    STRIPE_MAX_NETWORK_RETRIES = int(os.environ.get('STRIPE_MAX_NETWORK_RETRIES', 2))  # SDK 内置指数退避 + 幂等键
+    STRIPE_HTTP_POOL_SIZE = int(os.environ.get('STRIPE_HTTP_POOL_SIZE', 10))
+    STRIPE_BREAKER_FAILURES = int(os.environ.get('STRIPE_BREAKER_FAILURES', 5))  # 连续失败多少次后熔断
+    STRIPE_BREAKER_RESET_SECONDS = int(os.environ.get('STRIPE_BREAKER_RESET_SECONDS', 30))
+    
+    # 缓存配置（秒）
+    REPORTS_CACHE_TTL = int(os.environ.get('REPORTS_CACHE_TTL', 300))  # Reports 分类列表缓存
+    REPORT_TRIP_STATS_CACHE_TTL = int(os.environ.get('REPORT_TRIP_STATS_CACHE_TTL', 3600))  # Reports 单个行程汇总（按版本戳校验，过期只是兜底）
+    TRIP_COUNTS_CACHE_TTL = int(os.environ.get('TRIP_COUNTS_CACHE_TTL', 30))  # 后台侧边栏行程计数
+    AVAILABILITY_CACHE_TTL = int(os.environ.get('AVAILABILITY_CACHE_TTL', 5))  # 行程页套餐剩余名额
+    TRIP_PAGE_CACHE_TTL = int(os.environ.get('TRIP_PAGE_CACHE_TTL', 300))  # 公开报名页内容快照（按 Trip.updated_at 失效）
+    PAYMENT_METHOD_CACHE_TTL = int(os.environ.get('PAYMENT_METHOD_CACHE_TTL', 900))  # 报价时卡片 funding / brand 缓存
+    DISCOUNT_CODE_CACHE_TTL = int(os.environ.get('DISCOUNT_CODE_CACHE_TTL', 60))  # 折扣码快照（本进程保存优惠码时立即失效）
+    
+    # 收入汇总（revenue_daily）定时任务
+    REVENUE_ROLLUP_INTERVAL_MINUTES = int(os.environ.get('REVENUE_ROLLUP_INTERVAL_MINUTES', 10))
+    REVENUE_ROLLUP_OVERLAP_MINUTES = int(os.environ.get('REVENUE_ROLLUP_OVERLAP_MINUTES', 10))  # 回看窗口，覆盖晚提交的事务
+    
+    # 结账过期清理：任务间隔（同时释放过期的套餐名额锁定）、每批条数、过期 / 终态行保留小时数、是否取消对应的 PaymentIntent
+    INVENTORY_HOLD_SWEEP_MINUTES = int(os.environ.get('INVENTORY_HOLD_SWEEP_MINUTES', 5))
+    PENDING_BOOKING_SWEEP_BATCH = int(os.environ.get('PENDING_BOOKING_SWEEP_BATCH', 500))
+    PENDING_BOOKING_RETENTION_HOURS = int(os.environ.get('PENDING_BOOKING_RETENTION_HOURS', 168))  # 保留期内迟到的支付仍能创建预订
+    PENDING_BOOKING_CANCEL_INTENTS = os.environ.get('PENDING_BOOKING_CANCEL_INTENTS', 'false').lower() in ('1', 'true', 'yes')
+    
+    # 支付状态长轮询：单次请求最长等待秒数、跨 worker 的数据库复查间隔、
+    # 每个进程同时等待的请求数（gunicorn 每个 worker 8 个线程，其余线程留给其他请求）、名额用完时建议客户端重试间隔
+    PAYMENT_STATUS_MAX_WAIT = int(os.environ.get('PAYMENT_STATUS_MAX_WAIT', 5))
+    PAYMENT_STATUS_RECHECK_SECONDS = float(os.environ.get('PAYMENT_STATUS_RECHECK_SECONDS', 1))
+    PAYMENT_STATUS_MAX_WAITERS = int(os.environ.get('PAYMENT_STATUS_MAX_WAITERS', 2))
+    PAYMENT_STATUS_BUSY_RETRY_SECONDS = int(os.environ.get('PAYMENT_STATUS_BUSY_RETRY_SECONDS', 2))
+    
+    # Stripe Webhook 收件箱：后台处理间隔、每批条数、最大重试次数、退避基数/上限、领取超时（秒）
+    STRIPE_EVENT_POLL_SECONDS = int(os.environ.get('STRIPE_EVENT_POLL_SECONDS', 5))
+    STRIPE_EVENT_BATCH_SIZE = int(os.environ.get('STRIPE_EVENT_BATCH_SIZE', 50))
+    STRIPE_EVENT_MAX_ATTEMPTS = int(os.environ.get('STRIPE_EVENT_MAX_ATTEMPTS', 8))
+    STRIPE_EVENT_RETRY_BASE_SECONDS = int(os.environ.get('STRIPE_EVENT_RETRY_BASE_SECONDS', 30))
+    STRIPE_EVENT_RETRY_MAX_SECONDS = int(os.environ.get('STRIPE_EVENT_RETRY_MAX_SECONDS', 3600))
+    STRIPE_EVENT_LOCK_SECONDS = int(os.environ.get('STRIPE_EVENT_LOCK_SECONDS', 300))
     
     # Flask配置
     DEBUG = False
@@ -0,0 +1,52 @@
+"""add normalized unique email to clients
+
+Revision ID: add_client_email_normalized
+Revises: add_processed_stripe_events
+Create Date: 2026-10-17 21:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = 'add_client_email_normalized'
+down_revision = 'add_processed_stripe_events'
+branch_labels = None
+depends_on = None
+
+
+def _normalize(email):
+    # 与 Client.normalize_email 一致
+    if not email:
+        return None
+    return email.strip().lower() or None
+
+
+def upgrade():
+    with op.batch_alter_table('clients', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('email_normalized', sa.String(length=120), nullable=True))
+
+    # 回填：每个规范化邮箱只给最早的客户写入，其余重复客户留空，
+    # 由 scripts/merge_duplicate_clients.py 合并到这一行
+    bind = op.get_bind()
+    rows = bind.execute(sa.text(
+        "SELECT id, email FROM clients WHERE email IS NOT NULL ORDER BY id"
+    )).fetchall()
+    seen = set()
+    updates = []
+    for client_id, email in rows:
+        normalized = _normalize(email)
+        if normalized and normalized not in seen:
+            seen.add(normalized)
+            updates.append({'id': client_id, 'normalized': normalized})
+    if updates:
+        bind.execute(sa.text("UPDATE clients SET email_normalized = :normalized WHERE id = :id"), updates)
+
+    with op.batch_alter_table('clients', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_clients_email_normalized'), ['email_normalized'], unique=True)
+
+
+def downgrade():
+    with op.batch_alter_table('clients', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_clients_email_normalized'))
+        batch_op.drop_column('email_normalized')
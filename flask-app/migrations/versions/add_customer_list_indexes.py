@@ -0,0 +1,30 @@
+"""add indexes for the aggregated customers list
+
+Revision ID: add_customer_list_indexes
+Revises: add_revenue_daily_rollup
+Create Date: 2026-10-17 12:00:00.000000
+
+"""
+from alembic import op
+
+
+revision = 'add_customer_list_indexes'
+down_revision = 'add_revenue_daily_rollup'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('clients', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_clients_created_at'), ['created_at'], unique=False)
+
+    with op.batch_alter_table('bookings', schema=None) as batch_op:
+        batch_op.create_index('ix_bookings_client_created_paid', ['client_id', 'created_at', 'amount_paid'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('bookings', schema=None) as batch_op:
+        batch_op.drop_index('ix_bookings_client_created_paid')
+
+    with op.batch_alter_table('clients', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_clients_created_at'))
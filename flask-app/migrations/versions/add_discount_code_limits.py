@@ -0,0 +1,46 @@
+"""normalize discount codes and add max_uses / expires_at
+
+Revision ID: add_discount_code_limits
+Revises: add_client_email_normalized
+Create Date: 2026-10-17 22:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = 'add_discount_code_limits'
+down_revision = 'add_client_email_normalized'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('discount_codes', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('max_uses', sa.Integer(), nullable=True))
+        batch_op.add_column(sa.Column('expires_at', sa.DateTime(), nullable=True))
+
+    # 规范化已有折扣码（去空格 + 大写，与 DiscountCode.normalize_code 一致），查找改为直接比较 code 走唯一索引。
+    # 只差大小写的重复码保留 ID 最小的一个，其余保持原样并打印出来，需要在后台手动改名
+    bind = op.get_bind()
+    rows = bind.execute(sa.text("SELECT id, code FROM discount_codes ORDER BY id")).fetchall()
+    taken = {code for _id, code in rows}
+    updates = []
+    for code_id, code in rows:
+        normalized = (code or '').strip().upper()
+        if not normalized or normalized == code:
+            continue
+        if normalized in taken:
+            print(f"discount code {code_id} ({code!r}) conflicts with {normalized!r}; left unchanged")
+            continue
+        taken.discard(code)
+        taken.add(normalized)
+        updates.append({'id': code_id, 'code': normalized})
+    if updates:
+        bind.execute(sa.text("UPDATE discount_codes SET code = :code WHERE id = :id"), updates)
+
+
+def downgrade():
+    with op.batch_alter_table('discount_codes', schema=None) as batch_op:
+        batch_op.drop_column('expires_at')
+        batch_op.drop_column('max_uses')
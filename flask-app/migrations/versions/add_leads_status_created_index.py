@@ -0,0 +1,88 @@
+"""normalize lead interests/status and index leads by (status, created_at)
+
+Revision ID: add_leads_status_created_index
+Revises: add_customer_list_indexes
+Create Date: 2026-10-17 13:00:00.000000
+
+"""
+import json
+
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = 'add_leads_status_created_index'
+down_revision = 'add_customer_list_indexes'
+branch_labels = None
+depends_on = None
+
+
+BATCH_SIZE = 1000
+
+
+def _normalize_interests(value):
+    # 与 Lead.normalize_interests 保持一致（迁移中不引用应用模型）
+    if value is None:
+        return []
+    if isinstance(value, str):
+        text = value.strip()
+        if not text:
+            return []
+        try:
+            value = json.loads(text)
+        except (ValueError, TypeError):
+            value = text.split(',')
+    if not isinstance(value, (list, tuple)):
+        value = [value]
+
+    interests = []
+    for item in value:
+        item = str(item).strip() if item is not None else ''
+        if item and item not in interests:
+            interests.append(item)
+    return interests
+
+
+def upgrade():
+    conn = op.get_bind()
+    leads = sa.table(
+        'leads',
+        sa.column('id', sa.Integer),
+        sa.column('interest', sa.Text),
+        sa.column('status', sa.String)
+    )
+
+    conn.execute(leads.update().where(leads.c.status.is_(None)).values(status='new'))
+
+    # 旧数据的 interest 可能是逗号分隔字符串或非数组 JSON，统一改写成 JSON 数组
+    last_id = 0
+    while True:
+        rows = conn.execute(
+            sa.select(leads.c.id, leads.c.interest)
+            .where(leads.c.id > last_id)
+            .order_by(leads.c.id)
+            .limit(BATCH_SIZE)
+        ).fetchall()
+        if not rows:
+            break
+        for lead_id, interest in rows:
+            normalized = json.dumps(_normalize_interests(interest))
+            if normalized != interest:
+                conn.execute(leads.update().where(leads.c.id == lead_id).values(interest=normalized))
+        last_id = rows[-1][0]
+
+    with op.batch_alter_table('leads', schema=None) as batch_op:
+        batch_op.alter_column('status',
+               existing_type=sa.String(length=20),
+               nullable=False)
+        batch_op.create_index('ix_leads_status_created_at', ['status', 'created_at'], unique=False)
+        batch_op.create_index(batch_op.f('ix_leads_created_at'), ['created_at'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('leads', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_leads_created_at'))
+        batch_op.drop_index('ix_leads_status_created_at')
+        batch_op.alter_column('status',
+               existing_type=sa.String(length=20),
+               nullable=True)
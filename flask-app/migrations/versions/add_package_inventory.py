@@ -0,0 +1,78 @@
+"""add package_inventory counters and inventory_holds
+
+Revision ID: add_package_inventory
+Revises: add_trips_start_end_index
+Create Date: 2026-10-17 16:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = 'add_package_inventory'
+down_revision = 'add_trips_start_end_index'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'package_inventory',
+        sa.Column('package_id', sa.Integer(), nullable=False),
+        sa.Column('trip_id', sa.Integer(), nullable=False),
+        sa.Column('capacity', sa.Integer(), nullable=True),
+        sa.Column('sold', sa.Integer(), nullable=False, server_default='0'),
+        sa.Column('held', sa.Integer(), nullable=False, server_default='0'),
+        sa.Column('updated_at', sa.DateTime(), nullable=True),
+        sa.ForeignKeyConstraint(['package_id'], ['trip_packages.id'], ondelete='CASCADE'),
+        sa.ForeignKeyConstraint(['trip_id'], ['trips.id'], ondelete='CASCADE'),
+        sa.PrimaryKeyConstraint('package_id')
+    )
+    with op.batch_alter_table('package_inventory', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_package_inventory_trip_id'), ['trip_id'], unique=False)
+
+    op.create_table(
+        'inventory_holds',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('package_id', sa.Integer(), nullable=False),
+        sa.Column('pending_booking_id', sa.Integer(), nullable=True),
+        sa.Column('payment_intent_id', sa.String(length=128), nullable=False),
+        sa.Column('quantity', sa.Integer(), nullable=False),
+        sa.Column('status', sa.String(length=20), nullable=False, server_default='held'),
+        sa.Column('expires_at', sa.DateTime(), nullable=False),
+        sa.Column('created_at', sa.DateTime(), nullable=True),
+        sa.Column('resolved_at', sa.DateTime(), nullable=True),
+        sa.ForeignKeyConstraint(['package_id'], ['trip_packages.id'], ondelete='CASCADE'),
+        sa.ForeignKeyConstraint(['pending_booking_id'], ['pending_bookings.id'], ondelete='SET NULL'),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('payment_intent_id', 'package_id', name='uq_inventory_holds_pi_package')
+    )
+    with op.batch_alter_table('inventory_holds', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_inventory_holds_payment_intent_id'), ['payment_intent_id'], unique=False)
+        batch_op.create_index('ix_inventory_holds_status_expires_at', ['status', 'expires_at'], unique=False)
+
+    # 回填：已售 = 未取消预订的 booking_packages.quantity 之和；历史待支付报名不补锁定
+    op.execute("""
+        INSERT INTO package_inventory (package_id, trip_id, capacity, sold, held, updated_at)
+        SELECT p.id, p.trip_id, NULLIF(p.capacity, 0),
+               COALESCE((
+                   SELECT SUM(COALESCE(bp.quantity, 1))
+                   FROM booking_packages bp
+                   JOIN bookings b ON b.id = bp.booking_id
+                   WHERE bp.package_id = p.id
+                     AND (b.status IS NULL OR b.status <> 'cancelled')
+               ), 0),
+               0, CURRENT_TIMESTAMP
+        FROM trip_packages p
+    """)
+
+
+def downgrade():
+    with op.batch_alter_table('inventory_holds', schema=None) as batch_op:
+        batch_op.drop_index('ix_inventory_holds_status_expires_at')
+        batch_op.drop_index(batch_op.f('ix_inventory_holds_payment_intent_id'))
+    op.drop_table('inventory_holds')
+
+    with op.batch_alter_table('package_inventory', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_package_inventory_trip_id'))
+    op.drop_table('package_inventory')
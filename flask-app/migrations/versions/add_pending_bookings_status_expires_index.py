@@ -0,0 +1,24 @@
+"""add pending_bookings (status, expires_at) index for the expiry sweeper
+
+Revision ID: add_pending_bookings_status_expires_index
+Revises: add_discount_code_limits
+Create Date: 2026-10-17 23:00:00.000000
+
+"""
+from alembic import op
+
+
+revision = 'add_pending_bookings_status_expires_index'
+down_revision = 'add_discount_code_limits'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('pending_bookings', schema=None) as batch_op:
+        batch_op.create_index('ix_pending_bookings_status_expires_at', ['status', 'expires_at'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('pending_bookings', schema=None) as batch_op:
+        batch_op.drop_index('ix_pending_bookings_status_expires_at')
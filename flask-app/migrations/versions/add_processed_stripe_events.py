@@ -0,0 +1,33 @@
+"""add processed_stripe_events ledger
+
+Revision ID: add_processed_stripe_events
+Revises: add_stripe_events_inbox
+Create Date: 2026-10-17 20:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = 'add_processed_stripe_events'
+down_revision = 'add_stripe_events_inbox'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'processed_stripe_events',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('event_id', sa.String(length=255), nullable=True),
+        sa.Column('object_id', sa.String(length=255), nullable=True),
+        sa.Column('handler', sa.String(length=64), nullable=False),
+        sa.Column('created_at', sa.DateTime(), nullable=True),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('event_id', 'handler', name='uq_processed_stripe_events_event_handler'),
+        sa.UniqueConstraint('object_id', 'handler', name='uq_processed_stripe_events_object_handler')
+    )
+
+
+def downgrade():
+    op.drop_table('processed_stripe_events')
@@ -0,0 +1,61 @@
+"""add revenue_daily rollup and rollup_watermarks tables
+
+Revision ID: add_revenue_daily_rollup
+Revises: add_trip_financial_summary
+Create Date: 2026-10-17 11:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = 'add_revenue_daily_rollup'
+down_revision = 'add_trip_financial_summary'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'revenue_daily',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('day', sa.Date(), nullable=False),
+        sa.Column('trip_id', sa.Integer(), nullable=True),
+        sa.Column('status', sa.String(length=20), nullable=False),
+        sa.Column('payment_count', sa.Integer(), nullable=False, server_default='0'),
+        sa.Column('gross_cents', sa.BigInteger(), nullable=False, server_default='0'),
+        sa.Column('fee_cents', sa.BigInteger(), nullable=False, server_default='0'),
+        sa.Column('refund_count', sa.Integer(), nullable=False, server_default='0'),
+        sa.Column('refunded_cents', sa.BigInteger(), nullable=False, server_default='0'),
+        sa.Column('updated_at', sa.DateTime(), nullable=True),
+        sa.ForeignKeyConstraint(['trip_id'], ['trips.id'], ondelete='SET NULL'),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('day', 'trip_id', 'status', name='uq_revenue_daily_day_trip_status')
+    )
+    op.create_index(op.f('ix_revenue_daily_day'), 'revenue_daily', ['day'], unique=False)
+    op.create_index(op.f('ix_revenue_daily_trip_id'), 'revenue_daily', ['trip_id'], unique=False)
+    # 增量任务按 paid_at / refunded_at 范围查找变化的日期，重算时按 paid_at 范围汇总
+    op.create_index(op.f('ix_payments_paid_at'), 'payments', ['paid_at'], unique=False)
+    op.create_index(op.f('ix_payments_refunded_at'), 'payments', ['refunded_at'], unique=False)
+
+    op.create_table(
+        'rollup_watermarks',
+        sa.Column('name', sa.String(length=64), nullable=False),
+        sa.Column('value', sa.DateTime(), nullable=True),
+        sa.Column('updated_at', sa.DateTime(), nullable=True),
+        sa.PrimaryKeyConstraint('name')
+    )
+    # 水位线为空：首次运行增量任务时做全量汇总（或先运行 scripts/backfill_revenue_daily.py）
+    op.bulk_insert(
+        sa.table('rollup_watermarks', sa.column('name', sa.String), sa.column('value', sa.DateTime)),
+        [{'name': 'revenue_daily', 'value': None}]
+    )
+
+
+def downgrade():
+    op.drop_table('rollup_watermarks')
+    op.drop_index(op.f('ix_payments_refunded_at'), table_name='payments')
+    op.drop_index(op.f('ix_payments_paid_at'), table_name='payments')
+    op.drop_index(op.f('ix_revenue_daily_trip_id'), table_name='revenue_daily')
+    op.drop_index(op.f('ix_revenue_daily_day'), table_name='revenue_daily')
+    op.drop_table('revenue_daily')
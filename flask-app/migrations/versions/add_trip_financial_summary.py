@@ -0,0 +1,42 @@
+"""add trip_financial_summary table
+
+Revision ID: add_trip_financial_summary
+Revises: 18a67ca96014
+Create Date: 2026-10-17 10:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = 'add_trip_financial_summary'
+down_revision = '18a67ca96014'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    conn = op.get_bind()
+    inspector = sa.inspect(conn)
+    if 'trip_financial_summary' in inspector.get_table_names():
+        return
+
+    op.create_table(
+        'trip_financial_summary',
+        sa.Column('trip_id', sa.Integer(), nullable=False),
+        sa.Column('amount_gross', sa.Float(), nullable=False, server_default='0'),
+        sa.Column('amount_discount', sa.Float(), nullable=False, server_default='0'),
+        sa.Column('amount_expected', sa.Float(), nullable=False, server_default='0'),
+        sa.Column('amount_paid', sa.Float(), nullable=False, server_default='0'),
+        sa.Column('amount_pending', sa.Float(), nullable=False, server_default='0'),
+        sa.Column('booking_count', sa.Integer(), nullable=False, server_default='0'),
+        sa.Column('participant_count', sa.Integer(), nullable=False, server_default='0'),
+        sa.Column('updated_at', sa.DateTime(), nullable=True),
+        sa.ForeignKeyConstraint(['trip_id'], ['trips.id'], ondelete='CASCADE'),
+        sa.PrimaryKeyConstraint('trip_id')
+    )
+    # 数据由 scripts/rebuild_trip_financial_summary.py 回填
+
+
+def downgrade():
+    op.drop_table('trip_financial_summary')
@@ -0,0 +1,32 @@
+"""add updated_at to trip_packages for payment schedule caching
+
+Revision ID: add_trip_package_updated_at
+Revises: seed_default_buyer_info_fields
+Create Date: 2026-10-17 18:00:00.000000
+
+"""
+from datetime import datetime
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = 'add_trip_package_updated_at'
+down_revision = 'seed_default_buyer_info_fields'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('trip_packages', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('updated_at', sa.DateTime(), nullable=True))
+
+    # 应用按 UTC 写时间戳，这里不用数据库的本地时间
+    op.get_bind().execute(
+        sa.text("UPDATE trip_packages SET updated_at = :now WHERE updated_at IS NULL"),
+        {'now': datetime.utcnow()}
+    )
+
+
+def downgrade():
+    with op.batch_alter_table('trip_packages', schema=None) as batch_op:
+        batch_op.drop_column('updated_at')
@@ -0,0 +1,51 @@
+"""store trip setup completion on trips
+
+Revision ID: add_trip_setup_complete
+Revises: add_leads_status_created_index
+Create Date: 2026-10-17 14:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = 'add_trip_setup_complete'
+down_revision = 'add_leads_status_created_index'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('trips', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('setup_complete', sa.Boolean(), nullable=False, server_default=sa.false()))
+
+    # 回填：basics / description 必填字段齐全且至少有一个套餐（布尔值用 sa.true()，PostgreSQL 不接受整数）
+    # 只回填 setup_complete，不改 status：已完成的草稿在下次保存 builder 时由 update_trip_completion 发布
+    trips = sa.table(
+        'trips',
+        sa.column('id', sa.Integer),
+        sa.column('title', sa.String),
+        sa.column('start_date', sa.Date),
+        sa.column('end_date', sa.Date),
+        sa.column('destination_text', sa.String),
+        sa.column('description', sa.Text),
+        sa.column('setup_complete', sa.Boolean)
+    )
+    trip_packages = sa.table('trip_packages', sa.column('trip_id', sa.Integer))
+    op.execute(
+        trips.update().where(
+            sa.and_(
+                trips.c.title.isnot(None), trips.c.title != '',
+                trips.c.start_date.isnot(None),
+                trips.c.end_date.isnot(None),
+                trips.c.destination_text.isnot(None), trips.c.destination_text != '',
+                trips.c.description.isnot(None), trips.c.description != '',
+                sa.exists().where(trip_packages.c.trip_id == trips.c.id)
+            )
+        ).values(setup_complete=sa.true())
+    )
+
+
+def downgrade():
+    with op.batch_alter_table('trips', schema=None) as batch_op:
+        batch_op.drop_column('setup_complete')
@@ -0,0 +1,24 @@
+"""index trips by (start_date, end_date) for the calendar feed
+
+Revision ID: add_trips_start_end_index
+Revises: add_trip_setup_complete
+Create Date: 2026-10-17 15:00:00.000000
+
+"""
+from alembic import op
+
+
+revision = 'add_trips_start_end_index'
+down_revision = 'add_trip_setup_complete'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('trips', schema=None) as batch_op:
+        batch_op.create_index('ix_trips_start_end', ['start_date', 'end_date'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('trips', schema=None) as batch_op:
+        batch_op.drop_index('ix_trips_start_end')
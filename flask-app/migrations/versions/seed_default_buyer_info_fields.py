@@ -0,0 +1,62 @@
+"""seed default buyer info fields for trips without any
+
+Revision ID: seed_default_buyer_info_fields
+Revises: add_package_inventory
+Create Date: 2026-10-17 17:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = 'seed_default_buyer_info_fields'
+down_revision = 'add_package_inventory'
+branch_labels = None
+depends_on = None
+
+
+# 与 BuyerInfoField.DEFAULT_FIELDS 保持一致
+DEFAULT_FIELDS = (
+    ('First Name', 'text'),
+    ('Last Name', 'text'),
+    ('Email', 'email'),
+    ('Phone', 'phone'),
+)
+
+
+def upgrade():
+    # 以前由 trip_detail 在公开 GET 上懒创建；这里一次性给还没有字段的行程补齐
+    conn = op.get_bind()
+    trip_ids = [row[0] for row in conn.execute(sa.text("""
+        SELECT trips.id FROM trips
+        WHERE NOT EXISTS (
+            SELECT 1 FROM buyer_info_fields WHERE buyer_info_fields.trip_id = trips.id
+        )
+    """))]
+    if not trip_ids:
+        return
+
+    buyer_info_fields = sa.table(
+        'buyer_info_fields',
+        sa.column('trip_id', sa.Integer),
+        sa.column('field_name', sa.String),
+        sa.column('field_type', sa.String),
+        sa.column('is_required', sa.Boolean),
+        sa.column('display_order', sa.Integer),
+    )
+    op.bulk_insert(buyer_info_fields, [
+        {
+            'trip_id': trip_id,
+            'field_name': field_name,
+            'field_type': field_type,
+            'is_required': True,
+            'display_order': order,
+        }
+        for trip_id in trip_ids
+        for order, (field_name, field_type) in enumerate(DEFAULT_FIELDS)
+    ])
+
+
+def downgrade():
+    # 无法区分回填的字段和管理员手动配置的同名字段，降级时保留数据
+    pass
@@ -0,0 +1,58 @@
+import argparse
+import os
+import sys
+from datetime import date, datetime
+
+CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
+APP_ROOT = os.path.abspath(os.path.join(CURRENT_DIR, ".."))
+if APP_ROOT not in sys.path:
+    sys.path.insert(0, APP_ROOT)
+
+from app import create_app, db
+from app.models import RollupWatermark
+from app.revenue import ROLLUP_NAME, backfill_revenue_daily
+
+
+def _parse_date(value):
+    return date.fromisoformat(value) if value else None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Backfill the revenue_daily rollup from payments.")
+    parser.add_argument("--start", type=_parse_date, help="First day to rebuild (YYYY-MM-DD, UTC).")
+    parser.add_argument("--end", type=_parse_date, help="Last day to rebuild (YYYY-MM-DD, UTC).")
+    parser.add_argument(
+        "--set-watermark",
+        action="store_true",
+        help="Advance the incremental job watermark to the backfill start time.",
+    )
+    args = parser.parse_args()
+
+    config_name = os.environ.get("FLASK_ENV", "development")
+    app = create_app(config_name)
+
+    with app.app_context():
+        run_started = datetime.utcnow()
+        result = backfill_revenue_daily(args.start, args.end)
+
+        if args.set_watermark:
+            watermark = db.session.get(RollupWatermark, ROLLUP_NAME)
+            if watermark is None:
+                watermark = RollupWatermark(name=ROLLUP_NAME)
+                db.session.add(watermark)
+            watermark.value = run_started
+
+        db.session.commit()
+
+        app.logger.info(
+            "revenue backfill done start=%s end=%s days=%s rows=%s set_watermark=%s",
+            args.start,
+            args.end,
+            result["days"],
+            result["rows"],
+            args.set_watermark,
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,39 @@
+import argparse
+import os
+import sys
+
+CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
+APP_ROOT = os.path.abspath(os.path.join(CURRENT_DIR, ".."))
+if APP_ROOT not in sys.path:
+    sys.path.insert(0, APP_ROOT)
+
+from app import create_app
+from app.clients import merge_duplicate_clients
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Merge clients that share the same normalized email and repoint their bookings and payments."
+    )
+    parser.add_argument("--dry-run", action="store_true", help="Only report how many clients would be merged.")
+    args = parser.parse_args()
+
+    config_name = os.environ.get("FLASK_ENV", "development")
+    app = create_app(config_name)
+
+    with app.app_context():
+        # 每组重复客户一个事务
+        result = merge_duplicate_clients(dry_run=args.dry_run)
+
+        app.logger.info(
+            "client merge done groups=%s clients_removed=%s bookings_moved=%s payments_moved=%s dry_run=%s",
+            result["groups"],
+            result["clients_removed"],
+            result["bookings_moved"],
+            result["payments_moved"],
+            args.dry_run,
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,40 @@
+import argparse
+import os
+import sys
+
+CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
+APP_ROOT = os.path.abspath(os.path.join(CURRENT_DIR, ".."))
+if APP_ROOT not in sys.path:
+    sys.path.insert(0, APP_ROOT)
+
+from app import create_app, db
+from app.models import Trip
+from app.inventory import recount_trip_inventory
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Recount package_inventory sold/held counters from booking_packages and active holds."
+    )
+    parser.add_argument("--trip-id", type=int, action="append", help="Only recount these trips (repeatable).")
+    args = parser.parse_args()
+
+    config_name = os.environ.get("FLASK_ENV", "development")
+    app = create_app(config_name)
+
+    with app.app_context():
+        if args.trip_id:
+            trip_ids = sorted(set(args.trip_id))
+        else:
+            trip_ids = [row[0] for row in db.session.query(Trip.id).order_by(Trip.id).all()]
+
+        for trip_id in trip_ids:
+            # 每个行程一个事务，缩短库存行的加锁时间
+            recount_trip_inventory(trip_id)
+            db.session.commit()
+
+        app.logger.info("inventory recount done trips=%s", len(trip_ids))
+
+
+if __name__ == "__main__":
+    main()
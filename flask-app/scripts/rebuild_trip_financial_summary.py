@@ -0,0 +1,68 @@
+import argparse
+import os
+import sys
+
+CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
+APP_ROOT = os.path.abspath(os.path.join(CURRENT_DIR, ".."))
+if APP_ROOT not in sys.path:
+    sys.path.insert(0, APP_ROOT)
+
+from app import create_app, db
+from app.models import Trip
+from app.stats import rebuild_trip_financial_summaries
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Rebuild trip_financial_summary from bookings and report drift."
+    )
+    parser.add_argument("--trip-id", type=int, action="append", help="Only rebuild these trips (repeatable).")
+    parser.add_argument("--batch-size", type=int, default=100, help="Trips per batch/commit.")
+    parser.add_argument("--dry-run", action="store_true", help="Only report drift, do not write.")
+    args = parser.parse_args()
+
+    config_name = os.environ.get("FLASK_ENV", "development")
+    app = create_app(config_name)
+
+    with app.app_context():
+        if args.trip_id:
+            trip_ids = sorted(set(args.trip_id))
+        else:
+            trip_ids = [row[0] for row in db.session.query(Trip.id).order_by(Trip.id).all()]
+
+        processed = 0
+        missing = 0
+        drifted = 0
+
+        for start in range(0, len(trip_ids), args.batch_size):
+            batch = trip_ids[start:start + args.batch_size]
+            for item in rebuild_trip_financial_summaries(batch, dry_run=args.dry_run):
+                if item["missing"]:
+                    missing += 1
+                    app.logger.warning("summary missing trip_id=%s", item["trip_id"])
+                    continue
+                drifted += 1
+                for field, (stored, live) in item["diff"].items():
+                    app.logger.warning(
+                        "summary drift trip_id=%s field=%s stored=%s live=%s",
+                        item["trip_id"],
+                        field,
+                        stored,
+                        live,
+                    )
+            processed += len(batch)
+
+            if not args.dry_run:
+                db.session.commit()
+
+        app.logger.info(
+            "rebuild done processed=%s missing=%s drifted=%s dry_run=%s",
+            processed,
+            missing,
+            drifted,
+            args.dry_run,
+        )
+
+
+if __name__ == "__main__":
+    main()
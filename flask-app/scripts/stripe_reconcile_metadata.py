@@ -10,6 +10,7 @@ if APP_ROOT not in sys.path:
 from app import create_app, db
 from app.models import Payment
 from app.payments import retrieve_payment_intent
+from app.stripe_client import stripe_client_stats
 
 
 def _parse_int(value):
@@ -86,6 +87,10 @@ def main():
                 app.logger.warning(
                     "reconcile skip payment_id=%s status=%s", payment.id, status
                 )
+                # Stripe 连续失败触发熔断：停止本次运行，已处理的部分照常提交
+                if stripe_client_stats()["breaker"]["state"] == "open":
+                    app.logger.error("reconcile aborted: Stripe circuit breaker open payment_id=%s", payment.id)
+                    break
                 continue
 
             if status == "updated":